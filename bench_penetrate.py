@@ -0,0 +1,611 @@
+#!/usr/bin/env python3
+"""
+Benchmarks for penetrate_final.py
+
+Generates a synthetic repository in a temporary directory and times the
+file walkers on it, times the path parser on this project's markdown, and
+runs a suite of end-to-end cases whose throughput (relative to the os.walk
+walker on the same tree) and peak RSS can be saved as a JSON baseline and
+checked against it.
+
+Usage:
+    python bench_penetrate.py                    # 200k-file tree
+    python bench_penetrate.py --files 20000      # Smaller tree
+    python bench_penetrate.py --keep /tmp/repo   # Reuse/keep the tree
+    python bench_penetrate.py parse              # Path parser only
+    python bench_penetrate.py suite --save-baseline bench_baseline.json
+    python bench_penetrate.py suite --baseline bench_baseline.json   # Fails on regressions
+    python bench_penetrate.py suite --files 300 --min-seconds 0 --baseline b.json   # Quick check
+"""
+
+import io
+import re
+import os
+import sys
+import json
+import math
+import time
+import random
+import shutil
+import argparse
+import resource
+import tempfile
+import subprocess
+import contextlib
+
+# Add current directory to path to import penetrate_final
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import penetrate_final
+
+BENCHMARKS = ('walk', 'parse', 'suite')
+EXTENSIONS = ['.ts', '.tsx', '.js', '.py', '.json', '.css', '.md', '.png']
+
+# Default tree sizes: the walker runs on empty files, the suite on files
+# with content (mean size in bytes, lognormally distributed)
+DEFAULT_WALK_FILES = 200000
+DEFAULT_SUITE_FILES = 20000
+DEFAULT_MEAN_SIZE = 2048
+DEFAULT_BINARY_RATIO = 0.02
+DEFAULT_IGNORE_FILES = 20
+
+# Suite cases, each run in a fresh interpreter so its peak RSS is its own
+SUITE_CASES = ('scan', 'expand', 'tree', 'tree-100k', 'main')
+BASELINE_VERSION = 3
+# Paths the tree-100k case renders, generated in memory whatever the tree size
+TREE_CASE_PATHS = 100000
+# Fast cases are repeated until they have run this long, for a stable best time
+MIN_CASE_SECONDS = 1.0
+MAX_CASE_RUNS = 100
+# A case regresses when its relative throughput drops, or its peak RSS
+# grows, by more than this fraction of the baseline
+DEFAULT_TOLERANCE = 0.25
+
+# Lines the synthetic source files are made of
+SOURCE_LINES = [
+    "import { useState, useEffect } from 'react';\n",
+    "export function handler(request, response) {\n",
+    "  const result = await fetch(`/api/items/${id}`);\n",
+    "  if (!result.ok) throw new Error('request failed');\n",
+    "  return items.filter((item) => item.enabled).map(format);\n",
+    "}\n",
+    "\n",
+    "// TODO: move this into the shared helpers\n",
+]
+
+def make_file_content(rng, size):
+    """
+    Returns about size bytes of source-like text.
+    """
+    lines = []
+    total = 0
+    while total < size:
+        line = rng.choice(SOURCE_LINES)
+        lines.append(line)
+        total += len(line)
+    return ''.join(lines).encode('utf-8')
+
+def make_synthetic_dirs(rng, depth, fanout):
+    """
+    Returns the relative directories of a synthetic tree ('' for the root):
+    up to fanout subdirectories per directory, depth levels deep.
+    """
+    dirs = ['']
+    for level in range(depth):
+        for parent in list(dirs):
+            if parent.count('/') + 1 == level or (level == 0 and parent == ''):
+                for i in range(rng.randint(1, fanout)):
+                    dirs.append(f"{parent}/d{level}_{i}" if parent else f"d{level}_{i}")
+    return dirs
+
+def make_synthetic_paths(files, depth=6, fanout=8, seed=0):
+    """
+    Returns {rel_path: size} for files spread over a synthetic tree like
+    make_synthetic_repo's, without creating anything on disk.
+    """
+    rng = random.Random(seed)
+    dirs = make_synthetic_dirs(rng, depth, fanout)
+    paths = {}
+    for n in range(files):
+        rel_dir = rng.choice(dirs)
+        name = f"f{n}{rng.choice(EXTENSIONS)}"
+        paths[f"{rel_dir}/{name}" if rel_dir else name] = rng.randint(0, 8192)
+    return paths
+
+def make_synthetic_repo(root, files=200000, depth=6, fanout=8, seed=0,
+                        mean_size=0, binary_ratio=0.0, ignore_files=0):
+    """
+    Creates a repository with the given number of files spread over nested
+    directories, plus ignored node_modules/, dist/ and .next/ trees that a
+    walker should prune. Files are empty unless mean_size is set, in which
+    case their sizes follow a lognormal distribution with that mean;
+    binary_ratio of them are binary .wasm files. ignore_files nested
+    .gitignore files add negations and patterns that a share of the files
+    match.
+    """
+    rng = random.Random(seed)
+    dirs = make_synthetic_dirs(rng, depth, fanout)
+
+    with open(os.path.join(root, '.gitignore'), 'w') as f:
+        f.write("dist/\n.next/\n*.log\n")
+    for k, rel_dir in enumerate(rng.sample(dirs[1:], min(ignore_files, len(dirs) - 1))):
+        os.makedirs(os.path.join(root, rel_dir), exist_ok=True)
+        with open(os.path.join(root, rel_dir, '.gitignore'), 'w') as f:
+            f.write(f"*.gen.ts\n!keep{k}.gen.ts\nbuild/\ntmp_*\n/local-{k}.json\n")
+
+    # sigma of the size distribution; mu follows from the mean
+    sigma = 1.0
+    mu = math.log(mean_size) - sigma * sigma / 2 if mean_size else 0.0
+    for n in range(files):
+        rel_dir = rng.choice(dirs)
+        # About 1 file in 10 lands in a directory the walker should prune
+        ignored = rng.choice(('',) * 27 + ('dist', 'node_modules', '.next'))
+        if ignored:
+            rel_dir = f"{rel_dir}/{ignored}" if rel_dir else ignored
+        full_dir = os.path.join(root, rel_dir)
+        os.makedirs(full_dir, exist_ok=True)
+        name = f"f{n}{rng.choice(EXTENSIONS)}"
+        if ignore_files and n % 12 == 0:
+            name = rng.choice((f"f{n}.gen.ts", f"tmp_{n}.ts"))
+        if rng.random() < binary_ratio:
+            name = f"f{n}.wasm"
+            content = b'\0asm\1\0\0\0' + rng.randbytes(min(int(rng.lognormvariate(mu, sigma)), 1024 * 1024) if mean_size else 64)
+        elif mean_size:
+            content = make_file_content(rng, min(int(rng.lognormvariate(mu, sigma)), 1024 * 1024))
+        else:
+            content = b''
+        with open(os.path.join(full_dir, name), 'wb') as f:
+            f.write(content)
+
+def scan_all_files_oswalk(root_dir):
+    """
+    The os.walk-based scan_all_files this module used before the scandir
+    walker, kept as the baseline for comparison.
+    """
+    gitignore_spec = penetrate_final.load_gitignore(root_dir)
+    valid_files = []
+
+    for dirpath, dirnames, filenames in os.walk(root_dir):
+        rel_dir = os.path.relpath(dirpath, root_dir).replace(os.sep, '/')
+        if rel_dir == '.':
+            rel_dir = ''
+        gitignore_spec.chain(rel_dir, has_gitignore='.gitignore' in filenames)
+        dirnames[:] = [d for d in dirnames if d not in penetrate_final.IGNORED_DIRS and
+                       not gitignore_spec.is_dir_ignored(f"{rel_dir}/{d}" if rel_dir else d)]
+
+        for filename in filenames:
+            rel_path = os.path.relpath(os.path.join(dirpath, filename), root_dir)
+            if filename == 'penetrate_final.py' or filename == penetrate_final.OUTPUT_FILE:
+                continue
+            if not penetrate_final.is_ignored(rel_path, gitignore_spec):
+                valid_files.append(rel_path)
+
+    return valid_files
+
+def parse_file_paths_from_text_legacy(text):
+    """
+    The inline-regex parser this module used before the precompiled
+    single-pass extractor, kept as the baseline for comparison.
+
+    Parses file and directory paths from user input text.
+    Handles various formats including:
+    - Backtick paths: `src/app/page.tsx`
+    - File patterns: **/route.ts
+    - Directory paths: src/components/content/
+    - Regular paths in text
+    """
+    paths = set()
+    
+    # Pattern 1: Backtick enclosed paths (most reliable)
+    backtick_pattern = r'`([^`\n]+)`'
+    backtick_matches = re.findall(backtick_pattern, text)
+    for match in backtick_matches:
+        if '/' in match or '\\' in match:
+            paths.add(match.strip())
+    
+    # Pattern 2: File paths with extensions in list items
+    # Look for lines that start with bullet points or have file patterns
+    lines = text.split('\n')
+    for line in lines:
+        line = line.strip()
+        
+        # Skip if it's a header or description
+        if line.startswith('#') or line.startswith('=') or not line:
+            continue
+        
+        # Extract file paths from bullet points
+        bullet_match = re.match(r'^[\s\-\*\•]*\**([^:\n]*\.(ts|tsx|js|jsx|py|html|css|json|rs|java|c|cpp|sh|bat|php))\**', line, re.IGNORECASE)
+        if bullet_match:
+            file_path = bullet_match.group(1).strip()
+            # Clean up any trailing punctuation
+            file_path = re.sub(r'[\*\_\-\—\–]+$', '', file_path)
+            if len(file_path) > 5 and '/' in file_path:  # Basic validation
+                paths.add(file_path)
+        
+        # Extract directory paths
+        dir_match = re.match(r'^[\s\-\*\•]*\**([^:\n]*/[^:\n]*?)\**(\s|$)', line)
+        if dir_match:
+            dir_path = dir_match.group(1).strip()
+            # Clean up
+            dir_path = re.sub(r'[\*\_\-\—\–]+$', '', dir_path)
+            dir_path = re.sub(r'\s+\d+\s*files?$', '', dir_path, flags=re.IGNORECASE)
+            # Skip if it's an API endpoint without .ts or looks like a description
+            if (len(dir_path) > 3 and 
+                '/' in dir_path and 
+                not dir_path.startswith('http') and 
+                not '://' in dir_path and
+                not dir_path.endswith('-') and
+                not re.match(r'.*\s+(Main|Purpose|Features|Key|Component|Page|Dashboard|View|Panel|Engine)$', dir_path)):
+                paths.add(dir_path.rstrip('/'))
+    
+    # Pattern 3: API endpoints - improved extraction
+    # Look for patterns like /api/content/analyze/route.ts
+    api_route_pattern = r'(/api/[\w\-/]+/route\.(ts|js))'
+    api_route_matches = re.findall(api_route_pattern, text)
+    for match in api_route_matches:
+        paths.add(match[0])
+    
+    # Also capture API directory paths
+    api_dir_pattern = r'(/api/[\w\-/]+)(?=\s|$|\))'
+    api_matches = re.findall(api_dir_pattern, text)
+    for match in api_matches:
+        # Only add if it doesn't end with a word that suggests it's a description
+        if not match.endswith(('-', ' ', '–', '—')) and not match.endswith('/route'):
+            paths.add(match.strip())
+    
+    # Pattern 4: Trigger.dev task paths
+    trigger_pattern = r'(trigger/[\w\-/]+\.ts)'
+    trigger_matches = re.findall(trigger_pattern, text)
+    for match in trigger_matches:
+        paths.add(match.strip())
+    
+    # Pattern 5: Extract paths from code blocks
+    code_block_pattern = r'```(?:text)?\s*\n([\s\S]*?)\n```'
+    code_blocks = re.findall(code_block_pattern, text)
+    for block in code_blocks:
+        # Extract paths from tree-like structures
+        for line in block.split('\n'):
+            line = line.strip()
+            # Match indented file paths
+            match = re.match(r'^[│\s├└]*[\s─┬]*([\w/\\\-]+\.(ts|tsx|js|jsx|py|html|css|json))$', line)
+            if match:
+                paths.add(match.group(1))
+    
+    # Clean up paths
+    cleaned_paths = set()
+    for path in paths:
+        # Remove common markdown artifacts and descriptions
+        path = re.sub(r'[\*\_\`\[\]]+', '', path)
+        path = re.sub(r'\s+\-\s+.*$', '', path)  # Remove descriptions after dash
+        path = path.strip()
+        
+        # Normalize path separators
+        path = path.replace('\\', '/')
+        
+        # Skip if too short or clearly not a path
+        if (len(path) > 2 and 
+            ('/' in path or '.' in path) and
+            not path.startswith('#') and
+            not path.startswith('Summary') and
+            not path.startswith('Components') and
+            not path.startswith('📄') and
+            not path.startswith('🎨') and
+            not path.startswith('🛠') and
+            not path.startswith('⚙') and
+            not path.startswith('📊') and
+            not path.startswith('1.') and
+            not path.startswith('→') and
+            not path.startswith('├──') and
+            not path.startswith('└──') and
+            not 'Monthly/Weekly/Daily' in path and
+            not 'appears to be a backup' in path):
+            cleaned_paths.add(path)
+    
+    return list(cleaned_paths)
+
+def best_time(func, repeat):
+    """
+    Runs func repeat times and returns (best seconds, last result).
+    """
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = func()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best, result
+
+def bench_walkers(root, repeat=3):
+    """
+    Times the os.walk baseline against scan_all_files and checks they agree.
+    """
+    old_time, old_files = best_time(lambda: scan_all_files_oswalk(root), repeat)
+    # scan_all_files prints progress; keep the table readable
+    with contextlib.redirect_stdout(io.StringIO()):
+        new_time, new_files = best_time(lambda: penetrate_final.scan_all_files(root), repeat)
+
+    if sorted(old_files) != sorted(new_files):
+        print("ERROR: walkers returned different file lists")
+        sys.exit(1)
+
+    print(f"\n{'walker':<12}{'files':>10}{'best (s)':>12}{'files/s':>14}")
+    for name, elapsed in (('os.walk', old_time), ('scandir', new_time)):
+        print(f"{name:<12}{len(new_files):>10}{elapsed:>12.3f}{len(new_files) / elapsed:>14,.0f}")
+    print(f"\nSpeedup: {old_time / new_time:.2f}x")
+
+def bench_parser(root, repeat=3):
+    """
+    Times the legacy path parser against parse_file_paths_from_text on the
+    project's own markdown and text files and checks they find the same paths.
+    """
+    sources = []
+    for dirpath, dirnames, filenames in os.walk(root):
+        dirnames[:] = sorted(d for d in dirnames if d not in penetrate_final.IGNORED_DIRS)
+        for filename in sorted(filenames):
+            if filename.endswith(('.md', '.txt')):
+                with open(os.path.join(dirpath, filename), 'r', encoding='utf-8', errors='replace') as f:
+                    sources.append(f.read())
+    if not sources:
+        print("No .md/.txt files to parse")
+        return
+    text = '\n'.join(sources)
+
+    for source in sources:
+        if set(parse_file_paths_from_text_legacy(source)) != set(penetrate_final.parse_file_paths_from_text(source)):
+            print("ERROR: parsers returned different paths")
+            sys.exit(1)
+
+    old_time, old_paths = best_time(lambda: parse_file_paths_from_text_legacy(text), repeat)
+    new_time, new_paths = best_time(lambda: penetrate_final.parse_file_paths_from_text(text), repeat)
+    if set(old_paths) != set(new_paths):
+        print("ERROR: parsers returned different paths")
+        sys.exit(1)
+
+    megabytes = len(text.encode('utf-8')) / (1024 * 1024)
+    print(f"\n{'parser':<12}{'paths':>10}{'best (s)':>12}{'MB/s':>14}")
+    for name, elapsed in (('legacy', old_time), ('single-pass', new_time)):
+        print(f"{name:<12}{len(new_paths):>10}{elapsed:>12.3f}{megabytes / elapsed:>14.2f}")
+    print(f"\nSpeedup: {old_time / new_time:.2f}x")
+
+def sample_user_paths(files, rng, count=200):
+    """
+    Picks an input list for the expand case: existing files, their parent
+    directories and moved files that only the similar-name search can find.
+    """
+    files = sorted(f.replace(os.sep, '/') for f in files)
+    picked = rng.sample(files, min(count, len(files)))
+    paths = []
+    for i, rel_path in enumerate(picked):
+        if i % 10 == 0 and '/' in rel_path:
+            paths.append(rel_path.rpartition('/')[0] + '/')
+        elif i % 3 == 0:
+            paths.append(f"moved/{rel_path.rpartition('/')[2]}")
+        else:
+            paths.append(rel_path)
+    return paths
+
+def setup_case(name, root, workdir):
+    """
+    Prepares a suite case. Returns (run, unit): run() performs the case once
+    and returns how many units (files, paths or output bytes) it handled.
+    """
+    if name == 'scan':
+        def run():
+            return len(penetrate_final.scan_all_files(root))
+        return run, 'files'
+    if name == 'tree-100k':
+        sizes = make_synthetic_paths(TREE_CASE_PATHS)
+        paths = list(sizes)
+        def run():
+            penetrate_final.generate_tree(paths, sizes)
+            return len(paths)
+        return run, 'files'
+    
+    with contextlib.redirect_stdout(io.StringIO()):
+        files = penetrate_final.scan_all_files(root)
+    if name == 'tree':
+        def run():
+            penetrate_final.generate_tree(files)
+            return len(files)
+        return run, 'files'
+    if name == 'expand':
+        paths = sample_user_paths(files, random.Random(1))
+        def run():
+            penetrate_final._PATH_INDEXES.clear()
+            penetrate_final.expand_user_paths(paths, root, use_cache=False)
+            return len(paths)
+        return run, 'paths'
+    if name == 'main':
+        output = os.path.join(workdir, 'out.md')
+        def run():
+            penetrate_final.main(['--scan', '-o', output, '--no-cache'])
+            return os.path.getsize(output)
+        return run, 'bytes'
+    raise ValueError(f"unknown case: {name}")
+
+def settled_time(func, repeat, min_seconds):
+    """
+    Like best_time, but funcs faster than min_seconds over repeat runs are
+    run more often (up to MAX_CASE_RUNS times) for a stable best time.
+    """
+    best, result = best_time(func, repeat)
+    if best * repeat < min_seconds:
+        more, result = best_time(func, min(MAX_CASE_RUNS, int(min_seconds / max(best, 1e-6))))
+        best = min(best, more)
+    return best, result
+
+def run_case(name, root, repeat, min_seconds=MIN_CASE_SECONDS):
+    """
+    Runs one suite case in this process and returns its measurements: best
+    time, throughput in units per second, the process's peak RSS, and the
+    throughput relative to the os.walk walker timed on the same tree in the
+    same process, which unlike raw throughput carries over between machines.
+    Cases faster than min_seconds over repeat runs are run more often.
+    """
+    workdir = tempfile.mkdtemp(prefix='penetrate-bench-out-')
+    cwd = os.getcwd()
+    try:
+        os.chdir(root)
+        run, unit = setup_case(name, root, workdir)
+        with contextlib.redirect_stdout(io.StringIO()):
+            best, count = settled_time(run, repeat, min_seconds)
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(workdir, ignore_errors=True)
+    # ru_maxrss is in KB on Linux and in bytes on macOS; read before the
+    # reference walk so that it is the case's own
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == 'darwin':
+        peak_rss //= 1024
+    reference, walked = settled_time(lambda: len(scan_all_files_oswalk(root)), repeat, min_seconds)
+    throughput = count / best if best else 0.0
+    reference_throughput = walked / reference if reference else 0.0
+    return {'count': count, 'unit': unit, 'seconds': round(best, 6),
+            'throughput': round(throughput, 1), 'peak_rss_kb': peak_rss,
+            'reference_throughput': round(reference_throughput, 1),
+            'relative': round(throughput / reference_throughput, 4) if reference_throughput else 0.0}
+
+def measure_case(name, root, repeat, min_seconds=MIN_CASE_SECONDS):
+    """
+    Runs a suite case in a fresh interpreter (see run_case) and returns its
+    measurements.
+    """
+    result = subprocess.run([sys.executable, os.path.abspath(__file__), '--case', name,
+                             '--root', root, '--repeat', str(repeat), '--min-seconds', str(min_seconds)],
+                            capture_output=True, text=True)
+    if result.returncode != 0:
+        raise RuntimeError(f"case {name} failed:\n{result.stderr}")
+    return json.loads(result.stdout.splitlines()[-1])
+
+def compare_to_baseline(report, baseline, tolerance=DEFAULT_TOLERANCE):
+    """
+    Returns a message for every case that is slower relative to the os.walk
+    walker, or uses more memory, than the baseline by more than tolerance
+    (a fraction).
+    """
+    regressions = []
+    for name, result in report['results'].items():
+        old = baseline['results'].get(name)
+        if old is None:
+            continue
+        if result['relative'] < old['relative'] * (1 - tolerance):
+            regressions.append(f"{name}: {result['relative']:.4g} {result['unit']} per os.walk file, "
+                               f"baseline {old['relative']:.4g}")
+        if result['peak_rss_kb'] > old['peak_rss_kb'] * (1 + tolerance):
+            regressions.append(f"{name}: peak RSS {result['peak_rss_kb'] / 1024:.1f} MB, "
+                               f"baseline {old['peak_rss_kb'] / 1024:.1f} MB")
+    return regressions
+
+def bench_suite(root, params, repeat=3, cases=SUITE_CASES, baseline_path=None, save_path=None,
+                tolerance=DEFAULT_TOLERANCE, min_seconds=MIN_CASE_SECONDS):
+    """
+    Runs the suite cases on the synthetic tree at root, prints a table and
+    optionally saves the report as a baseline or checks it against one.
+    Returns the list of regressions (empty when there is no baseline).
+    """
+    report = {'version': BASELINE_VERSION, 'params': params, 'results': {}}
+    print(f"\n{'case':<10}{'count':>12}{'best (s)':>12}{'throughput':>22}{'vs os.walk':>12}{'peak RSS':>12}")
+    for name in cases:
+        result = report['results'][name] = measure_case(name, root, repeat, min_seconds)
+        print(f"{name:<10}{result['count']:>12}{result['seconds']:>12.3f}"
+              f"{result['throughput']:>16,.0f} {result['unit'] + '/s':<7}"
+              f"{result['relative']:>11.4g}x{result['peak_rss_kb'] / 1024:>9.1f} MB")
+    
+    if save_path:
+        with open(save_path, 'w', encoding='utf-8') as f:
+            json.dump(report, f, indent=2)
+            f.write('\n')
+        print(f"\nBaseline saved to {save_path}")
+    if not baseline_path:
+        return []
+    with open(baseline_path, 'r', encoding='utf-8') as f:
+        baseline = json.load(f)
+    if baseline.get('version') != BASELINE_VERSION or baseline.get('params') != params:
+        print(f"\nWarning: {baseline_path} was recorded with other parameters, not comparing")
+        return []
+    regressions = compare_to_baseline(report, baseline, tolerance)
+    if regressions:
+        print(f"\nRegressions against {baseline_path} (tolerance {tolerance:.0%}):")
+        for message in regressions:
+            print(f"  - {message}")
+    else:
+        print(f"\nNo regressions against {baseline_path} (tolerance {tolerance:.0%}).")
+    return regressions
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark penetrate_final.py on a synthetic repository.')
+    # No choices=: argparse rejects an empty list against them
+    parser.add_argument('benchmarks', nargs='*',
+                       help=f"Benchmarks to run: {', '.join(BENCHMARKS)} (default: walk and parse)")
+    parser.add_argument('--files', type=int,
+                       help=f'Number of files in the synthetic tree (default: {DEFAULT_WALK_FILES} '
+                            f'for walk, {DEFAULT_SUITE_FILES} for suite)')
+    parser.add_argument('--depth', type=int, default=6,
+                       help='Directory nesting depth of the synthetic tree (default: 6)')
+    parser.add_argument('--fanout', type=int, default=8,
+                       help='Most subdirectories per directory (default: 8)')
+    parser.add_argument('--mean-size', type=int, default=DEFAULT_MEAN_SIZE,
+                       help=f'Suite: mean file size in bytes (default: {DEFAULT_MEAN_SIZE})')
+    parser.add_argument('--binary-ratio', type=float, default=DEFAULT_BINARY_RATIO,
+                       help=f'Suite: share of binary files (default: {DEFAULT_BINARY_RATIO})')
+    parser.add_argument('--ignore-files', type=int, default=DEFAULT_IGNORE_FILES,
+                       help=f'Suite: number of nested .gitignore files (default: {DEFAULT_IGNORE_FILES})')
+    parser.add_argument('--repeat', type=int, default=3,
+                       help='Runs per benchmark, best time is reported (default: 3)')
+    parser.add_argument('--keep', type=str,
+                       help='Directory to create (or reuse) the synthetic tree in, kept afterwards')
+    parser.add_argument('--baseline', type=str,
+                       help='Suite: compare against this baseline JSON and exit 1 on regressions')
+    parser.add_argument('--save-baseline', type=str,
+                       help='Suite: save the results as a baseline JSON')
+    parser.add_argument('--tolerance', type=float, default=DEFAULT_TOLERANCE,
+                       help=f'Suite: allowed slowdown or memory growth as a fraction (default: {DEFAULT_TOLERANCE})')
+    parser.add_argument('--min-seconds', type=float, default=MIN_CASE_SECONDS,
+                       help=f'Suite: repeat fast cases until they have run this long (default: {MIN_CASE_SECONDS})')
+    # Internal: run one suite case in this process and print its result as JSON
+    parser.add_argument('--case', choices=SUITE_CASES, help=argparse.SUPPRESS)
+    parser.add_argument('--root', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.case:
+        print(json.dumps(run_case(args.case, args.root, args.repeat, args.min_seconds)))
+        return
+    benchmarks = args.benchmarks or ['walk', 'parse']
+    for name in benchmarks:
+        if name not in BENCHMARKS:
+            parser.error(f"unknown benchmark: {name} (choose from {', '.join(BENCHMARKS)})")
+
+    if 'parse' in benchmarks:
+        bench_parser(os.path.dirname(os.path.abspath(__file__)), args.repeat)
+
+    regressions = []
+    for name in ('walk', 'suite'):
+        if name not in benchmarks:
+            continue
+        suite = name == 'suite'
+        files = args.files or (DEFAULT_SUITE_FILES if suite else DEFAULT_WALK_FILES)
+        params = {'files': files, 'depth': args.depth, 'fanout': args.fanout}
+        if suite:
+            params.update(mean_size=args.mean_size, binary_ratio=args.binary_ratio,
+                          ignore_files=args.ignore_files)
+        root = args.keep or tempfile.mkdtemp(prefix='penetrate-bench-')
+        try:
+            os.makedirs(root, exist_ok=True)
+            if not os.listdir(root):
+                print(f"Generating {files} files in {root}...")
+                make_synthetic_repo(root, **params)
+            
+            if suite:
+                regressions = bench_suite(root, params, args.repeat, baseline_path=args.baseline,
+                                          save_path=args.save_baseline, tolerance=args.tolerance,
+                                          min_seconds=args.min_seconds)
+            else:
+                bench_walkers(root, args.repeat)
+        finally:
+            if not args.keep:
+                shutil.rmtree(root, ignore_errors=True)
+    
+    if regressions:
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,61 @@
+#!/usr/bin/env python3
+"""
+Thin client for the penetrate_final.py --serve daemon.
+
+Takes the same arguments as penetrate_final.py. A --scan or --input run is
+handed to the daemon serving the current directory, which answers from its
+in-memory file list and caches; anything else, or no daemon, runs
+penetrate_final.py in-process. Only the standard modules needed to talk to
+the socket are imported on the fast path.
+"""
+
+import os
+import sys
+import json
+import socket
+
+# Must match CACHE_DIR and DAEMON_SOCKET in penetrate_final.py
+DAEMON_SOCKET = os.path.join('.penetrate', 'daemon.sock')
+
+def forward(argv, root_dir, timeout=None):
+    """
+    Sends a run to the daemon serving root_dir. Returns (output, status), or
+    None if no daemon is listening or it can't serve this request.
+    """
+    client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        client.settimeout(timeout)
+        client.connect(os.path.join(root_dir, DAEMON_SOCKET))
+        client.sendall(json.dumps({'argv': list(argv), 'cwd': root_dir}).encode('utf-8') + b'\n')
+        data = b''
+        while not data.endswith(b'\n'):
+            chunk = client.recv(65536)
+            if not chunk:
+                break
+            data += chunk
+        reply = json.loads(data)
+    except (OSError, ValueError):
+        return None
+    finally:
+        client.close()
+    if reply.get('fallback'):
+        return None
+    return reply.get('output', ''), reply.get('status', 0)
+
+def main():
+    argv = sys.argv[1:]
+    root_dir = os.getcwd()
+    if (any(arg in ('--scan', '--input', '-i') or arg.startswith('--input=') for arg in argv)
+            and os.path.exists(os.path.join(root_dir, DAEMON_SOCKET))):
+        reply = forward(argv, root_dir)
+        if reply is not None:
+            output, status = reply
+            sys.stdout.write(output)
+            sys.exit(status)
+
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    import penetrate_final
+    penetrate_final.main(argv)
+
+if __name__ == "__main__":
+    main()
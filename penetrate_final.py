@@ -17,10 +17,25 @@ Usage:
 
 import os
 import re
-import pathspec
-from pathlib import Path
+import json
+import fnmatch
+import io
+import codecs
+import struct
+import hashlib
+import heapq
+import math
+import zlib
+import time
+import threading
+from collections import deque, Counter
+from itertools import chain
 import sys
-import argparse
+
+# Imported where they are used, so that --help, interactive mode and small
+# runs don't pay for them: pathspec (only when an ignore file exists),
+# argparse, concurrent.futures, sqlite3, tempfile, socket, signal, contextlib,
+# ast (only for --outline)
 
 # --- CONFIGURATION ---
 OUTPUT_FILE = "PROJECT_CODEBASE.md"
@@ -38,31 +53,366 @@ IGNORED_EXTENSIONS = {
 }
 
 # Directories to always ignore (in addition to .gitignore)
-IGNORED_DIRS = {'.git', '__pycache__', 'node_modules', 'venv', '.env', '.idea', '.vscode', '.vercel', '.trigger'}
+IGNORED_DIRS = {'.git', '__pycache__', 'node_modules', 'venv', '.env', '.idea', '.vscode', '.vercel', '.trigger', '.penetrate'}
+
+# Per-project cache directory (path index, manifests, ...)
+CACHE_DIR = '.penetrate'
+PATH_INDEX_FILE = 'path_index.json'
+PATH_INDEX_VERSION = 1
+MANIFEST_VERSION = 1
+SHARD_INDEX_VERSION = 1
+
+# Rendered-block cache shared by all outputs: a sqlite file under the cache
+# directory, trimmed to its size cap by evicting the least recently used blocks.
+# Freed pages are reused by later blocks; the file is only compacted once
+# they make up more than BLOCK_CACHE_VACUUM_SHARE of it
+BLOCK_CACHE_FILE = os.path.join('cache', 'blocks.sqlite')
+BLOCK_CACHE_VERSION = 2
+DEFAULT_BLOCK_CACHE_MB = 512
+BLOCK_CACHE_FLUSH_BYTES = 16 * 1024 * 1024
+BLOCK_CACHE_VACUUM_SHARE = 0.25
+
+# Reader threads and the cap on bytes read ahead of the writer
+DEFAULT_JOBS = 4
+DEFAULT_MAX_INFLIGHT_MB = 64
+
+# Files larger than this are streamed by the writer in CHUNK_SIZE pieces
+# instead of being read whole by the reader threads
+STREAM_THRESHOLD = 4 * 1024 * 1024
+CHUNK_SIZE = 1024 * 1024
+
+# Content-defined chunking for --chunk-dedup: a line is a cut point when the
+# rolling hash of the last three lines has the CHUNK_CUT_MASK bits clear, about
+# one line in 8, once a chunk has CHUNK_MIN_LINES; only chunks of at least
+# CHUNK_MIN_BYTES are worth replacing with a reference
+CHUNK_CUT_MASK = 0x7 << 16
+CHUNK_MIN_LINES = 3
+CHUNK_MAX_LINES = 48
+CHUNK_MIN_BYTES = 160
+CHUNK_HASH_BASE = 0x01000193
+CHUNK_HASH_BASE_SQUARED = CHUNK_HASH_BASE * CHUNK_HASH_BASE
+
+# Count-min sketch counting chunk repeats (4 MB), and the most chunks moved to the appendix
+CHUNK_SKETCH_DEPTH = 4
+CHUNK_SKETCH_WIDTH = 1 << 20
+CHUNK_APPENDIX_MAX = 10000
+
+# --outline: which files are reduced to signatures ('unlisted' keeps files
+# named in the input in full), the cache key prefix of extracted outlines in
+# the BlockCache (bump the version when extractors change), and the longest
+# statement kept whole in a Python outline, in lines
+OUTLINE_MODES = ('unlisted', 'all')
+OUTLINE_CACHE_PREFIX = '//outline/1/'
+OUTLINE_MAX_STATEMENT_LINES = 3
+
+# Tokens the brace scanner behind JS/TS and PHP outlines looks at: comments
+# and strings (so braces inside them are skipped), braces, parentheses and
+# statement ends; and the statements whose braced contents are kept (class,
+# interface, enum, namespace bodies and import/export lists) while other
+# bodies become "{ ... }"
+JS_OUTLINE_TOKEN_RE = re.compile(
+    r"""//[^\n]*|/\*.*?\*/|"(?:\\.|[^"\\\n])*"|'(?:\\.|[^'\\\n])*'|`(?:\\.|[^`\\])*`|[{}();]""", re.S)
+PHP_OUTLINE_TOKEN_RE = re.compile(
+    r"""(?://|#(?!\[))[^\n]*|/\*.*?\*/|"(?:\\.|[^"\\])*"|'(?:\\.|[^'\\])*'|[{}();]""", re.S)
+JS_OUTLINE_KEEP_RE = re.compile(
+    r'\b(?:class|interface|enum|namespace|module)\b[^=;]*$|\btype\s+\w+[^;]*=\s*$|'
+    r'(?:^|\n)\s*(?:import|export)\b[^=(]*$')
+PHP_OUTLINE_KEEP_RE = re.compile(r'\b(?:class|interface|trait|enum|namespace)\b[^;]*$', re.I)
+
+# What to do with files over --max-file-bytes
+OVERSIZE_POLICIES = ('skip', 'truncate', 'head-tail')
+
+# Bytes read from the start of a file to decide whether it is text
+SNIFF_BYTES = 8192
+
+# Magic numbers of binary formats that can hide behind unknown extensions.
+# Signatures made only of printable ASCII could start a text file too, so
+# they only count when the sample is not UTF-8 text anyway
+BINARY_MAGIC = (
+    (b'PK\x03\x04', 'zip'), (b'PK\x05\x06', 'zip'), (b'\x00asm', 'wasm'),
+    (b'wOF2', 'woff2'), (b'wOFF', 'woff'), (b'\x1f\x8b', 'gzip'),
+    *((b'BZh%d1AY&SY' % level, 'bzip2') for level in range(1, 10)),
+    (b'\xfd7zXZ\x00', 'xz'), (b'7z\xbc\xaf\x27\x1c', '7z'), (b'Rar!\x1a\x07', 'rar'),
+    (b'PACK\x00\x00\x00\x02', 'git pack'), (b'PACK\x00\x00\x00\x03', 'git pack'), (b'\x7fELF', 'ELF'),
+    (b'\xca\xfe\xba\xbe', 'Mach-O/class'), (b'\x89PNG', 'PNG'), (b'GIF87a', 'GIF'), (b'GIF89a', 'GIF'),
+    (b'\xff\xd8\xff', 'JPEG'), (b'%PDF-', 'PDF'), (b'SQLite format 3\x00', 'SQLite'),
+    (b'OggS\x00', 'Ogg'), (b'ID3\x02', 'MP3'), (b'ID3\x03', 'MP3'), (b'ID3\x04', 'MP3'),
+    (b'fLaC\x00', 'FLAC'), (b'fLaC\x80', 'FLAC'),
+)
+
+# Version of the sniff results kept in the path index; bump it when
+# sniff_binary changes its verdicts
+BINARY_CACHE_VERSION = 2
+
+# Where --scan gets its file list from
+FILE_SOURCES = ('walk', 'git-index')
+
+# Token estimation for --token-budget: bytes per token for the 'bytes'
+# estimator; the 'words' estimator counts each byte outside ASCII letters,
+# digits, '_' and whitespace as a token, each line break as a token, and each
+# word as one token per WORD_TOKEN_CHARS characters
+BYTES_PER_TOKEN = 4
+WORD_TOKEN_CHARS = 8
+WHITESPACE_BYTES = b' \t\n\r\x0b\x0c'
+PUNCTUATION_BYTES = bytes(c for c in range(256)
+                          if not (chr(c).isascii() and (chr(c).isalnum() or chr(c) == '_'))
+                          and c not in WHITESPACE_BYTES)
+PUNCTUATION_TO_SPACE = bytes.maketrans(PUNCTUATION_BYTES, b' ' * len(PUNCTUATION_BYTES))
+DEFAULT_TOKEN_ESTIMATOR = 'bytes'
+
+# Packing order for --token-budget by how a file was selected; others come last
+PACK_PRIORITY = {'listed': 0, 'directory': 1, 'imported': 2}
+
+# --follow-imports: the import specifiers found in each file, cached by
+# content hash; files larger than IMPORT_SCAN_MAX_BYTES (bundles, generated
+# code) are not scanned
+IMPORTS_CACHE_FILE = 'imports.json'
+IMPORTS_CACHE_VERSION = 1
+IMPORT_SCAN_MAX_BYTES = 1024 * 1024
+
+# Import statements by language. JS/TS: import/export ... from, bare import,
+# require() and dynamic import(); Python: import and from ... import (with
+# parenthesized name lists); PHP: require/include(_once) of a string literal,
+# optionally prefixed by __DIR__ or dirname(__FILE__)
+JS_IMPORT_RE = re.compile(
+    r"""(?:\bimport\s+(?:type\s+)?(?:[\w*{}\s,$]+?\s+from\s+)?|\bexport\s+(?:type\s+)?"""
+    r"""(?:\*(?:\s+as\s+\w+)?|\{[^}]*\})\s+from\s+|\b(?:require|import)\s*\(\s*)(['"])([^'"\n]+)\1""")
+PY_IMPORT_RE = re.compile(
+    r'^[ \t]*(?:from[ \t]+(\.*[\w.]*)[ \t]+import[ \t]+(\([^)]*\)|[\w., \t*]+)|import[ \t]+([\w., \t]+))',
+    re.MULTILINE)
+PHP_INCLUDE_RE = re.compile(
+    r"""\b(?:require|include)(?:_once)?\s*\(?\s*((?:__DIR__|dirname\s*\(\s*__FILE__\s*\))\s*\.\s*)?"""
+    r"""(['"])([^'"\n]+)\2""")
+
+# Extensions tried, in order, when resolving a JS/TS import, directly and
+# as a directory's index file; Python imports are also looked up under src/
+JS_IMPORT_EXTENSIONS = ('.ts', '.tsx', '.js', '.jsx', '.mjs', '.cjs', '.json')
+PY_SOURCE_ROOTS = ('', 'src')
+
+# --query: an inverted index of identifier parts, path tokens and comment
+# words in a sqlite file under the cache directory, one row per file with the
+# content hash it was indexed from; files over SEARCH_MAX_BYTES are indexed
+# by their path only, and postings are merged into the stored ones every
+# SEARCH_FLUSH_POSTINGS new (term, file) pairs; changed and deleted files
+# are purged from all postings once they make up SEARCH_COMPACT_SHARE of the
+# indexed files
+SEARCH_INDEX_FILE = os.path.join('cache', 'search.sqlite')
+SEARCH_INDEX_VERSION = 2
+SEARCH_MAX_BYTES = 1024 * 1024
+SEARCH_FLUSH_POSTINGS = 4 * 1024 * 1024
+SEARCH_COMPACT_SHARE = 0.25
+DEFAULT_QUERY_LIMIT = 20
+
+# Search terms: identifiers are split at underscores and camelCase humps
+# ("WordPressClient" is word, press and client), every two neighbouring parts
+# also make a term ("wordpress", "pressclient") and terms lose a plural or
+# -ing/-ed ending that leaves at least SEARCH_MIN_STEM letters; a file's path
+# parts count SEARCH_PATH_WEIGHT times
+SEARCH_IDENT_RE = re.compile(r'[A-Za-z][A-Za-z0-9_]*')
+SEARCH_PART_RE = re.compile(r'[A-Z]{2,}(?![a-z])|[A-Z]?[a-z]+')
+SEARCH_SUFFIXES = (('sses', 'ss'), ('ies', 'y'), ('ss', 'ss'), ('s', ''), ('ing', ''), ('ed', ''))
+SEARCH_MIN_STEM = 3
+SEARCH_MAX_TERM = 32
+SEARCH_PATH_WEIGHT = 3
+SEARCH_STOP_WORDS = frozenset((
+    'an', 'and', 'are', 'as', 'at', 'be', 'by', 'for', 'from', 'if', 'in', 'is', 'it', 'of', 'on',
+    'or', 'the', 'this', 'to', 'with', 'async', 'await', 'const', 'def', 'else', 'export', 'function',
+    'import', 'let', 'new', 'none', 'null', 'return', 'self', 'true', 'false', 'undefined', 'var',
+))
+
+# BM25 ranking: term frequency saturation and document length normalization
+SEARCH_BM25_K1 = 1.2
+SEARCH_BM25_B = 0.75
+
+# Room left on each directory line of the tree for --tree-stats
+TREE_STATS_ALLOWANCE = ' (00000 files, 1023.9 MB)'
+
+# tiktoken encoding, loaded on first use
+_TIKTOKEN_ENCODING = None
+
+# Directories skipped when indexing files for similar-name lookups
+INDEX_SKIP_DIRS = IGNORED_DIRS | {'.next'}
+
+# Longest trailing "dir/.../file" suffix kept in the path index
+PATH_SUFFIX_DEPTH = 4
+
+# Fuzzy path lookups compare names lowercased, without extension and with
+# every run of separators/punctuation dropped ("Content-Strategy_Dashboard"
+# and "contentStrategyDashboard" are the same key)
+FUZZY_KEY_STRIP_RE = re.compile(r'[\W_]+')
+
+# Lowest confidence a fuzzy (trigram) match needs to be reported, and the
+# share of its confidence that comes from matching directory names
+FUZZY_MIN_CONFIDENCE = 0.5
+FUZZY_DIR_WEIGHT = 0.2
+
+# Next.js App Router: the directories holding the app tree (first one found
+# wins), and the file names that make a directory a route handler or a page
+APP_ROUTER_DIRS = ('src/app', 'app')
+ROUTE_FILE_KINDS = {
+    'route.ts': 'route', 'route.js': 'route',
+    'page.tsx': 'page', 'page.jsx': 'page', 'page.ts': 'page', 'page.js': 'page',
+}
+
+# Path indexes built during this run, keyed by root directory
+_PATH_INDEXES = {}
+
+# Results kept in memory between --serve requests, keyed by root directory:
+# 'files' (scan_all_files) and 'matcher' (load_gitignore), plus a
+# 'generation' counter the watcher bumps whenever it drops them
+_HOT_STATE = {}
+
+# --serve: Unix socket under the cache directory, and how often the polling
+# watcher re-checks directory and ignore-file mtimes when inotify is missing
+DAEMON_SOCKET = 'daemon.sock'
+DAEMON_POLL_SECONDS = 1.0
+
+# inotify events that can change the file list or the ignore rules
+# (IN_MODIFY, IN_ATTRIB, IN_CLOSE_WRITE, IN_MOVED_FROM, IN_MOVED_TO,
+# IN_CREATE, IN_DELETE, IN_DELETE_SELF, IN_MOVE_SELF)
+INOTIFY_MASK = 0x002 | 0x004 | 0x008 | 0x040 | 0x080 | 0x100 | 0x200 | 0x400 | 0x800
+IN_ISDIR = 0x40000000
+IN_Q_OVERFLOW = 0x4000
+
+# --profile: the StageProfiler of the current run (None when not profiling),
+# and where Linux keeps the process's read/write syscall counters
+_PROFILER = None
+PROC_IO_PATH = '/proc/self/io'
+
+# Order of the --profile report; 'resolve' (find_file_similar) is part of
+# 'expand', 'search' includes listing the files it indexes, and 'read',
+# 'render' and 'write' share write_codebase's loop
+PROFILE_STAGES = ('enumerate', 'search', 'parse', 'expand', 'resolve', 'imports', 'pack', 'chunks',
+                  'tree', 'read', 'render', 'write', 'manifest')
+
+def compile_ignore_file(path):
+    """
+    Compiles one ignore file (.gitignore, .git/info/exclude) into a PathSpec.
+    Returns None if the file is missing or has no patterns.
+    """
+    try:
+        with open(path, 'r', encoding='utf-8', errors='replace') as f:
+            lines = f.read().splitlines()
+    except OSError:
+        return None
+    if not any(line.strip() and not line.startswith('#') for line in lines):
+        return None
+    import pathspec
+    # GitIgnoreSpec follows git's rules for negations more closely (pathspec >= 0.10)
+    if hasattr(pathspec, 'GitIgnoreSpec'):
+        return pathspec.GitIgnoreSpec.from_lines(lines)
+    return pathspec.PathSpec.from_lines('gitwildmatch', lines)
+
+class GitIgnoreMatcher:
+    """
+    Hierarchical .gitignore matcher. Each directory gets a cached chain of
+    compiled specs ((base_dir, spec) pairs, outermost first): the root's
+    .git/info/exclude and .gitignore, then every nested .gitignore on the way
+    down. Like git, a deeper or later pattern overrides an earlier one, and
+    nothing inside an ignored directory can be re-included.
+    """
+    def __init__(self, root_dir):
+        self.root_dir = root_dir
+        self._chains = {}
+        self._ignored_dirs = {}
+
+    def chain(self, rel_dir, has_gitignore=None):
+        """
+        Returns the spec chain that applies to entries of rel_dir ('/'-separated,
+        '' for the root). has_gitignore can be passed by a walker that already
+        listed the directory, to save a stat.
+        """
+        chain = self._chains.get(rel_dir)
+        if chain is not None:
+            return chain
+        
+        if rel_dir:
+            chain = self.chain(rel_dir.rpartition('/')[0])
+            base = rel_dir + '/'
+        else:
+            chain = []
+            base = ''
+            spec = compile_ignore_file(os.path.join(self.root_dir, '.git', 'info', 'exclude'))
+            if spec:
+                chain = [('', spec)]
+        
+        if has_gitignore is not False:
+            spec = compile_ignore_file(os.path.join(self.root_dir, rel_dir, '.gitignore'))
+            if spec:
+                chain = chain + [(base, spec)]
+        
+        self._chains[rel_dir] = chain
+        return chain
+
+    def _check(self, rel_path, chain):
+        ignored = False
+        for base, spec in chain:
+            sub_path = rel_path[len(base):]
+            if hasattr(spec, 'check_file'):
+                include = spec.check_file(sub_path).include
+                if include is not None:
+                    ignored = include
+            elif spec.match_file(sub_path):
+                ignored = True
+        return ignored
+
+    def is_dir_ignored(self, rel_dir):
+        """
+        Checks whether a directory ('/'-separated) or any of its parents is ignored.
+        """
+        ignored = self._ignored_dirs.get(rel_dir)
+        if ignored is None:
+            parent = rel_dir.rpartition('/')[0]
+            ignored = bool(parent) and self.is_dir_ignored(parent)
+            if not ignored:
+                ignored = self._check(rel_dir + '/', self.chain(parent))
+            self._ignored_dirs[rel_dir] = ignored
+        return ignored
+
+    def match_in_dir(self, rel_path, rel_dir):
+        """
+        Checks a '/'-separated path against the rules of its directory only,
+        for walkers that never descend into ignored directories.
+        """
+        return self._check(rel_path, self.chain(rel_dir))
+
+    def match_file(self, rel_path):
+        """
+        Checks whether a file is ignored (same interface as PathSpec.match_file).
+        """
+        rel_path = rel_path.replace(os.sep, '/')
+        rel_dir = rel_path.rpartition('/')[0]
+        if rel_dir and self.is_dir_ignored(rel_dir):
+            return True
+        return self._check(rel_path, self.chain(rel_dir))
 
 def load_gitignore(root_dir):
     """
-    Loads .gitignore patterns from the root directory.
+    Loads the ignore rules for a project: .git/info/exclude and every
+    .gitignore in the tree, compiled lazily per directory. Under --serve the
+    matcher is kept until an ignore file changes.
     """
-    gitignore_path = os.path.join(root_dir, '.gitignore')
-    if os.path.exists(gitignore_path):
-        with open(gitignore_path, 'r') as f:
-            return pathspec.PathSpec.from_lines('gitwildmatch', f)
-    return None
+    hot = _HOT_STATE.get(root_dir)
+    if hot is not None and 'matcher' in hot:
+        return hot['matcher']
+    matcher = GitIgnoreMatcher(root_dir)
+    if hot is not None:
+        hot['matcher'] = matcher
+    return matcher
 
 def is_ignored(rel_path, spec):
     """
     Checks if a file matches .gitignore rules or our custom exclusion lists.
     """
-    path_obj = Path(rel_path)
+    parts = rel_path.replace(os.sep, '/').split('/')
     
     # 1. Check strict directory excludes
-    for part in path_obj.parts:
+    for part in parts:
         if part in IGNORED_DIRS:
             return True
 
     # 2. Check extension blacklist
-    if path_obj.suffix.lower() in IGNORED_EXTENSIONS:
+    if os.path.splitext(parts[-1])[1].lower() in IGNORED_EXTENSIONS:
         return True
 
     # 3. Check .gitignore (if it exists)
@@ -71,6 +421,105 @@ def is_ignored(rel_path, spec):
 
     return False
 
+# Precompiled patterns for parse_file_paths_from_text
+BACKTICK_PATH_RE = re.compile(r'`([^`\n]+)`')
+BULLET_FILE_RE = re.compile(r'^[\s\-\*\•]*\**([^:\n]*\.(ts|tsx|js|jsx|py|html|css|json|rs|java|c|cpp|sh|bat|php))\**', re.IGNORECASE)
+BULLET_DIR_RE = re.compile(r'^[\s\-\*\•]*\**([^:\n]*/[^:\n]*?)\**(\s|$)')
+TRAILING_PUNCTUATION_RE = re.compile(r'[\*\_\-\—\–]+$')
+FILE_COUNT_RE = re.compile(r'\s+\d+\s*files?$', re.IGNORECASE)
+DESCRIPTION_WORD_RE = re.compile(r'\s(Main|Purpose|Features|Key|Component|Page|Dashboard|View|Panel|Engine)$')
+API_ROUTE_RE = re.compile(r'(/api/[\w\-/]+/route\.(ts|js))')
+API_DIR_RE = re.compile(r'(/api/[\w\-/]+)(?=\s|$|\))')
+TRIGGER_TASK_RE = re.compile(r'(trigger/[\w\-/]+\.ts)')
+CODE_BLOCK_RE = re.compile(r'```(?:text)?\s*\n([\s\S]*?)\n```')
+TREE_LINE_RE = re.compile(r'^[│\s├└]*[\s─┬]*([\w/\\\-]+\.(ts|tsx|js|jsx|py|html|css|json))$')
+MARKDOWN_ARTIFACTS_RE = re.compile(r'[\*\_\`\[\]]+')
+TRAILING_DESCRIPTION_RE = re.compile(r'\s+\-\s+.*$')
+
+# Candidates starting with these are headings or list decorations, not paths
+NON_PATH_PREFIXES = ('#', 'Summary', 'Components', '📄', '🎨', '🛠', '⚙', '📊',
+                     '1.', '→', '├──', '└──')
+
+def iter_path_candidates(text):
+    """
+    Scans text once, line by line, and yields (candidate, start, end) for each
+    raw path candidate with the span it came from in text. Handles:
+    - Backtick paths: `src/app/page.tsx`
+    - Bullet point lists with file extensions, and directory paths
+    - API endpoints: /api/content/analyze/route.ts
+    - Trigger.dev task paths: trigger/content/analyzer.ts
+    - Tree-style listings inside ``` code blocks
+    Every pattern needs a path separator, so lines without one are skipped
+    before any regex runs.
+    """
+    line_start = 0
+    for line in text.split('\n'):
+        offset = line_start
+        line_start += len(line) + 1
+        has_slash = '/' in line
+        if not has_slash and '\\' not in line:
+            continue
+        
+        # Pattern 1: Backtick enclosed paths (most reliable)
+        if '`' in line:
+            for match in BACKTICK_PATH_RE.finditer(line):
+                value = match.group(1)
+                if '/' in value or '\\' in value:
+                    yield value.strip(), offset + match.start(1), offset + match.end(1)
+        if not has_slash:
+            continue
+        
+        # Pattern 2: File and directory paths in list items
+        stripped = line.strip()
+        if not stripped.startswith(('#', '=')):
+            lead = offset + len(line) - len(line.lstrip())
+            
+            bullet_match = BULLET_FILE_RE.match(stripped)
+            if bullet_match:
+                # Clean up any trailing punctuation
+                file_path = TRAILING_PUNCTUATION_RE.sub('', bullet_match.group(1).strip())
+                if len(file_path) > 5 and '/' in file_path:  # Basic validation
+                    yield file_path, lead + bullet_match.start(1), lead + bullet_match.end(1)
+            
+            dir_match = BULLET_DIR_RE.match(stripped)
+            if dir_match:
+                dir_path = TRAILING_PUNCTUATION_RE.sub('', dir_match.group(1).strip())
+                dir_path = FILE_COUNT_RE.sub('', dir_path)
+                # Skip if it's an API endpoint without .ts or looks like a description
+                if (len(dir_path) > 3 and 
+                    '/' in dir_path and 
+                    not dir_path.startswith('http') and 
+                    '://' not in dir_path and
+                    not dir_path.endswith('-') and
+                    not DESCRIPTION_WORD_RE.search(dir_path)):
+                    yield dir_path.rstrip('/'), lead + dir_match.start(1), lead + dir_match.end(1)
+        
+        # Pattern 3: API endpoints and API directories
+        if '/api/' in line:
+            for match in API_ROUTE_RE.finditer(line):
+                yield match.group(1), offset + match.start(1), offset + match.end(1)
+            for match in API_DIR_RE.finditer(line):
+                value = match.group(1)
+                # Only add if it doesn't end with a word that suggests it's a description
+                if not value.endswith(('-', ' ', '–', '—')) and not value.endswith('/route'):
+                    yield value.strip(), offset + match.start(1), offset + match.end(1)
+        
+        # Pattern 4: Trigger.dev task paths
+        if 'trigger/' in line:
+            for match in TRIGGER_TASK_RE.finditer(line):
+                yield match.group(1).strip(), offset + match.start(1), offset + match.end(1)
+    
+    # Pattern 5: Extract paths from tree-like structures in code blocks
+    if '```' in text:
+        for block in CODE_BLOCK_RE.finditer(text):
+            offset = block.start(1)
+            for line in block.group(1).split('\n'):
+                match = TREE_LINE_RE.match(line.strip())
+                if match:
+                    start = offset + line.index(match.group(1))
+                    yield match.group(1), start, start + len(match.group(1))
+                offset += len(line) + 1
+
 def parse_file_paths_from_text(text):
     """
     Parses file and directory paths from user input text.
@@ -80,89 +529,12 @@ def parse_file_paths_from_text(text):
     - Directory paths: src/components/content/
     - Regular paths in text
     """
-    paths = set()
-    
-    # Pattern 1: Backtick enclosed paths (most reliable)
-    backtick_pattern = r'`([^`\n]+)`'
-    backtick_matches = re.findall(backtick_pattern, text)
-    for match in backtick_matches:
-        if '/' in match or '\\' in match:
-            paths.add(match.strip())
-    
-    # Pattern 2: File paths with extensions in list items
-    # Look for lines that start with bullet points or have file patterns
-    lines = text.split('\n')
-    for line in lines:
-        line = line.strip()
-        
-        # Skip if it's a header or description
-        if line.startswith('#') or line.startswith('=') or not line:
-            continue
-        
-        # Extract file paths from bullet points
-        bullet_match = re.match(r'^[\s\-\*\•]*\**([^:\n]*\.(ts|tsx|js|jsx|py|html|css|json|rs|java|c|cpp|sh|bat|php))\**', line, re.IGNORECASE)
-        if bullet_match:
-            file_path = bullet_match.group(1).strip()
-            # Clean up any trailing punctuation
-            file_path = re.sub(r'[\*\_\-\—\–]+$', '', file_path)
-            if len(file_path) > 5 and '/' in file_path:  # Basic validation
-                paths.add(file_path)
-        
-        # Extract directory paths
-        dir_match = re.match(r'^[\s\-\*\•]*\**([^:\n]*/[^:\n]*?)\**(\s|$)', line)
-        if dir_match:
-            dir_path = dir_match.group(1).strip()
-            # Clean up
-            dir_path = re.sub(r'[\*\_\-\—\–]+$', '', dir_path)
-            dir_path = re.sub(r'\s+\d+\s*files?$', '', dir_path, flags=re.IGNORECASE)
-            # Skip if it's an API endpoint without .ts or looks like a description
-            if (len(dir_path) > 3 and 
-                '/' in dir_path and 
-                not dir_path.startswith('http') and 
-                not '://' in dir_path and
-                not dir_path.endswith('-') and
-                not re.match(r'.*\s+(Main|Purpose|Features|Key|Component|Page|Dashboard|View|Panel|Engine)$', dir_path)):
-                paths.add(dir_path.rstrip('/'))
-    
-    # Pattern 3: API endpoints - improved extraction
-    # Look for patterns like /api/content/analyze/route.ts
-    api_route_pattern = r'(/api/[\w\-/]+/route\.(ts|js))'
-    api_route_matches = re.findall(api_route_pattern, text)
-    for match in api_route_matches:
-        paths.add(match[0])
-    
-    # Also capture API directory paths
-    api_dir_pattern = r'(/api/[\w\-/]+)(?=\s|$|\))'
-    api_matches = re.findall(api_dir_pattern, text)
-    for match in api_matches:
-        # Only add if it doesn't end with a word that suggests it's a description
-        if not match.endswith(('-', ' ', '–', '—')) and not match.endswith('/route'):
-            paths.add(match.strip())
-    
-    # Pattern 4: Trigger.dev task paths
-    trigger_pattern = r'(trigger/[\w\-/]+\.ts)'
-    trigger_matches = re.findall(trigger_pattern, text)
-    for match in trigger_matches:
-        paths.add(match.strip())
-    
-    # Pattern 5: Extract paths from code blocks
-    code_block_pattern = r'```(?:text)?\s*\n([\s\S]*?)\n```'
-    code_blocks = re.findall(code_block_pattern, text)
-    for block in code_blocks:
-        # Extract paths from tree-like structures
-        for line in block.split('\n'):
-            line = line.strip()
-            # Match indented file paths
-            match = re.match(r'^[│\s├└]*[\s─┬]*([\w/\\\-]+\.(ts|tsx|js|jsx|py|html|css|json))$', line)
-            if match:
-                paths.add(match.group(1))
-    
-    # Clean up paths
     cleaned_paths = set()
-    for path in paths:
+    
+    for path, _, _ in iter_path_candidates(text):
         # Remove common markdown artifacts and descriptions
-        path = re.sub(r'[\*\_\`\[\]]+', '', path)
-        path = re.sub(r'\s+\-\s+.*$', '', path)  # Remove descriptions after dash
+        path = MARKDOWN_ARTIFACTS_RE.sub('', path)
+        path = TRAILING_DESCRIPTION_RE.sub('', path)  # Remove descriptions after dash
         path = path.strip()
         
         # Normalize path separators
@@ -171,67 +543,475 @@ def parse_file_paths_from_text(text):
         # Skip if too short or clearly not a path
         if (len(path) > 2 and 
             ('/' in path or '.' in path) and
-            not path.startswith('#') and
-            not path.startswith('Summary') and
-            not path.startswith('Components') and
-            not path.startswith('📄') and
-            not path.startswith('🎨') and
-            not path.startswith('🛠') and
-            not path.startswith('⚙') and
-            not path.startswith('📊') and
-            not path.startswith('1.') and
-            not path.startswith('→') and
-            not path.startswith('├──') and
-            not path.startswith('└──') and
-            not 'Monthly/Weekly/Daily' in path and
-            not 'appears to be a backup' in path):
+            not path.startswith(NON_PATH_PREFIXES) and
+            'Monthly/Weekly/Daily' not in path and
+            'appears to be a backup' not in path):
             cleaned_paths.add(path)
     
     return list(cleaned_paths)
 
-def find_file_similar(path, root_dir):
+def build_path_index(root_dir):
+    """
+    Walks the project once and records every file plus the mtime of every
+    directory visited. Paths always use '/' separators.
+    """
+    files = []
+    dirs = {}
+    stack = ['']
+    
+    while stack:
+        rel_dir = stack.pop()
+        abs_dir = os.path.join(root_dir, rel_dir) if rel_dir else root_dir
+        try:
+            # Stat before listing so a change during the scan invalidates the index
+            dirs[rel_dir] = os.stat(abs_dir).st_mtime_ns
+            with os.scandir(abs_dir) as entries:
+                for entry in entries:
+                    rel_path = f"{rel_dir}/{entry.name}" if rel_dir else entry.name
+                    if entry.is_dir():
+                        # Like os.walk, list symlinked directories but don't follow them
+                        if entry.name not in INDEX_SKIP_DIRS and not entry.is_symlink():
+                            stack.append(rel_path)
+                    else:
+                        files.append(rel_path)
+        except OSError:
+            continue
+    
+    files.sort()
+    return {'version': PATH_INDEX_VERSION, 'dirs': dirs, 'files': files}
+
+def is_path_index_fresh(index, root_dir):
+    """
+    Checks that no indexed directory changed since the index was built.
+    Adding, removing or renaming an entry bumps the parent directory's mtime.
+    """
+    if not index or index.get('version') != PATH_INDEX_VERSION or 'files' not in index:
+        return False
+    
+    for rel_dir, mtime_ns in index['dirs'].items():
+        abs_dir = os.path.join(root_dir, rel_dir) if rel_dir else root_dir
+        try:
+            if os.stat(abs_dir).st_mtime_ns != mtime_ns:
+                return False
+        except OSError:
+            return False
+    return True
+
+def load_path_index(root_dir):
+    """
+    Loads the saved path index from the cache directory, if any.
+    """
+    index_path = os.path.join(root_dir, CACHE_DIR, PATH_INDEX_FILE)
+    try:
+        with open(index_path, 'r', encoding='utf-8') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+def save_path_index(index, root_dir):
+    """
+    Saves the path index to the cache directory (atomically).
+    """
+    cache_dir = os.path.join(root_dir, CACHE_DIR)
+    index_path = os.path.join(cache_dir, PATH_INDEX_FILE)
+    data = {key: index[key] for key in ('version', 'dirs', 'files', 'binary', 'binary_version')
+            if key in index}
+    try:
+        if not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir)
+            # Creating the cache directory itself bumps the root's mtime
+            if 'dirs' in index:
+                index['dirs'][''] = os.stat(root_dir).st_mtime_ns
+        tmp_path = index_path + '.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(data, f, separators=(',', ':'))
+        os.replace(tmp_path, index_path)
+    except OSError as e:
+        print(f"Warning: Could not save path index: {e}")
+
+def add_path_lookups(index):
+    """
+    Adds the lookup tables used by find_file_similar to a path index:
+    file/dir sets, basename -> paths, stem -> paths and
+    trailing "dir/file" suffix -> paths.
+    """
+    by_name = {}
+    by_stem = {}
+    by_suffix = {}
+    
+    for rel_path in index['files']:
+        parts = rel_path.split('/')
+        filename = parts[-1]
+        by_name.setdefault(filename, []).append(rel_path)
+        by_stem.setdefault(os.path.splitext(filename)[0], []).append(rel_path)
+        for i in range(max(1, len(parts) - PATH_SUFFIX_DEPTH), len(parts) - 1):
+            by_suffix.setdefault('/'.join(parts[i:]), []).append(rel_path)
+    
+    index['file_set'] = set(index['files'])
+    index['dir_set'] = set(index['dirs'])
+    index['by_name'] = by_name
+    index['by_stem'] = by_stem
+    index['by_suffix'] = by_suffix
+    return index
+
+def get_path_index(root_dir, use_cache=True):
+    """
+    Returns the path index for root_dir. It is built at most once per run and,
+    when use_cache is set, reused from (and saved to) the cache directory
+    until a directory mtime changes.
+    """
+    index = _PATH_INDEXES.get(root_dir)
+    if index is not None:
+        return index
+    
+    saved = load_path_index(root_dir) if use_cache else None
+    index = saved
+    if not is_path_index_fresh(index, root_dir):
+        index = build_path_index(root_dir)
+        # Sniff results are validated per file, so they survive a rebuild
+        if (saved or {}).get('binary_version') == BINARY_CACHE_VERSION:
+            index['binary'] = saved.get('binary', {})
+            index['binary_version'] = BINARY_CACHE_VERSION
+        if use_cache:
+            save_path_index(index, root_dir)
+    
+    index = add_path_lookups(index)
+    _PATH_INDEXES[root_dir] = index
+    return index
+
+def fuzzy_key(name):
+    """
+    Normalizes a file or directory name for fuzzy lookups: lowercase, no
+    extension, no separators or punctuation.
+    """
+    return FUZZY_KEY_STRIP_RE.sub('', os.path.splitext(name)[0].lower())
+
+def key_trigrams(key):
+    """
+    Returns the set of trigrams of a fuzzy key, padded so that short keys and
+    the start/end of a name still count.
+    """
+    padded = f"^{key}$"
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+def add_fuzzy_lookups(index):
+    """
+    Adds the trigram index used for fuzzy lookups to a path index. Files are
+    grouped by the fuzzy key of their name, so a trigram's posting list holds
+    key ids rather than one entry per file (a hundred index.ts files share one).
+    """
+    key_ids = {}
+    key_paths = []
+    key_sizes = []
+    trigrams = {}
+    
+    for rel_path in index['files']:
+        key = fuzzy_key(rel_path.rsplit('/', 1)[-1])
+        key_id = key_ids.get(key)
+        if key_id is None:
+            key_id = key_ids[key] = len(key_paths)
+            grams = key_trigrams(key)
+            key_paths.append([])
+            key_sizes.append(len(grams))
+            for gram in grams:
+                trigrams.setdefault(gram, []).append(key_id)
+        key_paths[key_id].append(rel_path)
+    
+    index['fuzzy_paths'] = key_paths
+    index['fuzzy_sizes'] = key_sizes
+    index['fuzzy_trigrams'] = trigrams
+    # Normalized directory paths, filled in as fuzzy matches are scored
+    index['fuzzy_dirs'] = {}
+    return index
+
+def get_posting_set(index, gram):
+    """
+    Returns a trigram's posting list as a set, converted once per index.
+    """
+    posting_sets = index.setdefault('fuzzy_sets', {})
+    posting = posting_sets.get(gram)
+    if posting is None:
+        posting = posting_sets[gram] = set(index['fuzzy_trigrams'].get(gram, ()))
+    return posting
+
+def find_fuzzy_matches(path, index, limit=3):
+    """
+    Ranks indexed files by the trigram similarity (Dice coefficient) of their
+    name to the last component of path, ignoring case, separators and
+    extension; directory names found along the file's path add to the score.
+    Returns up to limit (rel_path, confidence) pairs, best first, with
+    confidence in 0..1.
+    """
+    if 'fuzzy_trigrams' not in index:
+        add_fuzzy_lookups(index)
+    
+    parts = path.strip('/').split('/')
+    key = fuzzy_key(parts[-1])
+    if not key:
+        return []
+    postings = index['fuzzy_trigrams']
+    sizes = index['fuzzy_sizes']
+    grams = key_trigrams(key)
+    # Directories can only scale a score down, to between (1 - FUZZY_DIR_WEIGHT)
+    # and 1 times itself, so a name must score FUZZY_MIN_CONFIDENCE on its own
+    min_score = FUZZY_MIN_CONFIDENCE
+    
+    # A key scoring min_score shares at least min_overlap trigrams with the
+    # name. Counting (in C) only the posting lists of its rarest trigrams, a
+    # key must be in two of them to still reach min_overlap; the few that
+    # are get their frequent trigrams added by set intersections.
+    min_overlap = math.ceil(min_score * (len(grams) + 1) / 2)
+    grams = sorted(grams, key=lambda gram: len(postings.get(gram, ())))
+    split = len(grams) - max(0, min_overlap - 2)
+    hits = Counter(chain.from_iterable(postings.get(gram, ()) for gram in grams[:split]))
+    need = min_overlap - (len(grams) - split)
+    keys = {key_id for key_id, count in hits.items() if count >= need}
+    hits.update(chain.from_iterable(keys.intersection(get_posting_set(index, gram))
+                                    for gram in grams[split:]))
+    
+    candidates = []
+    for key_id in keys:
+        score = 2 * hits[key_id] / (len(grams) + sizes[key_id])
+        if score >= min_score:
+            candidates.append((score, key_id))
+    candidates.sort(reverse=True)
+    
+    dir_keys = [fuzzy_key(part) for part in parts[:-1]]
+    dir_keys = [dir_key for dir_key in dir_keys if dir_key]
+    ext = os.path.splitext(parts[-1])[1]
+    fuzzy_dirs = index['fuzzy_dirs']
+    best = []
+    for score, key_id in candidates:
+        # Directories can only lower a score, so stop once nothing can beat
+        # the matches already found
+        if len(best) >= limit and score < best[0][0]:
+            break
+        for rel_path in index['fuzzy_paths'][key_id]:
+            rel_dir = rel_path.rpartition('/')[0]
+            dir_score = 1.0
+            if dir_keys:
+                dir_path = fuzzy_dirs.get(rel_dir)
+                if dir_path is None:
+                    dir_path = fuzzy_dirs[rel_dir] = FUZZY_KEY_STRIP_RE.sub('', rel_dir.lower())
+                dir_score = sum(dir_key in dir_path for dir_key in dir_keys) / len(dir_keys)
+            confidence = score * (1 - FUZZY_DIR_WEIGHT + FUZZY_DIR_WEIGHT * dir_score)
+            if confidence < FUZZY_MIN_CONFIDENCE:
+                continue
+            # Ties go to the same extension, then the shallower path
+            entry = (confidence, rel_path.endswith(ext), -rel_dir.count('/'), rel_path)
+            if len(best) < limit:
+                heapq.heappush(best, entry)
+            else:
+                heapq.heappushpop(best, entry)
+    return [(entry[3], entry[0]) for entry in sorted(best, reverse=True)]
+
+def new_route_node():
+    """
+    Returns an empty route trie node: static children by segment name,
+    [param] children, [...param] and [[...param]] children, and the route
+    files ({'route': rel_path, 'page': rel_path}) of the URL ending here.
+    """
+    return {'static': {}, 'dynamic': [], 'catch_all': [], 'optional': [], 'files': {}}
+
+def add_route_lookups(index):
+    """
+    Adds the Next.js route trie to a path index: every route.ts/page.tsx
+    under the app directory, keyed by its URL pattern. Route groups
+    ("(marketing)") and parallel route slots ("@modal") don't appear in
+    URLs and are skipped; private ("_lib") and intercepting ("(..)photo")
+    folders are not routes. Dynamic segments are also reachable by their
+    folder name, so "[domain]/settings" finds the page literally.
+    """
+    dir_set = index['dir_set']
+    app_dir = next((d for d in APP_ROUTER_DIRS if d in dir_set), None)
+    root = new_route_node()
+    index['routes'] = root
+    if app_dir is None:
+        return index
+    
+    prefix = app_dir + '/'
+    for rel_path in index['files']:
+        if not rel_path.startswith(prefix):
+            continue
+        *segments, filename = rel_path[len(prefix):].split('/')
+        kind = ROUTE_FILE_KINDS.get(filename)
+        if kind is None:
+            continue
+        
+        node = root
+        for segment in segments:
+            if (segment.startswith('(') and segment.endswith(')')) or segment.startswith('@'):
+                continue
+            if segment.startswith(('_', '(')):
+                node = None
+                break
+            child = node['static'].get(segment)
+            if child is None:
+                child = node['static'][segment] = new_route_node()
+                if segment.startswith('[[...'):
+                    node['optional'].append(child)
+                elif segment.startswith('[...'):
+                    node['catch_all'].append(child)
+                elif segment.startswith('['):
+                    node['dynamic'].append(child)
+            node = child
+        if node is not None:
+            node['files'].setdefault(kind, rel_path)
+    return index
+
+def route_file(node, kinds):
+    """
+    Returns the first of kinds ('route'/'page') that node has a file for.
+    """
+    for kind in kinds:
+        if kind in node['files']:
+            return node['files'][kind]
+    return None
+
+def match_route(node, segments, kinds, static=0):
+    """
+    Walks the route trie along the URL segments, trying static children
+    before dynamic ones and backtracking only when a branch dead-ends.
+    Returns (rel_path, static segments matched) or None.
+    """
+    if not segments:
+        found = route_file(node, kinds)
+        if found is not None:
+            return found, static
+        for child in node['optional']:
+            found = route_file(child, kinds)
+            if found is not None:
+                return found, static
+        return None
+    
+    child = node['static'].get(segments[0])
+    if child is not None:
+        found = match_route(child, segments[1:], kinds, static + 1)
+        if found is not None:
+            return found
+    for child in node['dynamic']:
+        found = match_route(child, segments[1:], kinds, static)
+        if found is not None:
+            return found
+    for child in node['catch_all'] + node['optional']:
+        found = route_file(child, kinds)
+        if found is not None:
+            return found, static
+    return None
+
+def find_route_matches(path, index):
+    """
+    Resolves a URL-like path ("/api/content/analyze", "blog/[slug]/page.tsx",
+    "app/(shop)/cart") to the route.ts or page.tsx serving it. Returns a
+    [(rel_path, confidence)] list with at most one match; the confidence is
+    lower the more segments only matched a dynamic one. Paths naming any
+    other file, and matches without a single static segment, are rejected.
+    """
+    if 'routes' not in index:
+        add_route_lookups(index)
+    
+    segments = [segment for segment in path.strip('/').split('/') if segment]
+    kinds = ('route', 'page') if segments[:1] == ['api'] else ('page', 'route')
+    if segments and segments[-1] in ROUTE_FILE_KINDS:
+        kinds = (ROUTE_FILE_KINDS[segments.pop()],)
+    elif segments and '.' in segments[-1]:
+        return []
+    for app_dir in APP_ROUTER_DIRS:
+        app_parts = app_dir.split('/')
+        if segments[:len(app_parts)] == app_parts:
+            segments = segments[len(app_parts):]
+            break
+    segments = [segment for segment in segments
+                if not (segment.startswith('(') and segment.endswith(')')) and not segment.startswith('@')]
+    if not segments:
+        return []
+    
+    found = match_route(index['routes'], segments, kinds)
+    if found is None or found[1] == 0:
+        return []
+    rel_path, static = found
+    return [(rel_path, 0.5 + 0.5 * static / len(segments))]
+
+def find_file_similar(path, root_dir, index=None):
     """
     Searches for files with similar names when exact path is not found.
     Returns list of found file paths.
     """
+    return [rel_path for rel_path, _ in find_file_matches(path, root_dir, index)]
+
+def find_file_matches(path, root_dir, index=None):
+    """
+    find_file_similar with a confidence (0..1) for each match: returns a list
+    of (rel_path, confidence). Exact name matches score by how much of the
+    path they match; when there are none, names are looked up fuzzily.
+    """
+    if index is None:
+        index = get_path_index(root_dir)
+    full_url = '://' in path
+    if full_url:
+        # Only the path of a full URL names something in the project
+        path = path.split('://', 1)[1].partition('/')[2]
+        path = path.partition('?')[0].partition('#')[0]
+    path = path.rstrip('/')
+    if not path.strip('/'):
+        return []
+    
+    # URLs and route/page paths resolve through the app's route table, but a
+    # route reached through dynamic segments ("[domain]/settings" for
+    # "lib/settings") only wins when no file matches the path better; ties
+    # go to the route for URL-shaped paths ("acme.com/settings", "api/...")
+    route_matches = find_route_matches(path, index)
+    if route_matches and route_matches[0][1] >= 1.0:
+        return route_matches
+    file_matches = find_path_matches(path, index)
+    if route_matches:
+        first, _, rest = path.partition('/')
+        url_shaped = full_url or first == 'api' or ('.' in first and rest != '')
+        best_file = max((c for _, c in file_matches), default=0)
+        if route_matches[0][1] > best_file or (url_shaped and route_matches[0][1] == best_file):
+            return route_matches
+    return file_matches
+
+def find_path_matches(path, index):
+    """
+    The file lookups behind find_file_matches, for a path without trailing
+    slash: API route and content-strategy fallbacks, exact, suffix and name
+    matches, then fuzzy matches. Returns a list of (rel_path, confidence).
+    """
+    file_set = index['file_set']
     found_files = []
+    confidence = {}
     filename = os.path.basename(path)
     
-    # Special handling for API routes
+    # API routes that don't match a route exactly
     if path.startswith('api/content/'):
-        # Remove the api/ prefix and add route.ts if needed
-        api_path = path
-        if not api_path.endswith('route.ts'):
-            api_path = f"{api_path}/route.ts"
-        
-        # Convert to actual file path
-        expected_path = f"src/app/{api_path}"
-        full_path = os.path.join(root_dir, expected_path.replace('/', os.sep))
-        if os.path.exists(full_path):
-            found_files.append(expected_path)
-        else:
-            # Try to find the closest match
-            api_name = path.replace('api/content/', '').replace('/route', '')
-            search_pattern = f"src/app/api/**/*{api_name}*/route.ts"
-            import glob
-            matches = glob.glob(os.path.join(root_dir, search_pattern.replace('/', os.sep)), recursive=True)
-            for match in matches[:3]:  # Limit to 3 matches
-                rel_path = os.path.relpath(match, root_dir)
-                found_files.append(rel_path.replace('\\', '/'))
+        api_name = path.replace('api/content/', '').replace('/route.ts', '')
+        route_files = [p for p in index['by_name'].get('route.ts', [])
+                       if p.startswith('src/app/api/')]
+        # Try to find the closest match (src/app/api/**/*{api_name}*/route.ts)
+        depth = api_name.count('/') + 1
+        for route_file in route_files:
+            route_dir = route_file[:-len('/route.ts')]
+            tail = '/'.join(route_dir.split('/')[-depth:])
+            if fnmatch.fnmatchcase(tail, f"*{api_name}*"):
+                found_files.append(route_file)
+                confidence[route_file] = 0.8
+                if len(found_files) >= 3:  # Limit to 3 matches
+                    break
         
         # If still not found, try exact name match in api/content directories
         if not found_files:
-            search_pattern = f"src/app/api/content/**/route.ts"
-            matches = glob.glob(os.path.join(root_dir, search_pattern.replace('/', os.sep)), recursive=True)
-            for match in matches:
-                rel_path = os.path.relpath(match, root_dir)
+            for route_file in route_files:
+                if not route_file.startswith('src/app/api/content/'):
+                    continue
                 # Check if this matches what we're looking for
-                if api_name.replace('-', '') in rel_path.replace('-', '').replace('/', ''):
-                    found_files.append(rel_path.replace('\\', '/'))
+                if api_name.replace('-', '') in route_file.replace('-', '').replace('/', ''):
+                    found_files.append(route_file)
+                    confidence[route_file] = 0.6
                     if len(found_files) >= 3:
                         break
         
-        return found_files[:3]  # Return max 3 matches
+        return [(f, confidence[f]) for f in found_files[:3]]  # Return max 3 matches
     
     # Special handling for content-strategy paths
     if 'content-strategy' in path:
@@ -242,11 +1022,10 @@ def find_file_similar(path, root_dir):
                 'src/app/page.tsx'  # fallback
             ]
             for expected in expected_paths:
-                full_path = os.path.join(root_dir, expected.replace('/', os.sep))
-                if os.path.exists(full_path):
+                if expected in file_set:
                     found_files.append(expected)
                     break
-        return found_files
+        return [(f, 0.8) for f in found_files]
     
     # If path doesn't have an extension, try common extensions
     if '.' not in filename:
@@ -267,36 +1046,59 @@ def find_file_similar(path, root_dir):
     path_parts = path.split('/')
     for i in range(len(path_parts)):
         partial_path = '/'.join(path_parts[i:])
-        full_path = os.path.join(root_dir, partial_path.replace('/', os.sep))
-        if os.path.exists(full_path):
-            rel_path = os.path.relpath(full_path, root_dir)
-            if rel_path not in found_files:
-                found_files.append(rel_path.replace('\\', '/'))
+        if partial_path in file_set or partial_path in index['dir_set']:
+            if partial_path not in found_files:
+                found_files.append(partial_path)
+                confidence[partial_path] = (len(path_parts) - i) / len(path_parts)
+    
+    # Then files sharing the longest trailing "dir/file" suffix with the path
+    matched = len(path_parts)
+    if not found_files:
+        dir_parts = path_parts[:-1]
+        for i in range(max(0, len(dir_parts) - PATH_SUFFIX_DEPTH + 1), len(dir_parts)):
+            for name in possible_names:
+                suffix = '/'.join(dir_parts[i:] + [name])
+                found_files.extend(index['by_suffix'].get(suffix, []))
+            if found_files:
+                matched = len(dir_parts) - i + 1
+                break
     
     # If no exact match, search by filename
     if not found_files:
-        for root, dirs, files in os.walk(root_dir):
-            # Skip ignored directories and build directories
-            dirs[:] = [d for d in dirs if d not in IGNORED_DIRS and d != '.next']
-            
-            for file in files:
-                # Check exact matches
-                if file in possible_names:
-                    full_path = os.path.join(root, file)
-                    rel_path = os.path.relpath(full_path, root_dir)
-                    if rel_path not in found_files:
-                        found_files.append(rel_path.replace('\\', '/'))
-                        if len(found_files) >= 3:  # Limit results
-                            return found_files
+        matched = 1
+        for name in possible_names:
+            found_files.extend(index['by_name'].get(name, []))
     
-    return found_files[:3]  # Return max 3 matches
+    # Still nothing: rank names that are close to it (typos, renamed case/separators)
+    if not found_files:
+        return find_fuzzy_matches(path, index)
+    
+    for f in found_files:
+        # A matching name counts for half, the matching directories for the rest
+        confidence.setdefault(f, 0.5 + 0.5 * matched / len(path_parts))
+    return [(f, confidence[f]) for f in found_files[:3]]  # Return max 3 matches
 
-def expand_user_paths(user_paths, root_dir):
+def expand_user_paths(user_paths, root_dir, use_cache=True, origins=None):
     """
     Expands user-provided paths (files and directories) to a list of files.
+    The path index used to resolve missing paths is only built on the first miss.
+    If origins is a dict, it records for each file whether it was 'listed'
+    (named directly or found by similar-name search) or came from a listed
+    'directory'.
+    """
+    return list(iter_expanded_paths(user_paths, root_dir, use_cache, origins))
+
+def iter_expanded_paths(user_paths, root_dir, use_cache=True, origins=None, verbose=True):
     """
+    Generator behind expand_user_paths: yields each file the first time a
+    user path expands to it. verbose=False silences the notes about paths
+    that were searched for or not found.
+    """
+    if origins is None:
+        origins = {}
     expanded_files = set()
     gitignore_spec = load_gitignore(root_dir)
+    path_index = None
     processed_paths = set()
     api_base_processed = set()  # Track API base paths to avoid duplicates
     
@@ -338,157 +1140,3006 @@ def expand_user_paths(user_paths, root_dir):
             # It's a file
             rel_path = os.path.relpath(full_path, root_dir)
             if not is_ignored(rel_path, gitignore_spec):
-                expanded_files.add(rel_path)
+                origins[rel_path] = 'listed'
+                if rel_path not in expanded_files:
+                    expanded_files.add(rel_path)
+                    yield rel_path
         elif os.path.isdir(full_path):
             # It's a directory - walk through it
-            for dirpath, dirnames, filenames in os.walk(full_path):
-                # Modify dirnames in-place to skip ignored directories
-                dirnames[:] = [d for d in dirnames if d not in IGNORED_DIRS]
-                
-                for filename in filenames:
-                    abs_path = os.path.join(dirpath, filename)
-                    rel_path = os.path.relpath(abs_path, root_dir)
-                    
-                    # Skip the script itself and the output file
-                    if filename == os.path.basename(__file__) or filename == OUTPUT_FILE:
-                        continue
-                    
-                    if not is_ignored(rel_path, gitignore_spec):
-                        expanded_files.add(rel_path)
+            rel_dir = os.path.relpath(full_path, root_dir).replace(os.sep, '/')
+            rel_dir = '' if rel_dir == '.' else rel_dir
+            if rel_dir and (any(part in IGNORED_DIRS for part in rel_dir.split('/')) or
+                            gitignore_spec.is_dir_ignored(rel_dir)):
+                continue
+            for rel_path, _ in iter_scan_files(root_dir, gitignore_spec, rel_dir):
+                origins.setdefault(rel_path, 'directory')
+                if rel_path not in expanded_files:
+                    expanded_files.add(rel_path)
+                    yield rel_path
         else:
             # Path not found - try intelligent search
-            similar_files = find_file_similar(path, root_dir)
+            with profile_stage('resolve') as stage:
+                if path_index is None:
+                    path_index = get_path_index(root_dir, use_cache)
+                similar_files = find_file_matches(path, root_dir, path_index)
+                stage.files = len(similar_files)
             if similar_files:
                 # For API routes, prefer the most specific match
                 if path.startswith('api/content/'):
                     # Sort by exact match score
                     similar_files.sort(key=lambda x: (
-                        x.count('/content/') == 1,  # Prefer direct /content/ paths
-                        x.count('/')  # Then prefer shorter paths
+                        x[0].count('/content/') == 1,  # Prefer direct /content/ paths
+                        x[0].count('/')  # Then prefer shorter paths
                     ), reverse=True)
                 
                 # Take the best match
-                best_match = similar_files[0]
-                print(f"Found '{path}' at: {best_match}")
+                best_match, confidence = similar_files[0]
+                if verbose:
+                    print(f"Found '{path}' at: {best_match} (confidence {confidence:.2f})")
                 
                 if not is_ignored(best_match, gitignore_spec):
-                    expanded_files.add(best_match)
-            else:
+                    origins[best_match] = 'listed'
+                    if best_match not in expanded_files:
+                        expanded_files.add(best_match)
+                        yield best_match
+            elif verbose:
                 print(f"Warning: Path not found: {path}")
-    
-    return list(expanded_files)
 
-def scan_all_files(root_dir):
+def scan_imports(rel_path, text):
     """
-    Scans all files in the directory (original behavior).
+    Returns the import specifiers in a file's text, as written for JS/TS and
+    PHP ("./util", "@/lib/db", "./lib/x.php" for __DIR__-relative includes)
+    and as dotted module names for Python (".models", "app.views.index").
+    Regex scanners, so imports in comments or strings are picked up too.
     """
-    gitignore_spec = load_gitignore(root_dir)
-    valid_files = []
-    
-    print(f"Scanning directory: {root_dir}...")
-    
-    # Walk through the directory
-    for dirpath, dirnames, filenames in os.walk(root_dir):
-        # Modify dirnames in-place to skip ignored directories efficiently
-        dirnames[:] = [d for d in dirnames if d not in IGNORED_DIRS]
-        
-        # Also skip .git folder specifically if it wasn't caught
-        if '.git' in dirnames:
-            dirnames.remove('.git')
-
-        for filename in filenames:
-            abs_path = os.path.join(dirpath, filename)
-            rel_path = os.path.relpath(abs_path, root_dir)
-            
-            # Skip the script itself and the output file
-            if filename == os.path.basename(__file__) or filename == OUTPUT_FILE:
+    ext = os.path.splitext(rel_path)[1].lower()
+    specs = []
+    if ext in JS_IMPORT_EXTENSIONS and ext != '.json':
+        specs = [match.group(2) for match in JS_IMPORT_RE.finditer(text)]
+    elif ext == '.py':
+        for module, names, plain in PY_IMPORT_RE.findall(text):
+            if plain:
+                specs.extend(name.split()[0] for name in plain.split(',') if name.strip())
                 continue
+            specs.append(module)
+            # "from pkg import mod" may import a submodule
+            prefix = module if module.endswith('.') else module + '.'
+            for name in names.strip('()').split(','):
+                name = name.split()[0] if name.strip() else ''
+                if name and name != '*':
+                    specs.append(prefix + name)
+    elif ext == '.php':
+        for dir_prefix, _, spec in PHP_INCLUDE_RE.findall(text):
+            specs.append('./' + spec.lstrip('/') if dir_prefix else spec)
+    return list(dict.fromkeys(specs))
 
-            if not is_ignored(rel_path, gitignore_spec):
-                valid_files.append(rel_path)
-    
-    return valid_files
+def load_path_aliases(root_dir):
+    """
+    Reads compilerOptions.baseUrl and .paths from the project's tsconfig.json
+    (or jsconfig.json), tolerating comments and trailing commas. Returns
+    (base_dir, [(pattern, [targets])]) with the targets relative to the root,
+    longest pattern prefix first; base_dir is None without a baseUrl.
+    """
+    for name in ('tsconfig.json', 'jsconfig.json'):
+        try:
+            with open(os.path.join(root_dir, name), 'r', encoding='utf-8') as f:
+                text = f.read()
+        except OSError:
+            continue
+        text = re.sub(r'("(?:\\.|[^"\\])*")|//[^\n]*|/\*.*?\*/', lambda m: m.group(1) or '', text, flags=re.S)
+        text = re.sub(r',(\s*[}\]])', r'\1', text)
+        try:
+            options = json.loads(text).get('compilerOptions') or {}
+        except (ValueError, AttributeError):
+            print(f"Warning: Could not parse {name} for path aliases")
+            return None, []
+        base_url = options.get('baseUrl')
+        base_dir = None
+        if base_url:
+            base_dir = os.path.normpath(base_url).replace(os.sep, '/')
+            base_dir = '' if base_dir == '.' else base_dir
+        paths_dir = base_dir or ''
+        aliases = []
+        for pattern, targets in (options.get('paths') or {}).items():
+            targets = [os.path.normpath(os.path.join(paths_dir, t)).replace(os.sep, '/') for t in targets]
+            aliases.append((pattern, targets))
+        aliases.sort(key=lambda alias: -len(alias[0].split('*')[0]))
+        return base_dir, aliases
+    return None, []
 
-def generate_tree(file_list):
+def resolve_js_import(spec, importer, file_set, base_dir, aliases):
     """
-    Generates a directory tree string for the Table of Contents.
+    Resolves a JS/TS import specifier to an indexed file: relative to the
+    importing file, through tsconfig path aliases, or from baseUrl. Tries
+    the specifier as is, with each of JS_IMPORT_EXTENSIONS and as a
+    directory index; an explicit .js may stand for a .ts source. Packages
+    from node_modules resolve to None.
     """
-    tree_str = "## 1. Project Structure\n\n```text\n"
-    tree_str += ".\n"
+    spec = spec.split('?')[0]
+    if spec.startswith('.'):
+        bases = [os.path.normpath(os.path.join(os.path.dirname(importer), spec))]
+    else:
+        bases = []
+        for pattern, targets in aliases:
+            prefix, star, suffix = pattern.partition('*')
+            if star and spec.startswith(prefix) and spec.endswith(suffix) and len(spec) >= len(prefix + suffix):
+                middle = spec[len(prefix):len(spec) - len(suffix)]
+                bases.extend(target.replace('*', middle, 1) for target in targets)
+            elif not star and spec == pattern:
+                bases.extend(targets)
+        if base_dir is not None:
+            bases.append(os.path.normpath(os.path.join(base_dir, spec)))
     
-    # Sort files to ensure folders come before files or alphabetical order
-    file_list.sort()
+    for base in bases:
+        base = base.replace(os.sep, '/')
+        stem, spec_ext = os.path.splitext(base)
+        candidates = [base]
+        candidates.extend(base + ext for ext in JS_IMPORT_EXTENSIONS)
+        candidates.extend(f"{base}/index{ext}" for ext in JS_IMPORT_EXTENSIONS)
+        if spec_ext in ('.js', '.jsx', '.mjs', '.cjs'):
+            candidates.extend((stem + '.ts', stem + '.tsx'))
+        for candidate in candidates:
+            if candidate in file_set:
+                return candidate
+    return None
+
+def resolve_python_import(module, importer, file_set):
+    """
+    Resolves a dotted (or relative, ".models") Python module name to an
+    indexed module or package __init__.py. Absolute names are looked up
+    next to the importing file and under each of PY_SOURCE_ROOTS.
+    """
+    name = module.lstrip('.')
+    level = len(module) - len(name)
+    importer_dir = os.path.dirname(importer)
+    if level:
+        base = importer_dir
+        for _ in range(level - 1):
+            base = os.path.dirname(base)
+        bases = [base]
+    else:
+        bases = [importer_dir] + [root for root in PY_SOURCE_ROOTS if root != importer_dir]
     
-    for path in file_list:
-        parts = path.split(os.sep)
-        indent = "    " * (len(parts) - 1)
-        tree_str += f"{indent}├── {parts[-1]}\n"
-        
-    tree_str += "```\n\n"
-    return tree_str
+    for base in bases:
+        path = '/'.join(part for part in [base] + name.split('.') if part)
+        for candidate in (path + '.py', path + '/__init__.py'):
+            if candidate in file_set:
+                return candidate
+    return None
 
-def get_file_content(filepath, rel_path):
+def resolve_import(spec, importer, file_set, aliases):
     """
-    Reads file content and returns formatted markdown block.
+    Resolves an import specifier found in importer (see scan_imports) to an
+    indexed file, or None. aliases is load_path_aliases' result.
+    """
+    ext = os.path.splitext(importer)[1].lower()
+    if ext == '.py':
+        return resolve_python_import(spec, importer, file_set)
+    if ext == '.php':
+        for base in (os.path.dirname(importer), ''):
+            candidate = os.path.normpath(os.path.join(base, spec)).replace(os.sep, '/')
+            if candidate in file_set:
+                return candidate
+        return None
+    return resolve_js_import(spec, importer, file_set, *aliases)
+
+def load_imports_cache(root_dir):
+    """
+    Loads the cached import specifiers: {'files': {rel_path: [size,
+    mtime_ns, hash]}, 'imports': {hash: [spec, ...]}}.
     """
     try:
-        # Try reading as UTF-8
-        with open(filepath, 'r', encoding='utf-8') as f:
-            content = f.read()
-            
-        # Determine language for syntax highlighting
-        ext = Path(filepath).suffix.lstrip('.')
-        lang_map = {
-            'py': 'python', 'js': 'javascript', 'ts': 'typescript', 'tsx': 'typescript',
-            'jsx': 'javascript', 'html': 'html', 'css': 'css', 'json': 'json', 
-            'rs': 'rust', 'java': 'java', 'c': 'c', 'cpp': 'cpp', 'sh': 'bash',
-            'bat': 'batch', 'php': 'php'
-        }
-        lang = lang_map.get(ext, '')
-
-        return (
-            f"### {rel_path}\n\n"
-            f"```{lang}\n"
-            f"{content}\n"
-            f"```\n\n"
-            f"---\n\n"
-        )
-    except Exception as e:
-        return f"> Error reading file {rel_path}: {str(e)}\n\n---\n\n"
+        with open(os.path.join(root_dir, CACHE_DIR, IMPORTS_CACHE_FILE), 'r', encoding='utf-8') as f:
+            cache = json.load(f)
+    except (OSError, ValueError):
+        cache = None
+    if not cache or cache.get('version') != IMPORTS_CACHE_VERSION:
+        cache = {'version': IMPORTS_CACHE_VERSION, 'files': {}, 'imports': {}}
+    return cache
 
-def read_from_file(filename):
+def save_imports_cache(root_dir, cache, file_set):
     """
-    Reads file list from a file.
+    Saves the import cache (atomically), dropping files that are gone and
+    hashes no file has any more.
     """
+    files = {rel_path: entry for rel_path, entry in cache['files'].items() if rel_path in file_set}
+    hashes = {entry[2] for entry in files.values()}
+    imports = {content_hash: specs for content_hash, specs in cache['imports'].items() if content_hash in hashes}
+    cache_path = os.path.join(root_dir, CACHE_DIR, IMPORTS_CACHE_FILE)
     try:
-        with open(filename, 'r', encoding='utf-8') as f:
-            return f.read()
-    except FileNotFoundError:
-        print(f"Error: File '{filename}' not found.")
-        sys.exit(1)
-    except Exception as e:
-        print(f"Error reading file '{filename}': {e}")
-        sys.exit(1)
+        os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+        tmp_path = cache_path + '.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump({'version': IMPORTS_CACHE_VERSION, 'files': files, 'imports': imports},
+                      f, separators=(',', ':'))
+        os.replace(tmp_path, cache_path)
+    except OSError as e:
+        print(f"Warning: Could not save import cache: {e}")
 
-def get_user_input():
+def get_file_imports(root_dir, rel_path, cache):
     """
-    Gets user input for file selection mode.
+    Returns the import specifiers of a file, from the cache when its size and
+    mtime (or, failing that, its content hash) are unchanged. Returns
+    (specs, changed) where changed says whether the cache was updated.
     """
-    print("\n" + "="*60)
-    print("PROJECT CODEBASE GENERATOR")
-    print("="*60)
-    print("\nChoose mode:")
-    print("1. Scan all files (default behavior)")
-    print("2. Provide custom list of files/directories")
-    
-    while True:
-        choice = input("\nEnter choice (1 or 2): ").strip()
-        if choice in ['1', '2', '']:
-            break
-        print("Invalid choice. Please enter 1 or 2.")
+    abs_path = os.path.join(root_dir, rel_path)
+    try:
+        st = os.stat(abs_path)
+    except OSError:
+        return [], False
+    entry = cache['files'].get(rel_path)
+    if entry and entry[:2] == [st.st_size, st.st_mtime_ns] and entry[2] in cache['imports']:
+        return cache['imports'][entry[2]], False
+    if st.st_size > IMPORT_SCAN_MAX_BYTES:
+        return [], False
     
-    if choice == '1' or choice == '':
-        return None
+    try:
+        with open(abs_path, 'rb') as f:
+            data = f.read()
+    except OSError:
+        return [], False
+    content_hash = hash_content(data)
+    specs = cache['imports'].get(content_hash)
+    if specs is None:
+        specs = scan_imports(rel_path, decode_text(data)) if b'\0' not in data[:SNIFF_BYTES] else []
+        cache['imports'][content_hash] = specs
+    cache['files'][rel_path] = [st.st_size, st.st_mtime_ns, content_hash]
+    return specs, True
+
+def follow_imports(files, root_dir, depth, use_cache=True, origins=None):
+    """
+    Adds what files import, transitively up to depth levels: imports are
+    found by scan_imports, resolved by resolve_import against the path index
+    and skipped if ignored. Returns files followed by the newly added ones in
+    breadth-first order; origins records those as 'imported'.
+    """
+    if origins is None:
+        origins = {}
+    index = get_path_index(root_dir, use_cache)
+    file_set = index['file_set']
+    gitignore_spec = load_gitignore(root_dir)
+    aliases = load_path_aliases(root_dir)
+    cache = load_imports_cache(root_dir) if use_cache else {'files': {}, 'imports': {}}
+    changed = False
+    
+    result = list(files)
+    seen = {rel_path.replace(os.sep, '/') for rel_path in files}
+    level = sorted(seen)
+    for _ in range(depth):
+        next_level = []
+        for importer in level:
+            specs, updated = get_file_imports(root_dir, importer, cache)
+            changed = changed or updated
+            for spec in specs:
+                rel_path = resolve_import(spec, importer, file_set, aliases)
+                if rel_path is None or rel_path in seen or is_ignored(rel_path, gitignore_spec):
+                    continue
+                seen.add(rel_path)
+                next_level.append(rel_path)
+                origins[rel_path] = 'imported'
+        result.extend(next_level)
+        level = next_level
+        if not level:
+            break
+    
+    if use_cache and changed:
+        save_imports_cache(root_dir, cache, file_set)
+    return result
+
+def stem_search_term(word):
+    """
+    Strips the first matching ending in SEARCH_SUFFIXES from a lowercased
+    word, unless that would leave fewer than SEARCH_MIN_STEM letters.
+    """
+    if word[-1] not in 'sgd':  # the last letters of SEARCH_SUFFIXES
+        return word
+    for suffix, replacement in SEARCH_SUFFIXES:
+        if word.endswith(suffix):
+            if len(word) - len(suffix) >= SEARCH_MIN_STEM:
+                return word[:-len(suffix)] + replacement
+            break
+    return word
+
+def split_search_terms(ident):
+    """
+    Returns the search terms of an identifier or word: its lowercased parts
+    and each pair of neighbouring parts, stemmed, without stop words.
+    """
+    parts = [part.lower() for part in SEARCH_PART_RE.findall(ident)]
+    terms = []
+    for word in chain(parts, (a + b for a, b in zip(parts, parts[1:]))):
+        if 2 <= len(word) <= SEARCH_MAX_TERM and word not in SEARCH_STOP_WORDS:
+            terms.append(stem_search_term(word))
+    return terms
+
+def count_search_terms(text, memo):
+    """
+    Returns a Counter of the search terms in text. memo caches
+    split_search_terms by identifier across calls.
+    """
+    idents = SEARCH_IDENT_RE.findall(text)
+    for ident in set(idents).difference(memo):
+        memo[ident] = split_search_terms(ident)
+    return Counter(chain.from_iterable(map(memo.__getitem__, idents)))
+
+def encode_postings(pairs):
+    """
+    Packs an array('I') of (file id, count) pairs sorted by file id into a
+    blob: ids are stored as deltas from the previous id, then zlib-compressed.
+    """
+    from array import array
+    ids = pairs[0::2]
+    packed = pairs[:]
+    packed[0::2] = array('I', map(int.__sub__, ids, chain((0,), ids)))
+    return zlib.compress(packed.tobytes())
+
+def decode_postings(blob):
+    """
+    Unpacks a blob of encode_postings back to an array('I') of (file id,
+    count) pairs.
+    """
+    from array import array
+    from itertools import accumulate
+    pairs = array('I')
+    pairs.frombytes(zlib.decompress(blob))
+    pairs[0::2] = array('I', accumulate(pairs[0::2]))
+    return pairs
+
+def drop_postings(pairs, deleted):
+    """
+    Returns the (file id, count) pairs whose file is not in deleted.
+    """
+    from array import array
+    if deleted.isdisjoint(pairs[0::2]):
+        return pairs
+    return array('I', chain.from_iterable(
+        (doc, count) for doc, count in zip(pairs[0::2], pairs[1::2]) if doc not in deleted))
+
+class SearchIndex:
+    """
+    Inverted index behind --query in a single sqlite file under the cache
+    directory (in memory with --no-cache): a row per term with its postings
+    packed by encode_postings, and a row per file with the size, mtime and
+    content hash it was indexed from and its length in terms. update() only
+    reads files whose size or mtime changed, and only re-indexes those whose
+    content hash changed, under a new id so that new postings sort last.
+    The ids of changed and deleted files are kept as tombstones: search()
+    skips them, and their postings are dropped whenever a term's row is
+    rewritten, or from every row once they are SEARCH_COMPACT_SHARE of the
+    files.
+    """
+    def __init__(self, root_dir, use_cache=True):
+        import sqlite3
+        self.db = None
+        if use_cache:
+            path = os.path.join(root_dir, CACHE_DIR, SEARCH_INDEX_FILE)
+            try:
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                self.db = sqlite3.connect(path, timeout=30)
+                self._create_tables()
+            except (OSError, sqlite3.Error) as e:
+                print(f"Warning: Search index kept in memory only: {e}")
+                if self.db is not None:
+                    self.db.close()
+                self.db = None
+        if self.db is None:
+            self.db = sqlite3.connect(':memory:')
+            self._create_tables()
+
+    def _create_tables(self):
+        self.db.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value)")
+        self.db.execute("CREATE TABLE IF NOT EXISTS docs (id INTEGER PRIMARY KEY, path TEXT UNIQUE, "
+                        "size INTEGER, mtime_ns INTEGER, hash TEXT, length INTEGER)")
+        self.db.execute("CREATE TABLE IF NOT EXISTS terms (term TEXT PRIMARY KEY, postings BLOB) WITHOUT ROWID")
+        row = self.db.execute("SELECT value FROM meta WHERE key = 'version'").fetchone()
+        if row is None or row[0] != SEARCH_INDEX_VERSION:
+            for table in ('meta', 'terms', 'docs'):
+                self.db.execute(f"DELETE FROM {table}")
+            self.db.execute("INSERT INTO meta VALUES ('version', ?)", (SEARCH_INDEX_VERSION,))
+        self.db.commit()
+
+    def _load_meta(self):
+        """
+        Returns the stored counters: {'next_doc', 'files', 'lengths' (an
+        array('I') of lengths by file id), 'deleted' (the tombstones), 'tree'
+        (the JSON get_tree_state the file list was last taken at)}.
+        """
+        from array import array
+        meta = dict(self.db.execute("SELECT key, value FROM meta"))
+        lengths = array('I')
+        lengths.frombytes(meta.get('lengths', b''))
+        deleted = array('I')
+        deleted.frombytes(meta.get('deleted', b''))
+        return {'next_doc': meta.get('next_doc', 1), 'files': meta.get('files', 0),
+                'lengths': lengths, 'deleted': set(deleted), 'tree': meta.get('tree')}
+
+    def _flush(self, pending, deleted):
+        """
+        Appends the pairs in pending ({term: array('I') of (file id, count)})
+        to the stored postings, dropping the tombstoned files on the way.
+        """
+        from array import array
+        terms = list(pending)
+        for i in range(0, len(terms), 500):
+            batch = terms[i:i + 500]
+            stored = dict(self.db.execute(
+                f"SELECT term, postings FROM terms WHERE term IN ({','.join('?' * len(batch))})", batch))
+            rows = []
+            for term in batch:
+                pairs = drop_postings(decode_postings(stored[term]), deleted) if term in stored else array('I')
+                pairs.extend(pending[term])
+                rows.append((term, encode_postings(pairs)))
+            self.db.executemany("INSERT OR REPLACE INTO terms VALUES (?, ?)", rows)
+        pending.clear()
+
+    def _compact(self, deleted):
+        """
+        Drops the tombstoned files from every term's postings.
+        """
+        rows = self.db.execute("SELECT term, postings FROM terms").fetchall()
+        for i in range(0, len(rows), 10000):
+            updates = []
+            removed = []
+            for term, blob in rows[i:i + 10000]:
+                pairs = decode_postings(blob)
+                kept = drop_postings(pairs, deleted)
+                if not kept:
+                    removed.append((term,))
+                elif kept is not pairs:
+                    updates.append((encode_postings(kept), term))
+            self.db.executemany("UPDATE terms SET postings = ? WHERE term = ?", updates)
+            self.db.executemany("DELETE FROM terms WHERE term = ?", removed)
+        deleted.clear()
+
+    def update(self, root_dir, rel_paths, stats=None):
+        """
+        Brings the index in line with the given files, dropping files that
+        are gone. stats may hold an os.stat_result per rel_path. Returns the
+        number of files (re)indexed.
+        """
+        from array import array
+        docs = {path: row for *row, path in
+                self.db.execute("SELECT id, size, mtime_ns, hash, path FROM docs")}
+        meta = self._load_meta()
+        next_doc = meta['next_doc']
+        deleted = meta['deleted']
+        pending = {}
+        pending_count = 0
+        memo = {}
+        seen = set()
+        indexed = 0
+        changed = False
+        with self.db:
+            for rel_path in rel_paths:
+                path = rel_path.replace(os.sep, '/')
+                seen.add(path)
+                st = stats.get(rel_path) if stats else None
+                try:
+                    if st is None:
+                        st = os.stat(os.path.join(root_dir, rel_path))
+                    old = docs.get(path)
+                    if old is not None and old[1:3] == [st.st_size, st.st_mtime_ns]:
+                        continue
+                    data = b''
+                    if st.st_size <= SEARCH_MAX_BYTES:
+                        with open(os.path.join(root_dir, rel_path), 'rb') as f:
+                            data = f.read()
+                except OSError:
+                    continue
+                changed = True
+                content_hash = hash_content(data) if data else ''
+                if old is not None and old[3] == content_hash:
+                    self.db.execute("UPDATE docs SET size = ?, mtime_ns = ? WHERE id = ?",
+                                    (st.st_size, st.st_mtime_ns, old[0]))
+                    continue
+                
+                if old is not None:
+                    deleted.add(old[0])
+                    self.db.execute("DELETE FROM docs WHERE id = ?", (old[0],))
+                counts = Counter()
+                if data and sniff_binary(data[:SNIFF_BYTES]) is None:
+                    counts = count_search_terms(data.decode('utf-8', 'replace'), memo)
+                for term, count in count_search_terms(path, memo).items():
+                    counts[term] += count * SEARCH_PATH_WEIGHT
+                self.db.execute("INSERT INTO docs VALUES (?, ?, ?, ?, ?, ?)",
+                                (next_doc, path, st.st_size, st.st_mtime_ns, content_hash,
+                                 sum(counts.values())))
+                for term, count in counts.items():
+                    postings = pending.get(term)
+                    if postings is None:
+                        postings = pending[term] = array('I')
+                    postings.append(next_doc)
+                    postings.append(count)
+                next_doc += 1
+                indexed += 1
+                pending_count += len(counts)
+                if pending_count >= SEARCH_FLUSH_POSTINGS:
+                    self._flush(pending, deleted)
+                    pending_count = 0
+            
+            for path, (doc, *_) in docs.items():
+                if path not in seen:
+                    changed = True
+                    deleted.add(doc)
+                    self.db.execute("DELETE FROM docs WHERE id = ?", (doc,))
+            if not changed:
+                return 0
+            self._flush(pending, deleted)
+            
+            files = self.db.execute("SELECT COUNT(*) FROM docs").fetchone()[0]
+            if len(deleted) > files * SEARCH_COMPACT_SHARE:
+                self._compact(deleted)
+            lengths = array('I', bytes(4 * next_doc))
+            for doc, length in self.db.execute("SELECT id, length FROM docs"):
+                lengths[doc] = length
+            self.db.executemany("INSERT OR REPLACE INTO meta VALUES (?, ?)", [
+                ('next_doc', next_doc), ('files', files), ('lengths', lengths.tobytes()),
+                ('deleted', array('I', sorted(deleted)).tobytes())])
+        return indexed
+
+    def current_files(self, root_dir):
+        """
+        Returns the indexed paths if the tree state they were listed at (see
+        set_tree) is still current, else None.
+        """
+        tree = self._load_meta()['tree']
+        if tree is None:
+            return None
+        tree = json.loads(tree)
+        stored = json.dumps(tree)
+        if not is_tree_state_current(tree, root_dir):
+            return None
+        if json.dumps(tree) != stored:
+            self.set_tree(tree)
+        return [path.replace('/', os.sep) for (path,) in self.db.execute("SELECT path FROM docs")]
+
+    def set_tree(self, tree):
+        """
+        Records the get_tree_state the indexed file list was taken at.
+        """
+        with self.db:
+            self.db.execute("INSERT OR REPLACE INTO meta VALUES ('tree', ?)",
+                            (json.dumps(tree, separators=(',', ':')),))
+
+    def search(self, query, limit=DEFAULT_QUERY_LIMIT):
+        """
+        Ranks the indexed files against a query with BM25. Returns up to
+        limit (rel_path, score) pairs, best first.
+        """
+        meta = self._load_meta()
+        terms = set(count_search_terms(query, {}))
+        files = meta['files']
+        if not terms or not files:
+            return []
+        lengths = meta['lengths']
+        k1 = SEARCH_BM25_K1
+        base = k1 * (1 - SEARCH_BM25_B)
+        scale = k1 * SEARCH_BM25_B * files / (sum(lengths) or 1)
+        scores = {}
+        for term in terms:
+            row = self.db.execute("SELECT postings FROM terms WHERE term = ?", (term,)).fetchone()
+            if row is None:
+                continue
+            pairs = drop_postings(decode_postings(row[0]), meta['deleted'])
+            docs = pairs[0::2]
+            if not docs:
+                continue
+            weight = math.log(1 + (files - len(docs) + 0.5) / (len(docs) + 0.5)) * (k1 + 1)
+            for doc, tf in zip(docs, pairs[1::2]):
+                scores[doc] = scores.get(doc, 0.0) + weight * tf / (tf + base + scale * lengths[doc])
+        best = heapq.nlargest(limit, scores.items(), key=lambda item: (item[1], -item[0]))
+        if not best:
+            return []
+        paths = dict(self.db.execute(f"SELECT id, path FROM docs WHERE id IN ({','.join('?' * len(best))})",
+                                     [doc for doc, _ in best]))
+        return [(paths[doc].replace('/', os.sep), score) for doc, score in best]
+
+    def close(self):
+        self.db.close()
+
+def listing_signature(names):
+    """
+    Hashes the names of a directory's entries that can change what --scan
+    finds: subdirectories (as "name/") and files affects_file_list keeps.
+    """
+    return hashlib.sha1('\0'.join(sorted(names)).encode('utf-8', 'surrogateescape')).hexdigest()
+
+def get_tree_state(root_dir, use_cache=True):
+    """
+    Returns the state search_project checks a stored file list against:
+    {'dirs': {rel_dir: [mtime_ns, listing_signature]}, 'ignores': {rel_path:
+    mtime_ns}} for every directory of the path index and every ignore file.
+    It is taken from the path index, rebuilt on the way if stale.
+    """
+    index = _PATH_INDEXES.get(root_dir)
+    if index is not None and not is_path_index_fresh(index, root_dir):
+        _PATH_INDEXES.pop(root_dir)
+    index = get_path_index(root_dir, use_cache)
+    names = {rel_dir: [] for rel_dir in index['dirs']}
+    for rel_dir in index['dirs']:
+        if rel_dir:
+            parent, _, name = rel_dir.rpartition('/')
+            names[parent].append(name + '/')
+    for rel_path in index['files']:
+        parent, _, name = rel_path.rpartition('/')
+        if parent in names and affects_file_list(name):
+            names[parent].append(name)
+    
+    ignores = {}
+    for rel_path in ['.git/info/exclude'] + index['by_name'].get('.gitignore', []):
+        try:
+            ignores[rel_path] = os.stat(os.path.join(root_dir, rel_path)).st_mtime_ns
+        except OSError:
+            ignores[rel_path] = None
+    return {'dirs': {rel_dir: [mtime_ns, listing_signature(names[rel_dir])]
+                     for rel_dir, mtime_ns in index['dirs'].items()},
+            'ignores': ignores}
+
+def is_tree_state_current(state, root_dir):
+    """
+    Checks that the files --scan finds can't have changed since state was
+    taken (see get_tree_state). Directories whose mtime moved are listed
+    again and only count as changed if an entry that matters came or went
+    (writing an output file or a cache doesn't); their new mtimes are stored
+    in state.
+    """
+    for rel_path, mtime_ns in state['ignores'].items():
+        try:
+            if os.stat(os.path.join(root_dir, rel_path)).st_mtime_ns != mtime_ns:
+                return False
+        except OSError:
+            if mtime_ns is not None:
+                return False
+    
+    for rel_dir, entry in state['dirs'].items():
+        abs_dir = os.path.join(root_dir, rel_dir) if rel_dir else root_dir
+        try:
+            mtime_ns = os.stat(abs_dir).st_mtime_ns
+            if mtime_ns == entry[0]:
+                continue
+            names = []
+            with os.scandir(abs_dir) as entries:
+                for dir_entry in entries:
+                    if dir_entry.is_dir():
+                        if dir_entry.name not in INDEX_SKIP_DIRS and not dir_entry.is_symlink():
+                            names.append(dir_entry.name + '/')
+                    elif affects_file_list(dir_entry.name):
+                        names.append(dir_entry.name)
+        except OSError:
+            return False
+        if listing_signature(names) != entry[1]:
+            return False
+        entry[0] = mtime_ns
+    return True
+
+def search_project(query, root_dir, limit=DEFAULT_QUERY_LIMIT, source='walk', use_cache=True):
+    """
+    Lists the project files (like --scan), brings the search index up to
+    date with them and returns the paths of the limit files that best match
+    a query, best first. Under --serve the daemon's file list is used; else
+    the list the index was last updated with is reused while
+    is_tree_state_current vouches for it, so only the files are stat'ed.
+    """
+    import sqlite3
+    index = SearchIndex(root_dir, use_cache)
+    try:
+        stats = None
+        tree = None
+        rel_paths = None
+        hot = _HOT_STATE.get(root_dir)
+        if source != 'walk':
+            rel_paths = scan_project_files(root_dir, source)
+        elif hot is not None and 'files' in hot:
+            rel_paths = scan_all_files(root_dir)
+        elif use_cache:
+            rel_paths = index.current_files(root_dir)
+            # The path index doesn't look inside .next, so it can't vouch for files there
+            if rel_paths is not None and any('.next' + os.sep in rel_path for rel_path in rel_paths):
+                rel_paths = None
+            if rel_paths is None:
+                tree = get_tree_state(root_dir, use_cache)
+        if rel_paths is None:
+            stats = {}
+            rel_paths = scan_all_files(root_dir, stats)
+        indexed = index.update(root_dir, rel_paths, stats)
+        if tree is not None:
+            index.set_tree(tree)
+        if indexed:
+            print(f"Indexed {indexed} new or changed files for search.")
+        matches = index.search(query, limit)
+    except sqlite3.Error as e:
+        print(f"Warning: Search failed: {e}")
+        return []
+    finally:
+        index.close()
+    
+    if matches:
+        print(f"\nTop {len(matches)} of {len(rel_paths)} files for \"{query}\":")
+        for rel_path, score in matches:
+            print(f"  {score:6.2f}  {rel_path}")
+    return [rel_path for rel_path, _ in matches]
+
+def iter_scan_files(root_dir, matcher, rel_dir=''):
+    """
+    Walks root_dir (or the rel_dir below it) with os.scandir and yields
+    (rel_path, DirEntry) for every file that is not ignored. Relative paths are
+    built incrementally from the parent's prefix, ignore rules are checked on
+    directories before descending, and the DirEntry (with its cached type and
+    stat data) is handed to the caller.
+    """
+    own_name = os.path.basename(__file__)
+    stack = [rel_dir.replace(os.sep, '/')]
+    
+    while stack:
+        rel_dir = stack.pop()
+        # matcher paths always use '/', returned paths use os.sep
+        prefix = rel_dir + '/' if rel_dir else ''
+        os_prefix = prefix.replace('/', os.sep)
+        try:
+            with os.scandir(os.path.join(root_dir, rel_dir) if rel_dir else root_dir) as it:
+                entries = list(it)
+        except OSError:
+            continue
+        
+        # Load this directory's .gitignore (if any) before looking at its entries
+        matcher.chain(rel_dir, has_gitignore=any(e.name == '.gitignore' for e in entries))
+        
+        for entry in entries:
+            name = entry.name
+            if name in IGNORED_DIRS:
+                continue
+            if entry.is_dir():
+                # Like os.walk, don't follow symlinked directories
+                if not entry.is_symlink() and not matcher.match_in_dir(prefix + name + '/', rel_dir):
+                    stack.append(prefix + name)
+                continue
+            
+            # Skip the script itself and the outputs
+            if name == own_name or is_output_name(name):
+                continue
+            if os.path.splitext(name)[1].lower() in IGNORED_EXTENSIONS:
+                continue
+            if matcher.match_in_dir(prefix + name, rel_dir):
+                continue
+            yield os_prefix + name, entry
+
+def find_git_dir(root_dir):
+    """
+    Finds the git directory of the work tree containing root_dir.
+    Returns (git_dir, work_tree) or (None, None) outside a git repository.
+    Handles '.git' files as used by worktrees and submodules.
+    """
+    work_tree = os.path.abspath(root_dir)
+    while True:
+        dot_git = os.path.join(work_tree, '.git')
+        if os.path.isdir(dot_git):
+            return dot_git, work_tree
+        if os.path.isfile(dot_git):
+            try:
+                with open(dot_git, 'r', encoding='utf-8') as f:
+                    line = f.readline().strip()
+            except OSError:
+                return None, None
+            if line.startswith('gitdir:'):
+                return os.path.join(work_tree, line[len('gitdir:'):].strip()), work_tree
+            return None, None
+        parent = os.path.dirname(work_tree)
+        if parent == work_tree:
+            return None, None
+        work_tree = parent
+
+def read_git_index(index_path):
+    """
+    Parses a git index file (versions 2, 3 and 4) without running git.
+    Returns a list of (path, mode, size, mtime_ns, sha1_hex, flags) for the
+    stage-0 entries, or None if the index is missing or uses a layout this
+    parser doesn't handle (split or sparse index).
+    """
+    try:
+        with open(index_path, 'rb') as f:
+            data = f.read()
+    except OSError:
+        return None
+    if len(data) < 12 or data[:4] != b'DIRC':
+        return None
+    
+    version, count = struct.unpack('>II', data[4:12])
+    if version not in (2, 3, 4):
+        return None
+    
+    entries = []
+    pos = 12
+    previous_path = b''
+    unpack_stat = struct.Struct('>10I20sH').unpack_from
+    
+    for _ in range(count):
+        (_, _, mtime_s, mtime_ns, _, _, mode, _, _, size,
+         sha1, flags) = unpack_stat(data, pos)
+        entry_start = pos
+        pos += 62
+        if version >= 3 and flags & 0x4000:
+            # Extended flags: skip-worktree, intent-to-add
+            flags |= struct.unpack_from('>H', data, pos)[0] << 16
+            pos += 2
+        
+        if version == 4:
+            # Path is prefix-compressed against the previous entry
+            strip = data[pos] & 0x7f
+            while data[pos] & 0x80:
+                pos += 1
+                strip = ((strip + 1) << 7) | (data[pos] & 0x7f)
+            pos += 1
+            end = data.index(b'\0', pos)
+            path = previous_path[:len(previous_path) - strip] + data[pos:end]
+            pos = end + 1
+        else:
+            end = data.index(b'\0', pos)
+            path = data[pos:end]
+            # Entries are NUL-padded to a multiple of 8 bytes
+            pos = entry_start + ((end - entry_start + 8) & ~7)
+        previous_path = path
+        
+        if mode == 0o040000:
+            # Sparse index directory entry
+            return None
+        if (flags >> 12) & 3 == 0:
+            entries.append((path.decode('utf-8', 'surrogateescape'), mode, size,
+                            mtime_s * 1000000000 + mtime_ns, sha1.hex(), flags))
+    
+    # A split index keeps most entries in a shared index file
+    while pos + 8 <= len(data) - 20:
+        signature, ext_size = struct.unpack_from('>4sI', data, pos)
+        if signature == b'link':
+            return None
+        pos += 8 + ext_size
+    return entries
+
+def scan_git_index(root_dir, known_hashes=None):
+    """
+    Lists the files tracked in the git index under root_dir, without walking
+    the tree or running git. Gitlinks (submodules), skip-worktree entries and
+    files matching IGNORED_DIRS/IGNORED_EXTENSIONS are left out. If
+    known_hashes is a dict, it is filled with rel_path -> [size, mtime_ns,
+    blob hash] for entries git itself would trust as clean (stat data older
+    than the index file), to seed change detection. Returns None if no usable
+    index is found.
+    """
+    git_dir, work_tree = find_git_dir(root_dir)
+    if git_dir is None:
+        return None
+    index_path = os.path.join(git_dir, 'index')
+    entries = read_git_index(index_path)
+    if entries is None:
+        return None
+    
+    # Entries modified in the same instant the index was written are "racy"
+    index_mtime_ns = os.stat(index_path).st_mtime_ns
+    prefix = os.path.relpath(os.path.abspath(root_dir), work_tree).replace(os.sep, '/')
+    prefix = '' if prefix == '.' else prefix + '/'
+    own_name = os.path.basename(__file__)
+    valid_files = []
+    
+    print(f"Reading file list from git index: {index_path}...")
+    
+    for path, mode, size, mtime_ns, sha1, flags in entries:
+        if mode & 0o170000 == 0o160000 or flags & (0x4000 << 16):
+            continue
+        if not path.startswith(prefix):
+            continue
+        rel_path = path[len(prefix):]
+        parts = rel_path.split('/')
+        if any(part in IGNORED_DIRS for part in parts):
+            continue
+        if parts[-1] == own_name or is_output_name(parts[-1]):
+            continue
+        if os.path.splitext(parts[-1])[1].lower() in IGNORED_EXTENSIONS:
+            continue
+        
+        rel_path = rel_path.replace('/', os.sep)
+        valid_files.append(rel_path)
+        if known_hashes is not None and mtime_ns < index_mtime_ns:
+            known_hashes[rel_path] = [size, mtime_ns, sha1]
+    
+    return valid_files
+
+def scan_all_files(root_dir, stats=None):
+    """
+    Scans all files in the directory (original behavior).
+    Directories ignored by any .gitignore are pruned before descending.
+    If stats is a dict, it is filled with rel_path -> os.stat_result.
+    Under --serve the list is kept until the watcher sees a change.
+    """
+    hot = _HOT_STATE.get(root_dir)
+    if hot is not None and stats is None and 'files' in hot:
+        print(f"Using the file list kept by the daemon for {root_dir}.")
+        return list(hot['files'])
+    generation = hot['generation'] if hot is not None else None
+    gitignore_spec = load_gitignore(root_dir)
+    valid_files = []
+    
+    print(f"Scanning directory: {root_dir}...")
+    
+    for rel_path, entry in iter_scan_files(root_dir, gitignore_spec):
+        valid_files.append(rel_path)
+        if stats is not None:
+            try:
+                stats[rel_path] = entry.stat()
+            except OSError:
+                pass
+    
+    if hot is not None and hot['generation'] == generation:
+        hot['files'] = list(valid_files)
+    return valid_files
+
+def scan_project_files(root_dir, source='walk', known_hashes=None):
+    """
+    Lists all project files, from the git index if source is 'git-index'
+    (falling back to walking the tree when there is no usable index).
+    """
+    if source == 'git-index':
+        valid_files = scan_git_index(root_dir, known_hashes)
+        if valid_files is not None:
+            return valid_files
+        print("No usable git index found, scanning the directory instead.")
+    return scan_all_files(root_dir)
+
+def build_tree(file_list, sizes=None):
+    """
+    Builds a trie of the file list. Directories are dicts mapping names to
+    children; files map to their size (0 without sizes).
+    """
+    root = {}
+    dir_nodes = {'': root}
+    
+    for rel_path in file_list:
+        dir_path, _, filename = rel_path.rpartition(os.sep)
+        node = dir_nodes.get(dir_path)
+        if node is None:
+            # Create the missing directory and any missing parents
+            missing = []
+            while node is None:
+                missing.append(dir_path)
+                dir_path = dir_path.rpartition(os.sep)[0]
+                node = dir_nodes.get(dir_path)
+            for path in reversed(missing):
+                node = node.setdefault(path.rpartition(os.sep)[2], {})
+                dir_nodes[path] = node
+        node[filename] = sizes.get(rel_path, 0) if sizes else 0
+    return root
+
+def _render_tree(node, prefix, lines, show_stats):
+    """
+    Appends the lines for a directory's children and returns the directory's
+    (file count, total bytes).
+    """
+    dirs = []
+    files = []
+    for name, child in node.items():
+        (dirs if type(child) is dict else files).append(name)
+    dirs.sort()
+    files.sort()
+    count = len(files)
+    total = sum(node[name] for name in files) if show_stats else 0
+    last = len(dirs) + len(files) - 1
+    
+    for i, name in enumerate(dirs):
+        child = node[name]
+        # Collapse directories whose only child is another directory
+        while len(child) == 1:
+            only_name, only_child = next(iter(child.items()))
+            if type(only_child) is not dict:
+                break
+            name = f"{name}/{only_name}"
+            child = only_child
+        
+        is_last = i == last
+        header = len(lines)
+        lines.append(None)
+        child_count, child_total = _render_tree(
+            child, prefix + ("    " if is_last else "│   "), lines, show_stats)
+        count += child_count
+        total += child_total
+        
+        stats = ''
+        if show_stats:
+            stats = f" ({child_count} file{'s' if child_count != 1 else ''}, {format_size(child_total)})"
+        lines[header] = f"{prefix}{'└── ' if is_last else '├── '}{name}/{stats}\n"
+    
+    if files:
+        branch = prefix + "├── "
+        lines.extend(f"{branch}{name}\n" for name in files[:-1])
+        lines.append(f"{prefix}└── {files[-1]}\n")
+    return count, total
+
+def generate_tree(file_list, sizes=None):
+    """
+    Generates a directory tree string for the Table of Contents.
+    Directories are listed before files, chains of single-child directories
+    are collapsed into one line (src/app/api/), and if sizes
+    (rel_path -> bytes) are given each directory shows its file count and
+    total size.
+    """
+    lines = ["## 1. Project Structure\n\n```text\n", ".\n"]
+    _render_tree(build_tree(file_list, sizes), '', lines, sizes is not None)
+    lines.append("```\n\n")
+    return ''.join(lines)
+
+# Language tags for syntax highlighting, by file extension
+LANG_MAP = {
+    'py': 'python', 'js': 'javascript', 'ts': 'typescript', 'tsx': 'typescript',
+    'jsx': 'javascript', 'html': 'html', 'css': 'css', 'json': 'json', 
+    'rs': 'rust', 'java': 'java', 'c': 'c', 'cpp': 'cpp', 'sh': 'bash',
+    'bat': 'batch', 'php': 'php'
+}
+
+def get_language(filepath):
+    """
+    Determines the language tag used for syntax highlighting.
+    """
+    ext = os.path.splitext(filepath)[1].lstrip('.')
+    return LANG_MAP.get(ext, '')
+
+def format_file_block(filepath, rel_path, content):
+    """
+    Formats file content as a markdown block.
+    """
+    lang = get_language(filepath)
+
+    return (
+        f"### {rel_path}\n\n"
+        f"```{lang}\n"
+        f"{content}\n"
+        f"```\n\n"
+        f"---\n\n"
+    )
+
+def format_error_block(rel_path, error):
+    """
+    Formats the note written in place of a file that could not be read.
+    """
+    return f"> Error reading file {rel_path}: {str(error)}\n\n---\n\n"
+
+def format_binary_block(rel_path, reason, size):
+    """
+    Formats the note written in place of a file that was sniffed as binary.
+    """
+    return f"### {rel_path}\n\n> Skipped: not a UTF-8 text file ({reason}, {format_size(size)}).\n\n---\n\n"
+
+def format_duplicate_block(rel_path, original):
+    """
+    Formats the note written in place of a file whose content is identical to
+    a file already written above it.
+    """
+    return f"### {rel_path}\n\n> Identical to `{original}` above.\n\n---\n\n"
+
+def format_outline_block(filepath, rel_path, outline):
+    """
+    Formats a file's outline (see extract_outline) as a markdown block.
+    """
+    lang = get_language(filepath)
+    return (
+        f"### {rel_path}\n\n"
+        f"> Outline: signatures only.\n\n"
+        f"```{lang}\n"
+        f"{outline}\n"
+        f"```\n\n"
+        f"---\n\n"
+    )
+
+def outline_python(text):
+    """
+    Python outline via ast: the module docstring, imports, module-level and
+    class-level assignments, and class and function headers (with
+    decorators) followed by their docstrings; function bodies become "...",
+    class bodies are outlined recursively. Statements over
+    OUTLINE_MAX_STATEMENT_LINES lines keep their first line. Returns None if
+    the file doesn't parse.
+    """
+    import ast
+    try:
+        tree = ast.parse(text)
+    except (SyntaxError, ValueError):
+        return None
+    lines = text.splitlines()
+    out = []
+    
+    def body_indent(node):
+        line = lines[node.body[0].lineno - 1]
+        return line[:len(line) - len(line.lstrip())]
+    
+    def emit(nodes, top_level):
+        for node in nodes:
+            if isinstance(node, (ast.FunctionDef, ast.AsyncFunctionDef, ast.ClassDef)):
+                start = min([node.lineno] + [d.lineno for d in node.decorator_list])
+                if top_level and out:
+                    out.append('')
+                first = node.body[0]
+                if lines[first.lineno - 1][:first.col_offset].strip():
+                    # "def f(): return 1": the body shares the header's last line
+                    out.extend(lines[start - 1:first.end_lineno])
+                    continue
+                # the header ends where the first body statement (or its
+                # decorators) begins
+                body_start = min([first.lineno] + [d.lineno for d in getattr(first, 'decorator_list', [])])
+                out.extend(lines[start - 1:body_start - 1])
+                rest = node.body
+                if (isinstance(first, ast.Expr) and isinstance(first.value, ast.Constant)
+                        and isinstance(first.value.value, str)):
+                    out.extend(lines[first.lineno - 1:first.end_lineno])
+                    rest = node.body[1:]
+                emitted = len(out)
+                if isinstance(node, ast.ClassDef):
+                    emit(rest, False)
+                if len(out) == emitted:
+                    out.append(body_indent(node) + '...')
+            elif (isinstance(node, (ast.Assign, ast.AnnAssign)) or
+                  (top_level and isinstance(node, (ast.Import, ast.ImportFrom))) or
+                  (top_level and node is tree.body[0] and isinstance(node, ast.Expr))):
+                if node.end_lineno - node.lineno < OUTLINE_MAX_STATEMENT_LINES or isinstance(node, ast.Expr):
+                    out.extend(lines[node.lineno - 1:node.end_lineno])
+                else:
+                    out.append(lines[node.lineno - 1] + ' ...')
+    
+    emit(tree.body, True)
+    return '\n'.join(out)
+
+def outline_braces(text, token_re, keep_re):
+    """
+    Brace-language outline (JS/TS, PHP) from a token scan: the source is kept
+    as is, except that braced bodies not selected by keep_re (function and
+    method bodies, top-level blocks, object literals) become "{ ... }".
+    Braces inside parentheses (destructured parameters, inline types) are
+    left alone. Returns None if the braces don't balance.
+    """
+    out = []
+    pos = 0
+    statement = 0
+    parens = 0
+    skipping = 0
+    for match in token_re.finditer(text):
+        token = match.group()
+        if skipping:
+            if token == '{':
+                skipping += 1
+            elif token == '}':
+                skipping -= 1
+                if not skipping:
+                    out.append('{ ... }')
+                    pos = statement = match.end()
+            continue
+        if token == '(':
+            parens += 1
+        elif token == ')':
+            parens = max(0, parens - 1)
+        elif token == '{' and not parens:
+            if not keep_re.search(text[statement:match.start()]):
+                out.append(text[pos:match.start()])
+                skipping = 1
+            statement = match.end()
+        elif token in ('}', ';') or len(token) > 1 and token[0] in '/#':
+            statement = match.end()
+    if skipping:
+        return None
+    out.append(text[pos:])
+    return re.sub(r'\n\s*\n(?:\s*\n)+', '\n\n', ''.join(out)).strip('\n')
+
+def extract_outline(rel_path, text):
+    """
+    Returns the outline of a file's text, or None for languages without an
+    extractor and for files an extractor can't handle.
+    """
+    ext = os.path.splitext(rel_path)[1].lower()
+    if ext == '.py':
+        return outline_python(text)
+    if ext in ('.ts', '.tsx', '.js', '.jsx', '.mjs', '.cjs'):
+        return outline_braces(text, JS_OUTLINE_TOKEN_RE, JS_OUTLINE_KEEP_RE)
+    if ext == '.php':
+        return outline_braces(text, PHP_OUTLINE_TOKEN_RE, PHP_OUTLINE_KEEP_RE)
+    return None
+
+def render_outline_block(abs_path, rel_path, content, content_hash, block_cache=None):
+    """
+    Returns the encoded outline block of a file, or None if it has no outline.
+    Outlines are kept in the BlockCache by content hash, so a file is only
+    parsed again when its content changes.
+    """
+    outline = block_cache.get_outline(content_hash) if block_cache is not None else None
+    if outline is None:
+        outline = extract_outline(rel_path, content)
+        outline = '' if outline is None else outline
+        if block_cache is not None:
+            block_cache.put_outline(content_hash, outline)
+    if not outline:
+        return None
+    return format_outline_block(abs_path, rel_path, outline).encode('utf-8')
+
+def get_file_content(filepath, rel_path):
+    """
+    Reads file content and returns formatted markdown block.
+    """
+    try:
+        # Try reading as UTF-8
+        with open(filepath, 'r', encoding='utf-8') as f:
+            content = f.read()
+        return format_file_block(filepath, rel_path, content)
+    except Exception as e:
+        return format_error_block(rel_path, e)
+
+def hash_content(data):
+    """
+    Returns the git blob hash (SHA-1 of "blob <size>\\0" + data) of file
+    contents, so hashes line up with the ones git already stores.
+    """
+    digest = hashlib.sha1(b'blob %d\0' % len(data))
+    digest.update(data)
+    return digest.hexdigest()
+
+def decode_text(data):
+    """
+    Decodes UTF-8 file contents with universal newlines, like open(..., 'r').
+    """
+    return data.decode('utf-8').replace('\r\n', '\n').replace('\r', '\n')
+
+def parse_size(text):
+    """
+    Parses a byte size such as 500000, 300K, 10MB or 1.5G.
+    """
+    match = re.fullmatch(r'\s*(\d+(?:\.\d+)?)\s*([kmg]?)i?b?\s*', str(text), re.IGNORECASE)
+    if not match:
+        raise ValueError(f"invalid size: {text!r}")
+    number, unit = match.groups()
+    multiplier = {'': 1, 'k': 1024, 'm': 1024 ** 2, 'g': 1024 ** 3}[unit.lower()]
+    return int(float(number) * multiplier)
+
+def parse_shard_size(text):
+    """
+    Parses --shard-size: a byte size such as 50MB, or a token count ending in
+    't' such as 200000t or 200kt. Returns (amount, 'bytes' or 'tokens').
+    """
+    match = re.fullmatch(r'\s*(\d+(?:\.\d+)?)\s*([km]?)\s*t(?:okens)?\s*', str(text), re.IGNORECASE)
+    if match:
+        number, unit = match.groups()
+        return int(float(number) * {'': 1, 'k': 1000, 'm': 1000 ** 2}[unit.lower()]), 'tokens'
+    return parse_size(text), 'bytes'
+
+def format_size(size):
+    """
+    Formats a byte count for notes in the output.
+    """
+    for unit in ('bytes', 'KB', 'MB'):
+        if size < 1024:
+            return f"{size} {unit}" if unit == 'bytes' else f"{size:.1f} {unit}"
+        size /= 1024
+    return f"{size:.1f} GB"
+
+def read_proc_io():
+    """
+    Returns this process's read and write syscall counts (syscr, syscw) from
+    /proc/self/io, or None where that isn't available.
+    """
+    try:
+        with open(PROC_IO_PATH, 'rb') as f:
+            fields = dict(line.split(b':', 1) for line in f.read().splitlines())
+        return int(fields[b'syscr']), int(fields[b'syscw'])
+    except (OSError, ValueError, KeyError):
+        return None
+
+class StageProfiler:
+    """
+    Collects the --profile measurements: per stage (see PROFILE_STAGES), the
+    wall time, number of calls, files and bytes handled and read/write
+    syscalls, plus Chrome trace events if trace is set. Stages are
+    timed with profile_stage(), and write_codebase's read/render/write loop
+    with a PipelineTimer. Times of a stage run by several threads at once
+    (the shard writers) add up.
+    """
+    def __init__(self, trace=False):
+        self.lock = threading.Lock()
+        self.stages = {}  # name -> [seconds, calls, files, bytes, syscalls]
+        self.events = [] if trace else None
+        self.has_io = read_proc_io() is not None
+        self.start = time.perf_counter()
+
+    def add(self, name, seconds, files=0, nbytes=0, syscalls=0, calls=1):
+        with self.lock:
+            stage = self.stages.setdefault(name, [0.0, 0, 0, 0, 0])
+            stage[0] += seconds
+            stage[1] += calls
+            stage[2] += files
+            stage[3] += nbytes
+            stage[4] += syscalls
+
+    def event(self, name, start, seconds, args=None):
+        """
+        Records a Chrome trace event (a no-op unless tracing).
+        """
+        if self.events is None:
+            return
+        event = {'name': name, 'ph': 'X', 'pid': os.getpid(), 'tid': threading.get_ident(),
+                 'ts': round((start - self.start) * 1e6, 1), 'dur': round(seconds * 1e6, 1)}
+        if args:
+            event['args'] = args
+        with self.lock:
+            self.events.append(event)
+
+    def report(self):
+        """
+        Prints the per-stage summary table.
+        """
+        total = time.perf_counter() - self.start
+        print(f"\n{'Stage':<12}{'Seconds':>10}{'Calls':>9}{'Files':>9}{'Bytes':>12}{'Syscalls':>10}")
+        order = {name: i for i, name in enumerate(PROFILE_STAGES)}
+        for name in sorted(self.stages, key=lambda name: order.get(name, len(order))):
+            seconds, calls, files, nbytes, syscalls = self.stages[name]
+            print(f"{name:<12}{seconds:>10.3f}{calls:>9}{files or '-':>9}"
+                  f"{format_size(nbytes) if nbytes else '-':>12}{syscalls if self.has_io else '-':>10}")
+        print(f"{'total':<12}{total:>10.3f}")
+
+    def write_trace(self, path):
+        """
+        Writes the trace events in Chrome's trace format (chrome://tracing, Perfetto).
+        """
+        with open(path, 'w', encoding='utf-8') as f:
+            json.dump({'traceEvents': self.events, 'displayTimeUnit': 'ms'}, f)
+
+class ProfileStage:
+    """
+    Context manager timing one run of a stage; set files and nbytes inside
+    the block. Does nothing when profiler is None.
+    """
+    def __init__(self, profiler, name):
+        self.profiler = profiler
+        self.name = name
+        self.files = 0
+        self.nbytes = 0
+
+    def __enter__(self):
+        if self.profiler is not None:
+            self.io = read_proc_io()
+            self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        if self.profiler is not None:
+            seconds = time.perf_counter() - self.started
+            io = read_proc_io()
+            syscalls = sum(io) - sum(self.io) if io and self.io else 0
+            self.profiler.add(self.name, seconds, self.files, self.nbytes, syscalls)
+            self.profiler.event(self.name, self.started, seconds)
+        return False
+
+def profile_stage(name):
+    """
+    Returns a ProfileStage for the current --profile run (a no-op without one).
+    """
+    return ProfileStage(_PROFILER, name)
+
+class PipelineTimer:
+    """
+    Splits the time of write_codebase's loop into 'read' (waiting for
+    iter_read_files), 'write' (calls on the output file, see output()) and
+    'render' (the rest of each file's turn). The loop's read syscalls are
+    counted under 'read' and its write syscalls under 'write'.
+    """
+    def __init__(self, profiler):
+        self.profiler = profiler
+        self.write_seconds = 0.0
+
+    def sources(self, sources):
+        """
+        Passes through iter_read_files results, timing each step.
+        """
+        io_start = read_proc_io()
+        waited = time.perf_counter()
+        for rel_path, source in sources:
+            got = time.perf_counter()
+            data = source['data']
+            self.profiler.add('read', got - waited, 1, len(data) if data else 0)
+            self.profiler.event('read', waited, got - waited, {'file': rel_path})
+            self.write_seconds = 0.0
+            yield rel_path, source
+            waited = time.perf_counter()
+            self.profiler.add('render', waited - got - self.write_seconds, 1)
+            self.profiler.event('render', got, waited - got, {'file': rel_path})
+        io_end = read_proc_io()
+        if io_start and io_end:
+            self.profiler.add('read', 0.0, syscalls=io_end[0] - io_start[0], calls=0)
+            self.profiler.add('write', 0.0, syscalls=io_end[1] - io_start[1], calls=0)
+
+    def output(self, md_file):
+        return _TimedOutput(md_file, self)
+
+class _TimedOutput:
+    """
+    Output file wrapper for PipelineTimer that times write() calls.
+    """
+    def __init__(self, f, timer):
+        self.f = f
+        self.timer = timer
+
+    def write(self, data):
+        started = time.perf_counter()
+        written = self.f.write(data)
+        seconds = time.perf_counter() - started
+        self.timer.write_seconds += seconds
+        self.timer.profiler.add('write', seconds, nbytes=len(data))
+        return written
+
+    def __getattr__(self, name):
+        return getattr(self.f, name)
+
+def write_all(dst, pieces):
+    """
+    Writes every piece a generator yields to dst and returns the generator's
+    own return value.
+    """
+    while True:
+        try:
+            piece = next(pieces)
+        except StopIteration as stop:
+            return stop.value
+        dst.write(piece)
+
+def iter_text(src, length=None, hasher=None):
+    """
+    Yields up to length bytes (or everything) of UTF-8 text from src,
+    re-encoded in CHUNK_SIZE pieces, applying universal newlines like
+    open(..., 'r'). Raw bytes are fed to hasher if given. Raises
+    UnicodeDecodeError on invalid text. Returns (bytes_read, last_char_yielded).
+    """
+    decoder = io.IncrementalNewlineDecoder(codecs.getincrementaldecoder('utf-8')(), translate=True)
+    bytes_read = 0
+    last_char = ''
+    
+    while length is None or bytes_read < length:
+        size = CHUNK_SIZE if length is None else min(CHUNK_SIZE, length - bytes_read)
+        chunk = src.read(size)
+        if not chunk:
+            break
+        bytes_read += len(chunk)
+        if hasher is not None:
+            hasher.update(chunk)
+        text = decoder.decode(chunk)
+        if text:
+            yield text.encode('utf-8')
+            last_char = text[-1]
+    
+    text = decoder.decode(b'', final=True)
+    if text:
+        yield text.encode('utf-8')
+        last_char = text[-1]
+    return bytes_read, last_char
+
+def find_text_cut(f, pos, forward):
+    """
+    Moves a cut position in a file to the nearest line start (within 4 KB) or,
+    failing that, to a UTF-8 character boundary, so truncated text stays
+    readable and decodable.
+    """
+    window = 4096
+    if forward:
+        f.seek(pos)
+        buf = f.read(window)
+        newline = buf.find(b'\n')
+        if newline != -1:
+            return pos + newline + 1
+        i = 0
+        while i < len(buf) and 0x80 <= buf[i] < 0xC0:
+            i += 1
+        return pos + i
+    
+    start = max(0, pos - window)
+    f.seek(start)
+    buf = f.read(pos - start + 1)
+    newline = buf.rfind(b'\n', 0, pos - start)
+    if newline != -1:
+        return start + newline + 1
+    i = pos - start
+    while i > 0 and i < len(buf) and 0x80 <= buf[i] < 0xC0:
+        i -= 1
+    return start + i
+
+def iter_streamed_block(abs_path, rel_path, max_file_bytes=None, oversize='truncate'):
+    """
+    Yields a file's block in CHUNK_SIZE pieces, so memory stays flat however
+    large the file is. Files over max_file_bytes are skipped, truncated or
+    cut down to their head and tail according to oversize, with a note in
+    the output. Returns (stat_result, content_hash); the hash is None unless
+    the whole file was read.
+    """
+    with open(abs_path, 'rb') as f:
+        st = os.fstat(f.fileno())
+        size = st.st_size
+        header = f"### {rel_path}\n\n"
+        limit_note = f"the {format_size(max_file_bytes)} limit (--max-file-bytes)" if max_file_bytes is not None else ''
+        
+        if max_file_bytes is not None and size > max_file_bytes and oversize == 'skip':
+            yield (
+                f"{header}> Skipped: {format_size(size)} is over {limit_note}.\n\n---\n\n"
+            ).encode('utf-8')
+            return st, None
+        
+        yield f"{header}```{get_language(abs_path)}\n".encode('utf-8')
+        content_hash = None
+        note = ''
+        
+        if max_file_bytes is None or size <= max_file_bytes:
+            hasher = hashlib.sha1(b'blob %d\0' % size)
+            bytes_read, _ = yield from iter_text(f, hasher=hasher)
+            if bytes_read == size:
+                content_hash = hasher.hexdigest()
+        elif oversize == 'truncate':
+            cut = find_text_cut(f, max_file_bytes, forward=False)
+            f.seek(0)
+            yield from iter_text(f, cut)
+            note = f"> Truncated: showing the first {format_size(cut)} of {format_size(size)}, over {limit_note}.\n\n"
+        else:
+            head_end = find_text_cut(f, max_file_bytes // 2, forward=False)
+            tail_start = max(head_end, find_text_cut(f, size - max_file_bytes // 2, forward=True))
+            f.seek(0)
+            _, last_char = yield from iter_text(f, head_end)
+            if last_char not in ('', '\n'):
+                yield b"\n"
+            yield f"... [{format_size(tail_start - head_end)} omitted] ...\n".encode('utf-8')
+            f.seek(tail_start)
+            yield from iter_text(f, size - tail_start)
+            note = (f"> Truncated: showing the first {format_size(head_end)} and last "
+                    f"{format_size(size - tail_start)} of {format_size(size)}, over {limit_note}.\n\n")
+        
+        yield f"\n```\n\n{note}---\n\n".encode('utf-8')
+    return st, content_hash
+
+def write_streamed_block(md_file, abs_path, rel_path, max_file_bytes=None, oversize='truncate'):
+    """
+    Writes a file's block as iter_streamed_block yields it and returns
+    (stat_result, content_hash).
+    """
+    return write_all(md_file, iter_streamed_block(abs_path, rel_path, max_file_bytes, oversize))
+
+def sniff_binary(sample):
+    """
+    Classifies the first bytes of a file without decoding the rest of it.
+    Returns a short reason if the file looks binary (known magic number,
+    NUL bytes or invalid UTF-8), or None if it looks like UTF-8 text.
+    """
+    reason = None
+    if b'\0' in sample:
+        reason = 'contains NUL bytes'
+    else:
+        try:
+            # final=False tolerates a multi-byte character cut off by the sample
+            codecs.getincrementaldecoder('utf-8')().decode(sample, final=False)
+        except UnicodeDecodeError:
+            reason = 'not valid UTF-8'
+    for magic, kind in BINARY_MAGIC:
+        if sample.startswith(magic) and (reason or not (magic.isascii() and magic.decode().isprintable())):
+            return f"{kind} data"
+    return reason
+
+def load_binary_cache(root_dir):
+    """
+    Returns the cached sniff results ({rel_path: [size, mtime_ns, reason]})
+    kept in the path index, without requiring the index to be fresh.
+    """
+    index = _PATH_INDEXES.get(root_dir) or load_path_index(root_dir) or {}
+    if index.get('binary_version') != BINARY_CACHE_VERSION:
+        return {}
+    return dict(index.get('binary') or {})
+
+def save_binary_cache(root_dir, binary_files):
+    """
+    Stores sniff results in the path index, dropping files that are gone.
+    """
+    binary_files = {rel_path: entry for rel_path, entry in binary_files.items()
+                    if os.path.exists(os.path.join(root_dir, rel_path))}
+    if root_dir in _PATH_INDEXES:
+        _PATH_INDEXES[root_dir]['binary'] = binary_files
+        _PATH_INDEXES[root_dir]['binary_version'] = BINARY_CACHE_VERSION
+    index = load_path_index(root_dir) or {'version': PATH_INDEX_VERSION}
+    index['binary'] = binary_files
+    index['binary_version'] = BINARY_CACHE_VERSION
+    save_path_index(index, root_dir)
+
+def copy_byte_range(src, dst, offset, length, chunk_size=CHUNK_SIZE):
+    """
+    Copies length bytes starting at offset from one binary file to another.
+    """
+    src.seek(offset)
+    while length > 0:
+        chunk = src.read(min(chunk_size, length))
+        if not chunk:
+            raise IOError("previous output is shorter than its manifest")
+        dst.write(chunk)
+        length -= len(chunk)
+
+def get_manifest_path(root_dir, output_file):
+    """
+    Returns where the manifest for an output file is kept in the cache directory.
+    """
+    abs_output = os.path.abspath(output_file)
+    key = hashlib.sha1(abs_output.encode('utf-8')).hexdigest()[:8]
+    return os.path.join(root_dir, CACHE_DIR, f"{os.path.basename(abs_output)}.{key}.manifest.json")
+
+def load_manifest(root_dir, output_file, options=None):
+    """
+    Loads the manifest written with the previous output. Returns None if there
+    is none, if it was written with different rendering options, or if the
+    output file was changed or removed since then.
+    """
+    try:
+        with open(get_manifest_path(root_dir, output_file), 'r', encoding='utf-8') as f:
+            manifest = json.load(f)
+        st = os.stat(output_file)
+    except (OSError, ValueError):
+        return None
+    
+    if manifest.get('version') != MANIFEST_VERSION or manifest.get('options') != (options or {}):
+        return None
+    if manifest.get('output') != [st.st_size, st.st_mtime_ns]:
+        return None
+    return manifest
+
+def save_manifest(root_dir, output_file, entries, options=None):
+    """
+    Saves the manifest for a freshly written output file. Each entry maps a
+    relative path to [size, mtime_ns, hash, offset, length] of its block.
+    """
+    manifest_path = get_manifest_path(root_dir, output_file)
+    try:
+        st = os.stat(output_file)
+        os.makedirs(os.path.dirname(manifest_path), exist_ok=True)
+        tmp_path = manifest_path + '.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump({
+                'version': MANIFEST_VERSION,
+                'output': [st.st_size, st.st_mtime_ns],
+                'options': options or {},
+                'files': entries,
+            }, f, separators=(',', ':'))
+        os.replace(tmp_path, manifest_path)
+    except OSError as e:
+        print(f"Warning: Could not save manifest: {e}")
+
+class BlockCache:
+    """
+    On-disk cache of rendered file blocks in a single sqlite file under the
+    cache directory, one row per file keyed by path with the size and mtime
+    the block was rendered from. New blocks are written in batches of up to
+    BLOCK_CACHE_FLUSH_BYTES; close() trims the store to max_bytes by evicting
+    the least recently used blocks. Triggers keep the total size of the
+    blocks in the meta table, so that check doesn't sum the table. It is
+    safe to share between the writer threads of a sharded output. Errors
+    disable the cache with a warning.
+    """
+    def __init__(self, root_dir, max_bytes=DEFAULT_BLOCK_CACHE_MB * 1024 * 1024):
+        self.path = os.path.join(root_dir, CACHE_DIR, BLOCK_CACHE_FILE)
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        self.now = int(time.time())
+        self.pending = []
+        self.pending_bytes = 0
+        self.used = []
+        self.db = None
+        import sqlite3
+        self._sqlite3 = sqlite3
+        try:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            self.db = sqlite3.connect(self.path, timeout=30, check_same_thread=False)
+            # Rows replaced by INSERT OR REPLACE only fire the delete trigger with this
+            self.db.execute("PRAGMA recursive_triggers = ON")
+            self.db.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value INTEGER)")
+            self.db.execute("CREATE TABLE IF NOT EXISTS blocks (path TEXT PRIMARY KEY, size INTEGER, "
+                            "mtime_ns INTEGER, hash TEXT, block BLOB, last_used INTEGER)")
+            self.db.execute("CREATE INDEX IF NOT EXISTS blocks_last_used ON blocks (last_used)")
+            self.db.execute("CREATE TRIGGER IF NOT EXISTS blocks_added AFTER INSERT ON blocks BEGIN "
+                            "UPDATE meta SET value = value + LENGTH(NEW.block) WHERE key = 'bytes'; END")
+            self.db.execute("CREATE TRIGGER IF NOT EXISTS blocks_removed AFTER DELETE ON blocks BEGIN "
+                            "UPDATE meta SET value = value - LENGTH(OLD.block) WHERE key = 'bytes'; END")
+            row = self.db.execute("SELECT value FROM meta WHERE key = 'version'").fetchone()
+            if row is None or row[0] != BLOCK_CACHE_VERSION:
+                self.db.execute("DELETE FROM blocks")
+                self.db.execute("INSERT OR REPLACE INTO meta VALUES ('bytes', 0)")
+                self.db.execute("INSERT OR REPLACE INTO meta VALUES ('version', ?)", (BLOCK_CACHE_VERSION,))
+            self.db.commit()
+        except (OSError, sqlite3.Error) as e:
+            self._disable(e)
+
+    def _disable(self, error):
+        print(f"Warning: Block cache disabled: {error}")
+        if self.db is not None:
+            self.db.close()
+        self.db = None
+
+    def entries(self, rel_paths):
+        """
+        Returns {rel_path: [size, mtime_ns, hash]} for the given files that
+        have a cached block.
+        """
+        found = {}
+        if self.db is None:
+            return found
+        keys = {rel_path.replace(os.sep, '/'): rel_path for rel_path in rel_paths}
+        paths = list(keys)
+        try:
+            with self.lock:
+                for i in range(0, len(paths), 500):
+                    batch = paths[i:i + 500]
+                    for path, size, mtime_ns, content_hash in self.db.execute(
+                            f"SELECT path, size, mtime_ns, hash FROM blocks WHERE path IN ({','.join('?' * len(batch))})",
+                            batch):
+                        found[keys[path]] = [size, mtime_ns, content_hash]
+        except self._sqlite3.Error as e:
+            self._disable(e)
+        return found
+
+    def get(self, rel_path, st):
+        """
+        Returns the cached block for a file if it was rendered from the same
+        size and mtime, else None.
+        """
+        if self.db is None:
+            return None
+        path = rel_path.replace(os.sep, '/')
+        try:
+            with self.lock:
+                row = self.db.execute("SELECT block FROM blocks WHERE path = ? AND size = ? AND mtime_ns = ?",
+                                      (path, st.st_size, st.st_mtime_ns)).fetchone()
+                if row is not None:
+                    self.used.append(path)
+        except self._sqlite3.Error as e:
+            self._disable(e)
+            return None
+        return None if row is None else bytes(row[0])
+
+    def get_outline(self, content_hash):
+        """
+        Returns the outline cached for a content hash ('' if the file had
+        none), or None.
+        """
+        if self.db is None:
+            return None
+        key = OUTLINE_CACHE_PREFIX + content_hash
+        try:
+            with self.lock:
+                row = self.db.execute("SELECT block FROM blocks WHERE path = ?", (key,)).fetchone()
+                if row is not None:
+                    self.used.append(key)
+        except self._sqlite3.Error as e:
+            self._disable(e)
+            return None
+        return None if row is None else bytes(row[0]).decode('utf-8')
+
+    def put_outline(self, content_hash, outline):
+        """
+        Queues an extracted outline; outlines share the blocks table (and its
+        size cap) under OUTLINE_CACHE_PREFIX keys.
+        """
+        if self.db is None:
+            return
+        block = outline.encode('utf-8')
+        with self.lock:
+            self.pending.append((OUTLINE_CACHE_PREFIX + content_hash, 0, 0, content_hash, block, self.now))
+            self.pending_bytes += len(block)
+            if self.pending_bytes >= BLOCK_CACHE_FLUSH_BYTES:
+                self._flush()
+
+    def put(self, rel_path, st, content_hash, block):
+        """
+        Queues a freshly rendered block, replacing any older one for the file.
+        """
+        if self.db is None:
+            return
+        with self.lock:
+            self.pending.append((rel_path.replace(os.sep, '/'), st.st_size, st.st_mtime_ns,
+                                 content_hash, block, self.now))
+            self.pending_bytes += len(block)
+            if self.pending_bytes >= BLOCK_CACHE_FLUSH_BYTES:
+                self._flush()
+
+    def _flush(self):
+        self.now = int(time.time())
+        try:
+            self.db.executemany("INSERT OR REPLACE INTO blocks VALUES (?, ?, ?, ?, ?, ?)", self.pending)
+            self.db.executemany("UPDATE blocks SET last_used = ? WHERE path = ?",
+                                [(self.now, path) for path in self.used])
+            self.db.commit()
+        except self._sqlite3.Error as e:
+            self._disable(e)
+        self.pending = []
+        self.pending_bytes = 0
+        self.used = []
+
+    def flush(self):
+        """
+        Writes queued blocks and evicts least recently used blocks while the
+        store is over max_bytes, compacting the file once more than
+        BLOCK_CACHE_VACUUM_SHARE of its pages are free.
+        """
+        if self.db is None:
+            return
+        with self.lock:
+            self._flush()
+            if self.db is None:
+                return
+            try:
+                total = self.db.execute("SELECT value FROM meta WHERE key = 'bytes'").fetchone()[0]
+                if total > self.max_bytes:
+                    evict = []
+                    for path, length in self.db.execute(
+                            "SELECT path, LENGTH(block) FROM blocks ORDER BY last_used, path"):
+                        if total <= self.max_bytes:
+                            break
+                        evict.append((path,))
+                        total -= length
+                    self.db.executemany("DELETE FROM blocks WHERE path = ?", evict)
+                    self.db.commit()
+                    free = self.db.execute("PRAGMA freelist_count").fetchone()[0]
+                    pages = self.db.execute("PRAGMA page_count").fetchone()[0]
+                    if free > pages * BLOCK_CACHE_VACUUM_SHARE:
+                        self.db.execute("VACUUM")
+            except self._sqlite3.Error as e:
+                print(f"Warning: Could not trim block cache: {e}")
+
+    def close(self):
+        """
+        Flushes and closes the store.
+        """
+        self.flush()
+        with self.lock:
+            if self.db is not None:
+                self.db.close()
+                self.db = None
+
+class _ByteBudget:
+    """
+    Bounds the bytes held by prefetched files. Grants are handed out in
+    submission order, so a later file can never hold budget that an earlier
+    file (the one the writer is waiting for) still needs.
+    """
+    def __init__(self, limit):
+        self.limit = limit
+        self.in_use = 0
+        self.next_seq = 0
+        self.closed = False
+        self.cond = threading.Condition()
+
+    def acquire(self, seq, size):
+        with self.cond:
+            while not self.closed and (
+                    seq != self.next_seq or
+                    (self.in_use and self.in_use + size > self.limit)):
+                self.cond.wait()
+            self.next_seq += 1
+            self.in_use += size
+            self.cond.notify_all()
+        return size
+
+    def release(self, size):
+        with self.cond:
+            self.in_use -= size
+            self.cond.notify_all()
+
+    def close(self):
+        with self.cond:
+            self.closed = True
+            self.cond.notify_all()
+
+def read_source_file(abs_path, old=None, budget=None, seq=0, stream_threshold=STREAM_THRESHOLD,
+                     binary_entry=None, known=None, cached=None):
+    """
+    Reader stage for one file. Returns a dict with the file's 'stat', 'data',
+    content 'hash', any 'error', and the budget 'cost' held by its data.
+    'unchanged' is set (and nothing read) when size and mtime still match the
+    manifest entry old, or when they match a known [size, mtime_ns, hash]
+    (from the git index) whose hash equals the manifest's. The first SNIFF_BYTES are checked before anything is
+    decoded: 'binary' holds the reason if the file is binary (or if the cached
+    binary_entry still matches). 'stream' is set (and only the sniff read) for
+    files over stream_threshold, which the writer streams itself. 'cached' is
+    set (and nothing read) when size and mtime match the [size, mtime_ns,
+    hash] of the file's block in the BlockCache.
+    """
+    result = {'stat': None, 'data': None, 'hash': None, 'error': None, 'cost': 0,
+              'unchanged': False, 'stream': False, 'binary': None, 'cached': False}
+    size = 0
+    try:
+        st = result['stat'] = os.stat(abs_path)
+        if old is not None and ([st.st_size, st.st_mtime_ns] == old[:2] or
+                                (known is not None and [st.st_size, st.st_mtime_ns, old[2]] == known)):
+            result['unchanged'] = True
+            result['hash'] = old[2]
+        elif binary_entry is not None and [st.st_size, st.st_mtime_ns] == binary_entry[:2]:
+            result['binary'] = binary_entry[2]
+        elif (cached is not None and [st.st_size, st.st_mtime_ns] == cached[:2] and
+              st.st_size <= stream_threshold):
+            result['cached'] = True
+            result['hash'] = cached[2]
+        elif st.st_size > stream_threshold:
+            result['stream'] = True
+        else:
+            size = st.st_size
+    except OSError as e:
+        result['error'] = e
+    
+    if budget is not None:
+        result['cost'] = budget.acquire(seq, size)
+    if result['error'] is not None or result['unchanged'] or result['binary'] or result['cached']:
+        return result
+    
+    try:
+        with open(abs_path, 'rb') as f:
+            result['stat'] = os.fstat(f.fileno())
+            head = f.read(SNIFF_BYTES)
+            result['binary'] = sniff_binary(head)
+            if result['binary']:
+                result['stream'] = False
+            elif not result['stream']:
+                result['data'] = head + f.read()
+                result['hash'] = hash_content(result['data'])
+    except Exception as e:
+        result['error'] = e
+    return result
+
+def iter_read_files(root_dir, rel_paths, old_files=None, jobs=DEFAULT_JOBS,
+                    max_inflight_bytes=DEFAULT_MAX_INFLIGHT_MB * 1024 * 1024,
+                    stream_threshold=STREAM_THRESHOLD, binary_files=None, known_hashes=None,
+                    cached_files=None):
+    """
+    Yields (rel_path, read_source_file result) in the order of rel_paths.
+    binary_files holds cached sniff results keyed by '/'-separated path,
+    known_hashes trusted hashes from the git index (see scan_git_index),
+    cached_files the BlockCache entries of files with a cached block.
+    With jobs > 1, a thread pool reads up to 2 * jobs files ahead of the
+    consumer while the bytes read but not yet consumed stay under
+    max_inflight_bytes (a single larger file is still read on its own).
+    """
+    old_files = old_files or {}
+    binary_files = binary_files or {}
+    known_hashes = known_hashes or {}
+    cached_files = cached_files or {}
+    
+    if jobs <= 1:
+        for rel_path in rel_paths:
+            yield rel_path, read_source_file(
+                os.path.join(root_dir, rel_path), old_files.get(rel_path),
+                stream_threshold=stream_threshold,
+                binary_entry=binary_files.get(rel_path.replace(os.sep, '/')),
+                known=known_hashes.get(rel_path), cached=cached_files.get(rel_path))
+        return
+    
+    from concurrent.futures import ThreadPoolExecutor
+    budget = _ByteBudget(max_inflight_bytes)
+    pending = deque()
+    executor = ThreadPoolExecutor(max_workers=jobs)
+    try:
+        for seq, rel_path in enumerate(rel_paths):
+            pending.append((rel_path, executor.submit(
+                read_source_file, os.path.join(root_dir, rel_path),
+                old_files.get(rel_path), budget, seq, stream_threshold,
+                binary_files.get(rel_path.replace(os.sep, '/')), known_hashes.get(rel_path),
+                cached_files.get(rel_path))))
+            
+            while len(pending) >= jobs * 2:
+                rel_path, future = pending.popleft()
+                result = future.result()
+                yield rel_path, result
+                budget.release(result['cost'])
+        
+        while pending:
+            rel_path, future = pending.popleft()
+            result = future.result()
+            yield rel_path, result
+            budget.release(result['cost'])
+    finally:
+        budget.close()
+        executor.shutdown(wait=True, cancel_futures=True)
+
+def iter_line_chunks(text):
+    """
+    Splits text into content-defined chunks of whole lines. A rolling hash
+    over the CRC-32s of the last three lines picks the cut points, so a run of
+    lines is cut the same way wherever it appears and an edit only moves the
+    cuts next to it. Chunks are CHUNK_MIN_LINES to CHUNK_MAX_LINES lines long
+    (the last one may be shorter). The hashes are computed with map() and a
+    comprehension, so only the cut points are visited by a Python loop.
+    """
+    lines = text.splitlines(keepends=True)
+    hashes = list(map(zlib.crc32, map(str.encode, lines)))
+    cuts = [i for i, (first, second, third) in enumerate(zip([0, 0] + hashes, [0] + hashes, hashes))
+            if not (first * CHUNK_HASH_BASE_SQUARED + second * CHUNK_HASH_BASE + third) & CHUNK_CUT_MASK]
+    
+    start = 0
+    for i in cuts + [len(lines) - 1]:
+        while i + 1 - start > CHUNK_MAX_LINES:
+            yield ''.join(lines[start:start + CHUNK_MAX_LINES])
+            start += CHUNK_MAX_LINES
+        if i + 1 - start >= CHUNK_MIN_LINES:
+            yield ''.join(lines[start:i + 1])
+            start = i + 1
+    if start < len(lines):
+        yield ''.join(lines[start:])
+
+def chunk_digest(chunk):
+    """
+    Returns the 16-byte digest identifying a chunk, or None if the chunk is
+    too short to be worth a reference or doesn't end with a newline.
+    """
+    if len(chunk) < CHUNK_MIN_BYTES or not chunk.endswith('\n'):
+        return None
+    return hashlib.blake2b(chunk.encode('utf-8'), digest_size=16).digest()
+
+class ChunkCounter:
+    """
+    Counts chunk digests in a count-min sketch: CHUNK_SKETCH_DEPTH rows of
+    CHUNK_SKETCH_WIDTH saturating byte counters, so memory stays fixed however
+    many chunks a repository has. Counts can only be overestimated. Chunks
+    counted more than min_repeats times are the ones worth moving out.
+    """
+    def __init__(self, min_repeats):
+        self.min_repeats = min_repeats
+        self.rows = [bytearray(CHUNK_SKETCH_WIDTH) for _ in range(CHUNK_SKETCH_DEPTH)]
+
+    def _slots(self, digest):
+        return [int.from_bytes(digest[i * 4:i * 4 + 4], 'little') & (CHUNK_SKETCH_WIDTH - 1)
+                for i in range(CHUNK_SKETCH_DEPTH)]
+
+    def add(self, digest):
+        for row, slot in zip(self.rows, self._slots(digest)):
+            if row[slot] < 255:
+                row[slot] += 1
+
+    def is_repeated(self, digest):
+        return min(row[slot] for row, slot in zip(self.rows, self._slots(digest))) > self.min_repeats
+
+class ChunkAppendix:
+    """
+    Rewrites file contents for one output: each chunk the counter reports as
+    repeated is replaced by a one-line reference, and its text is kept once
+    for the "Repeated Chunks" appendix. Chunk texts are spooled to a temporary
+    file, so memory holds at most CHUNK_APPENDIX_MAX small entries.
+    """
+    def __init__(self, counter):
+        self.counter = counter
+        self.chunks = {}  # digest -> [number, spool offset, length, language, places]
+        import tempfile
+        self.spool = tempfile.TemporaryFile()
+        self.spool_size = 0
+        self.references = 0
+        self.bytes_replaced = 0
+
+    def rewrite(self, content, lang=''):
+        pieces = []
+        for chunk in iter_line_chunks(content):
+            digest = chunk_digest(chunk)
+            entry = self.chunks.get(digest) if digest else None
+            if (digest and entry is None and len(self.chunks) < CHUNK_APPENDIX_MAX and
+                    self.counter.is_repeated(digest)):
+                data = chunk.encode('utf-8')
+                entry = self.chunks[digest] = [len(self.chunks) + 1, self.spool_size, len(data), lang, 0]
+                self.spool.write(data)
+                self.spool_size += len(data)
+            if entry is None:
+                pieces.append(chunk)
+                continue
+            entry[4] += 1
+            marker = f"[... {chunk.count(chr(10))} repeated lines, see chunk #{entry[0]} under Repeated Chunks ...]\n"
+            pieces.append(marker)
+            self.references += 1
+            self.bytes_replaced += len(chunk.encode('utf-8')) - len(marker.encode('utf-8'))
+        return ''.join(pieces)
+
+    def write(self, md_file):
+        """
+        Writes the appendix (if any chunk was moved) and returns its size.
+        """
+        if not self.chunks:
+            return 0
+        start = md_file.tell()
+        md_file.write("## 3. Repeated Chunks\n\n".encode('utf-8'))
+        for number, offset, length, lang, places in sorted(self.chunks.values()):
+            md_file.write(f"### Chunk #{number}\n\nUsed in {places} place{'s' if places != 1 else ''}.\n\n```{lang}\n".encode('utf-8'))
+            copy_byte_range(self.spool, md_file, offset, length)
+            md_file.write("```\n\n---\n\n".encode('utf-8'))
+        return md_file.tell() - start
+
+    def close(self):
+        self.spool.close()
+
+def count_chunks(root_dir, rel_paths, min_repeats, jobs=DEFAULT_JOBS,
+                 max_inflight_bytes=DEFAULT_MAX_INFLIGHT_MB * 1024 * 1024,
+                 max_file_bytes=None, use_cache=True):
+    """
+    First pass of --chunk-dedup: reads the files that the writer will render
+    from memory (not streamed or binary ones) through iter_read_files and
+    counts their chunks. Returns the ChunkCounter for write_codebase.
+    """
+    counter = ChunkCounter(min_repeats)
+    stream_threshold = STREAM_THRESHOLD if max_file_bytes is None else min(STREAM_THRESHOLD, max_file_bytes)
+    binary_files = load_binary_cache(root_dir) if use_cache else {}
+    for _, source in iter_read_files(root_dir, rel_paths, jobs=jobs, max_inflight_bytes=max_inflight_bytes,
+                                     stream_threshold=stream_threshold, binary_files=binary_files):
+        if source['data'] is None:
+            continue
+        try:
+            text = decode_text(source['data'])
+        except UnicodeDecodeError:
+            continue
+        for chunk in iter_line_chunks(text):
+            digest = chunk_digest(chunk)
+            if digest:
+                counter.add(digest)
+    return counter
+
+def estimate_tokens_bytes(data):
+    """
+    Estimates tokens as one per BYTES_PER_TOKEN bytes.
+    """
+    return -(-len(data) // BYTES_PER_TOKEN)
+
+def estimate_tokens_words(data):
+    """
+    Estimates tokens by counting words, punctuation bytes and line breaks,
+    which follows BPE tokenizers more closely on code. Only bytes.translate,
+    bytes.split and bytes.count touch the data, so it runs at tens of MB/s.
+    """
+    punctuation = len(data) - len(data.translate(None, PUNCTUATION_BYTES))
+    words = data.translate(PUNCTUATION_TO_SPACE).split()
+    long_words = sum(len(word) // WORD_TOKEN_CHARS for word in words if len(word) > WORD_TOKEN_CHARS)
+    return punctuation + len(words) + long_words + data.count(b'\n')
+
+def estimate_tokens_tiktoken(data):
+    """
+    Counts tokens with tiktoken's cl100k_base encoding (optional dependency).
+    """
+    global _TIKTOKEN_ENCODING
+    if _TIKTOKEN_ENCODING is None:
+        import tiktoken
+        _TIKTOKEN_ENCODING = tiktoken.get_encoding('cl100k_base')
+    return len(_TIKTOKEN_ENCODING.encode(data.decode('utf-8', errors='replace'), disallowed_special=()))
+
+def count_bytes(data):
+    """
+    Counts bytes, for sizing shards when --shard-size is given in bytes.
+    """
+    return len(data)
+
+# Token estimators for --token-budget, by name. Each takes bytes and returns
+# a token count; add an entry here to plug in another tokenizer.
+TOKEN_ESTIMATORS = {
+    'bytes': estimate_tokens_bytes,
+    'words': estimate_tokens_words,
+    'tiktoken': estimate_tokens_tiktoken,
+}
+
+def estimate_file_tokens(abs_path, rel_path, estimator, max_file_bytes=None, binary_entry=None):
+    """
+    Estimates the tokens a file's block takes in the output, heading and
+    fences included (or its bytes, with count_bytes as the estimator). Files
+    over max_file_bytes count up to the cap and binary files count as their
+    note. The bytes estimator and count_bytes work from the file size alone;
+    the others read the file in CHUNK_SIZE pieces.
+    """
+    try:
+        st = os.stat(abs_path)
+        size = st.st_size
+        if binary_entry and binary_entry[:2] == [size, st.st_mtime_ns]:
+            return estimator(format_binary_block(rel_path, binary_entry[2], size).encode('utf-8'))
+        
+        limit = size if max_file_bytes is None else min(size, max_file_bytes)
+        tokens = estimator(format_file_block(abs_path, rel_path, '').encode('utf-8'))
+        if estimator is estimate_tokens_bytes:
+            return tokens - (-limit // BYTES_PER_TOKEN)
+        if estimator is count_bytes:
+            return tokens + limit
+        
+        with open(abs_path, 'rb') as f:
+            chunk = f.read(min(CHUNK_SIZE, limit))
+            reason = sniff_binary(chunk[:SNIFF_BYTES])
+            if reason:
+                return estimator(format_binary_block(rel_path, reason, size).encode('utf-8'))
+            remaining = limit
+            while chunk:
+                tokens += estimator(chunk)
+                remaining -= len(chunk)
+                chunk = f.read(min(CHUNK_SIZE, remaining)) if remaining > 0 else b''
+        return tokens
+    except OSError as e:
+        return estimator(format_error_block(rel_path, e).encode('utf-8'))
+
+def estimate_tree_lines(rel_path, tree_dirs, estimator, tree_stats=False):
+    """
+    Estimates the project tree lines a file adds: its own line plus a line for
+    each of its directories not in tree_dirs, counted without collapsing, so
+    the estimate stays on the high side. Returns (cost, new directories).
+    """
+    parts = rel_path.split(os.sep)
+    stats = TREE_STATS_ALLOWANCE if tree_stats else ''
+    cost = estimator(f"{'│   ' * (len(parts) - 1)}└── {parts[-1]}\n".encode('utf-8'))
+    new_dirs = []
+    for depth in range(1, len(parts)):
+        rel_dir = os.sep.join(parts[:depth])
+        if rel_dir not in tree_dirs:
+            new_dirs.append(rel_dir)
+            cost += estimator(f"{'│   ' * (depth - 1)}├── {parts[depth - 1]}/{stats}\n".encode('utf-8'))
+    return cost, new_dirs
+
+def pack_token_budget(valid_files, root_dir, budget, estimator=DEFAULT_TOKEN_ESTIMATOR,
+                      origins=None, max_file_bytes=None, tree_stats=False, use_cache=True):
+    """
+    Chooses the files whose blocks fit in budget tokens. Files the user listed
+    go first, then files from directories they listed, then the rest; within
+    each group smaller files go first so that as many as possible fit. Each
+    file also pays for the tree lines it adds (see estimate_tree_lines).
+    Prints what was dropped and returns the files to keep.
+    """
+    estimate = TOKEN_ESTIMATORS[estimator]
+    origins = origins or {}
+    binary_files = load_binary_cache(root_dir) if use_cache else {}
+    costs = {}
+    for rel_path in valid_files:
+        costs[rel_path] = estimate_file_tokens(
+            os.path.join(root_dir, rel_path), rel_path, estimate, max_file_bytes,
+            binary_files.get(rel_path.replace(os.sep, '/')))
+    
+    order = sorted(valid_files, key=lambda p: (
+        PACK_PRIORITY.get(origins.get(p), len(PACK_PRIORITY)), costs[p], p))
+    used = estimate((f"# Project Codebase: {os.path.basename(root_dir)}\n\n"
+                     f"{generate_tree([])}## 2. File Contents\n\n").encode('utf-8'))
+    tree_dirs = set()
+    kept = []
+    dropped = []
+    
+    for rel_path in order:
+        tree_cost, new_dirs = estimate_tree_lines(rel_path, tree_dirs, estimate, tree_stats)
+        cost = costs[rel_path] + tree_cost
+        if used + cost <= budget:
+            used += cost
+            kept.append(rel_path)
+            tree_dirs.update(new_dirs)
+        else:
+            dropped.append(rel_path)
+    
+    print(f"\nToken budget: keeping {len(kept)} of {len(valid_files)} files, "
+          f"~{used:,} of {budget:,} tokens ({estimator} estimate).")
+    if dropped:
+        print(f"Dropped {len(dropped)} files (~{sum(costs[p] for p in dropped):,} tokens):")
+        for rel_path in dropped[:10]:  # Show first 10, highest priority first
+            print(f"  - {rel_path} (~{costs[rel_path]:,} tokens)")
+        if len(dropped) > 10:
+            print(f"  ... and {len(dropped) - 10} more")
+    return kept
+
+def write_codebase(output_file, valid_files, root_dir, incremental=False, use_cache=True,
+                   jobs=DEFAULT_JOBS, max_inflight_bytes=DEFAULT_MAX_INFLIGHT_MB * 1024 * 1024,
+                   max_file_bytes=None, oversize='truncate', tree_stats=False, known_hashes=None,
+                   title=None, binary_files=None, dedup=False, chunk_counter=None, block_cache=None,
+                   outline=None):
+    """
+    Writes the markdown file and records where each file's block landed.
+    Files are read by iter_read_files and written in sorted order; files over
+    STREAM_THRESHOLD or max_file_bytes are streamed by write_streamed_block.
+    With incremental=True, blocks of files that are unchanged since the
+    previous run (same size and mtime, or same content hash) are copied
+    byte-for-byte from the previous output instead of being re-rendered.
+    tree_stats adds per-directory file counts and sizes to the tree.
+    known_hashes (from scan_git_index) lets unchanged files be recognised
+    without reading them even when their mtime differs from the manifest.
+    With dedup=True, a file whose content hash matches a file written above it
+    gets a short reference to that file instead of a second copy.
+    With a chunk_counter (from count_chunks), chunks it reports as repeated
+    are moved to a "Repeated Chunks" appendix (see ChunkAppendix); as that
+    depends on every other file, no blocks are reused incrementally.
+    Blocks rendered from memory are kept in a BlockCache, so files unchanged
+    since any earlier run (for any output) are not read again; pass
+    block_cache to share one, otherwise one is opened here if use_cache.
+    title replaces the "Project Codebase: <dir>" heading. A binary_files dict
+    passed in is updated with new sniff results and left for the caller to
+    save; otherwise the cached results are loaded and saved here.
+    Files in the outline set are written as outlines (see extract_outline)
+    where their language has an extractor, unless they are streamed.
+    """
+    options = {'max_file_bytes': max_file_bytes, 'oversize': oversize if max_file_bytes else None}
+    if dedup:
+        options['dedup'] = True
+    outline = set(outline or ())
+    if outline:
+        options['outline'] = hashlib.sha1('\n'.join(sorted(outline)).encode('utf-8')).hexdigest()[:16]
+    if chunk_counter is not None:
+        options['chunk_repeats'] = chunk_counter.min_repeats
+        incremental = False
+    stream_threshold = STREAM_THRESHOLD if max_file_bytes is None else min(STREAM_THRESHOLD, max_file_bytes)
+    
+    previous = None
+    if incremental:
+        previous = load_manifest(root_dir, output_file, options) if use_cache else None
+        if previous is None:
+            print("No usable manifest from a previous run, writing all files.")
+    
+    old_files = previous['files'] if previous else {}
+    old_output = open(output_file, 'rb') if previous else None
+    # Content hash -> first file written with it, and the files whose previous
+    # block was a reference, which can't be reused if they are now the first
+    first_paths = {}
+    old_duplicates = set()
+    if dedup:
+        old_first_paths = {}
+        for rel_path in sorted(old_files):
+            old_hash = old_files[rel_path][2]
+            if old_hash in old_first_paths:
+                old_duplicates.add(rel_path)
+            elif old_hash is not None:
+                old_first_paths[old_hash] = rel_path
+    duplicates = 0
+    duplicate_bytes = 0
+    appendix = ChunkAppendix(chunk_counter) if chunk_counter is not None else None
+    appendix_bytes = 0
+    own_binary_cache = binary_files is None
+    if own_binary_cache:
+        binary_files = load_binary_cache(root_dir) if use_cache else {}
+    binary_changed = False
+    own_block_cache = block_cache is None and use_cache and chunk_counter is None
+    if own_block_cache:
+        block_cache = BlockCache(root_dir)
+    if chunk_counter is not None:
+        block_cache = None  # Rewritten blocks depend on the other files
+    cached_files = {}
+    if block_cache is not None:
+        cached_files = block_cache.entries([rel_path for rel_path in valid_files if rel_path not in outline])
+    entries = {}
+    reused = 0
+    cache_hits = 0
+    tmp_output = output_file + '.tmp'
+    
+    try:
+        with open(tmp_output, 'wb') as md_file:
+            timer = PipelineTimer(_PROFILER) if _PROFILER is not None else None
+            if timer is not None:
+                md_file = timer.output(md_file)
+            title = title or f"Project Codebase: {os.path.basename(root_dir)}"
+            md_file.write(f"# {title}\n\n".encode('utf-8'))
+            
+            # Section 1: Table of Contents / Structure
+            sizes = None
+            if tree_stats:
+                sizes = {}
+                for rel_path in valid_files:
+                    try:
+                        sizes[rel_path] = os.stat(os.path.join(root_dir, rel_path)).st_size
+                    except OSError:
+                        sizes[rel_path] = 0
+            with profile_stage('tree') as stage:
+                tree = generate_tree(valid_files, sizes)
+                stage.files = len(valid_files)
+            md_file.write(tree.encode('utf-8'))
+            
+            # Section 2: File Contents
+            md_file.write("## 2. File Contents\n\n".encode('utf-8'))
+            
+            sources = iter_read_files(root_dir, sorted(valid_files), old_files,
+                                      jobs, max_inflight_bytes, stream_threshold, binary_files,
+                                      known_hashes, cached_files)
+            if timer is not None:
+                sources = timer.sources(sources)
+            for rel_path, source in sources:
+                abs_path = os.path.join(root_dir, rel_path)
+                old = old_files.get(rel_path)
+                offset = md_file.tell()
+                
+                try:
+                    if source['error'] is not None:
+                        raise source['error']
+                    
+                    st = source['stat']
+                    content_hash = source['hash']
+                    cached_block = None
+                    if source['cached'] and not (dedup and content_hash in first_paths):
+                        cached_block = block_cache.get(rel_path, st)
+                    if dedup and content_hash in first_paths:
+                        md_file.write(format_duplicate_block(rel_path, first_paths[content_hash]).encode('utf-8'))
+                        duplicates += 1
+                        duplicate_bytes += st.st_size
+                    elif (old is not None and rel_path not in old_duplicates and
+                          (source['unchanged'] or (content_hash is not None and content_hash == old[2]))):
+                        # Unchanged, or only the mtime changed (touch, checkout)
+                        copy_byte_range(old_output, md_file, old[3], old[4])
+                        reused += 1
+                    elif source['binary']:
+                        binary_entry = [st.st_size, st.st_mtime_ns, source['binary']]
+                        if binary_files.get(rel_path.replace(os.sep, '/')) != binary_entry:
+                            binary_files[rel_path.replace(os.sep, '/')] = binary_entry
+                            binary_changed = True
+                        block = format_binary_block(rel_path, source['binary'], st.st_size)
+                        md_file.write(block.encode('utf-8'))
+                    elif cached_block is not None:
+                        md_file.write(cached_block)
+                        cache_hits += 1
+                    elif source['stream'] or (source['data'] is None and st.st_size > stream_threshold):
+                        # Streamed, or unchanged but its old block can't be reused
+                        st, content_hash = write_streamed_block(md_file, abs_path, rel_path,
+                                                                max_file_bytes, oversize)
+                        if dedup and content_hash in first_paths:
+                            md_file.seek(offset)
+                            md_file.truncate()
+                            md_file.write(format_duplicate_block(rel_path, first_paths[content_hash]).encode('utf-8'))
+                            duplicates += 1
+                            duplicate_bytes += st.st_size
+                    else:
+                        data = source['data']
+                        if data is None:
+                            # Unchanged or cached, but the old block can't be used
+                            with open(abs_path, 'rb') as f:
+                                st = os.fstat(f.fileno())
+                                data = f.read()
+                            content_hash = hash_content(data)
+                        content = decode_text(data)
+                        block = None
+                        if rel_path in outline:
+                            block = render_outline_block(abs_path, rel_path, content, content_hash, block_cache)
+                        if block is not None:
+                            md_file.write(block)
+                        else:
+                            if appendix is not None:
+                                content = appendix.rewrite(content, get_language(abs_path))
+                            block = format_file_block(abs_path, rel_path, content).encode('utf-8')
+                            md_file.write(block)
+                            if block_cache is not None:
+                                block_cache.put(rel_path, st, content_hash, block)
+                    if dedup and content_hash is not None:
+                        first_paths.setdefault(content_hash, rel_path)
+                    entries[rel_path] = [st.st_size, st.st_mtime_ns, content_hash,
+                                         offset, md_file.tell() - offset]
+                except Exception as e:
+                    md_file.seek(offset)
+                    md_file.truncate()
+                    md_file.write(format_error_block(rel_path, e).encode('utf-8'))
+            
+            # Section 3: Chunks moved out by --chunk-dedup
+            if appendix is not None:
+                appendix_bytes = appendix.write(md_file)
+    finally:
+        if old_output:
+            old_output.close()
+        if appendix is not None:
+            appendix.close()
+        if own_block_cache:
+            block_cache.close()
+    
+    os.replace(tmp_output, output_file)
+    if use_cache:
+        with profile_stage('manifest'):
+            save_manifest(root_dir, output_file, entries, options)
+            if binary_changed and own_binary_cache:
+                save_binary_cache(root_dir, binary_files)
+    if previous:
+        print(f"Reused {reused} unchanged blocks, rendered {len(valid_files) - reused} files.")
+    if cache_hits:
+        print(f"Took {cache_hits} blocks from the block cache.")
+    if duplicates:
+        print(f"Replaced {duplicates} duplicate files with references ({format_size(duplicate_bytes)} not repeated).")
+    if appendix is not None and appendix.references:
+        saved = appendix.bytes_replaced - appendix_bytes
+        print(f"Moved {len(appendix.chunks)} repeated chunks to the appendix, replacing "
+              f"{appendix.references} copies ({format_size(saved) + ' saved' if saved > 0 else 'no net saving'}).")
+    return entries
+
+def get_shard_path(output_file, number):
+    """
+    Returns the file name of a shard: PROJECT_CODEBASE.md -> PROJECT_CODEBASE.001.md.
+    """
+    stem, ext = os.path.splitext(output_file)
+    return f"{stem}.{number:03d}{ext or '.md'}"
+
+def get_shard_index_path(output_file):
+    """
+    Returns the file name of the shard index: PROJECT_CODEBASE.index.json.
+    """
+    return f"{os.path.splitext(output_file)[0]}.index.json"
+
+def is_output_name(name):
+    """
+    Tells whether a file name is one of the default outputs: the output file,
+    the shard index, or the temporary file of either. Shards are .md files,
+    which the scan skips anyway.
+    """
+    name = name[:-len('.tmp')] if name.endswith('.tmp') else name
+    return name == OUTPUT_FILE or name == get_shard_index_path(OUTPUT_FILE)
+
+def is_shard_name(name, output_file):
+    """
+    Tells whether a file name is one get_shard_path gives for output_file.
+    """
+    stem, ext = os.path.splitext(os.path.basename(output_file))
+    return re.fullmatch(re.escape(stem) + r'\.\d{3,}' + re.escape(ext or '.md'), name) is not None
+
+def split_into_shards(valid_files, root_dir, shard_size, unit='bytes', estimator=DEFAULT_TOKEN_ESTIMATOR,
+                      max_file_bytes=None, tree_stats=False, use_cache=True):
+    """
+    Splits the files, in output order, into runs whose blocks, tree lines and
+    headings stay under shard_size bytes or tokens (estimated as for
+    --token-budget). A file larger than shard_size gets a shard of its own.
+    """
+    estimate = count_bytes if unit == 'bytes' else TOKEN_ESTIMATORS[estimator]
+    binary_files = load_binary_cache(root_dir) if use_cache else {}
+    heading = estimate((f"# Project Codebase: {os.path.basename(root_dir)} (part 999 of 999)\n\n"
+                        f"{generate_tree([])}## 2. File Contents\n\n").encode('utf-8'))
+    shards = []
+    used = 0
+    tree_dirs = set()
+    
+    for rel_path in sorted(valid_files):
+        cost = estimate_file_tokens(os.path.join(root_dir, rel_path), rel_path, estimate,
+                                    max_file_bytes, binary_files.get(rel_path.replace(os.sep, '/')))
+        tree_cost, new_dirs = estimate_tree_lines(rel_path, tree_dirs, estimate, tree_stats)
+        if not shards or used + cost + tree_cost > shard_size and shards[-1]:
+            shards.append([])
+            used = heading
+            tree_dirs = set()
+            tree_cost, new_dirs = estimate_tree_lines(rel_path, tree_dirs, estimate, tree_stats)
+        shards[-1].append(rel_path)
+        used += cost + tree_cost
+        tree_dirs.update(new_dirs)
+    return shards
+
+def write_sharded_codebase(output_file, valid_files, root_dir, shard_size, shard_unit='bytes',
+                           estimator=DEFAULT_TOKEN_ESTIMATOR, incremental=False, use_cache=True,
+                           jobs=DEFAULT_JOBS, max_inflight_bytes=DEFAULT_MAX_INFLIGHT_MB * 1024 * 1024,
+                           max_file_bytes=None, oversize='truncate', tree_stats=False, known_hashes=None,
+                           dedup=False, chunk_counter=None, block_cache=None, outline=None):
+    """
+    Writes the output as numbered shards (see get_shard_path), each with its
+    own heading, partial tree and file blocks, plus a JSON index mapping each
+    file to its shard, offset and length. Shards are written concurrently by
+    up to jobs write_codebase workers, which split the reader threads and the
+    in-flight byte cap between them. Shards left over from a previous run with
+    more of them are removed. With dedup, duplicates are replaced within each
+    shard, so every shard stays readable on its own; likewise each shard gets
+    its own appendix of repeated chunks. The workers share one BlockCache.
+    Files in the outline set are written as outlines. Returns the index.
+    """
+    shards = split_into_shards(valid_files, root_dir, shard_size, shard_unit, estimator,
+                               max_file_bytes, tree_stats, use_cache)
+    shard_paths = [get_shard_path(output_file, number) for number in range(1, len(shards) + 1)]
+    binary_files = load_binary_cache(root_dir) if use_cache else {}
+    cached_binary_files = dict(binary_files)
+    own_block_cache = block_cache is None and use_cache and chunk_counter is None
+    if own_block_cache:
+        block_cache = BlockCache(root_dir)
+    workers = min(jobs, len(shards))
+    
+    def write_shard(number):
+        return write_codebase(
+            shard_paths[number], shards[number], root_dir, incremental, use_cache,
+            max(1, jobs // workers), max_inflight_bytes // workers, max_file_bytes, oversize,
+            tree_stats, known_hashes,
+            title=f"Project Codebase: {os.path.basename(root_dir)} (part {number + 1} of {len(shards)})",
+            binary_files=binary_files, dedup=dedup, chunk_counter=chunk_counter,
+            block_cache=block_cache, outline=outline)
+    
+    from concurrent.futures import ThreadPoolExecutor
+    try:
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            results = list(executor.map(write_shard, range(len(shards))))
+    finally:
+        if own_block_cache:
+            block_cache.close()
+    
+    index = {'version': SHARD_INDEX_VERSION, 'shards': [], 'files': {}}
+    for shard_path, entries in zip(shard_paths, results):
+        shard_name = os.path.basename(shard_path)
+        index['shards'].append({'file': shard_name, 'files': len(entries),
+                                'bytes': os.path.getsize(shard_path)})
+        for rel_path, entry in entries.items():
+            index['files'][rel_path.replace(os.sep, '/')] = {
+                'shard': shard_name, 'offset': entry[3], 'length': entry[4]}
+    
+    index_path = get_shard_index_path(output_file)
+    try:
+        with open(index_path, 'r', encoding='utf-8') as f:
+            previous = json.load(f)
+        stale = {shard['file'] for shard in previous.get('shards', [])}
+    except (OSError, ValueError, AttributeError, TypeError, KeyError):
+        stale = set()
+    for shard_name in stale - {shard['file'] for shard in index['shards']}:
+        # Only ever delete our own shards, whatever the old index says
+        if not isinstance(shard_name, str) or not is_shard_name(shard_name, output_file):
+            continue
+        stale_path = os.path.join(os.path.dirname(index_path), shard_name)
+        if os.path.isfile(stale_path):
+            os.remove(stale_path)
+    
+    tmp_path = index_path + '.tmp'
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(index, f, indent=2)
+    os.replace(tmp_path, index_path)
+    
+    if use_cache and binary_files != cached_binary_files:
+        save_binary_cache(root_dir, binary_files)
+    return index
+
+def iter_files(root_dir, paths=None, use_cache=True):
+    """
+    Library API: yields the relative paths of the files to include, lazily
+    and in no particular order (main() sorts them). Without paths, every
+    file a --scan finds; with paths (e.g. from parse_file_paths_from_text),
+    the files they expand to, as with --input but without printing notes.
+    """
+    if paths is not None:
+        yield from iter_expanded_paths(paths, root_dir, use_cache, verbose=False)
+        return
+    for rel_path, _ in iter_scan_files(root_dir, load_gitignore(root_dir)):
+        yield rel_path
+
+def iter_blocks(files, root_dir, jobs=DEFAULT_JOBS, max_inflight_bytes=DEFAULT_MAX_INFLIGHT_MB * 1024 * 1024,
+                max_file_bytes=None, oversize='truncate'):
+    """
+    Library API: yields (rel_path, chunk) pairs with the markdown block of
+    each of files, in their order, as main() writes it. files can be any
+    iterable; iter_read_files reads ahead within max_inflight_bytes. Blocks
+    of files over STREAM_THRESHOLD or max_file_bytes come as several
+    consecutive chunks of about CHUNK_SIZE, so memory stays bounded whatever
+    the input, and each such file is read once. As a block can't be taken
+    back once partly sent, one whose file stops decoding part way through
+    (its head was sniffed as text) is closed with an error note where
+    main() writes the note alone.
+    """
+    stream_threshold = STREAM_THRESHOLD if max_file_bytes is None else min(STREAM_THRESHOLD, max_file_bytes)
+    for rel_path, source in iter_read_files(root_dir, files, jobs=jobs, max_inflight_bytes=max_inflight_bytes,
+                                            stream_threshold=stream_threshold):
+        abs_path = os.path.join(root_dir, rel_path)
+        try:
+            if source['error'] is not None:
+                raise source['error']
+            if source['binary']:
+                block = format_binary_block(rel_path, source['binary'], source['stat'].st_size)
+            elif source['stream']:
+                block = None
+            else:
+                block = format_file_block(abs_path, rel_path, decode_text(source['data']))
+        except Exception as e:
+            block = format_error_block(rel_path, e)
+        
+        if block is not None:
+            yield rel_path, block.encode('utf-8')
+            continue
+        sent = False
+        try:
+            for chunk in iter_streamed_block(abs_path, rel_path, max_file_bytes, oversize):
+                yield rel_path, chunk
+                sent = True
+        except Exception as e:
+            note = format_error_block(rel_path, e)
+            yield rel_path, (f"\n```\n\n{note}" if sent else note).encode('utf-8')
+
+def render(blocks, sink, root_dir, files=None, title=None):
+    """
+    Library API: writes the document main() produces to sink, which is a
+    binary file-like object (a gzip file, an upload stream, ...) or a
+    callable taking bytes. The chunks come from blocks (see iter_blocks);
+    the project tree is only included if files, the list of all paths, is
+    given. Returns the number of bytes written.
+    """
+    write = sink.write if hasattr(sink, 'write') else sink
+    title = title or f"Project Codebase: {os.path.basename(root_dir)}"
+    head = f"# {title}\n\n"
+    if files is not None:
+        head += generate_tree(files)
+    head += "## 2. File Contents\n\n"
+    write(head.encode('utf-8'))
+    written = len(head.encode('utf-8'))
+    for _, chunk in blocks:
+        write(chunk)
+        written += len(chunk)
+    return written
+
+def get_daemon_socket_path(root_dir):
+    """
+    Returns where the --serve daemon for a project listens.
+    """
+    return os.path.join(root_dir, CACHE_DIR, DAEMON_SOCKET)
+
+def affects_file_list(name):
+    """
+    Tells whether a created, deleted or renamed entry can change what the
+    scan finds: outputs, their temporary files and ignored extensions can't.
+    """
+    return not is_output_name(name) and os.path.splitext(name)[1].lower() not in IGNORED_EXTENSIONS
+
+class FileWatcher:
+    """
+    Watches a project for changes to its file list or ignore rules and calls
+    on_change(rel_path), with None when it can't tell what changed. Uses
+    inotify (through ctypes, Linux only) with one watch per directory that
+    isn't ignored; elsewhere, or if inotify fails, it polls directory and
+    .gitignore mtimes every poll_interval seconds and relists only the
+    directories whose mtime moved.
+    """
+    def __init__(self, root_dir, on_change, poll_interval=DAEMON_POLL_SECONDS, use_inotify=True):
+        self.root_dir = root_dir
+        self.on_change = on_change
+        self.poll_interval = poll_interval
+        self.stopped = threading.Event()
+        self.fd = None
+        self.watches = {}  # watch descriptor -> rel_dir
+        self.mode = 'polling'
+        if use_inotify:
+            try:
+                self._init_inotify()
+                self.mode = 'inotify'
+            except (OSError, AttributeError, TypeError):
+                self.fd = None
+        self.thread = threading.Thread(target=self._run_inotify if self.fd is not None else self._run_polling,
+                                       daemon=True)
+
+    def start(self):
+        self.thread.start()
+
+    def stop(self):
+        self.stopped.set()
+        self.thread.join()
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+
+    def _iter_dirs(self, rel_dir=''):
+        matcher = GitIgnoreMatcher(self.root_dir)
+        stack = [rel_dir]
+        while stack:
+            rel_dir = stack.pop()
+            yield rel_dir
+            try:
+                with os.scandir(os.path.join(self.root_dir, rel_dir)) as it:
+                    entries = list(it)
+            except OSError:
+                continue
+            for entry in entries:
+                if entry.name in IGNORED_DIRS or not entry.is_dir(follow_symlinks=False):
+                    continue
+                child = f"{rel_dir}/{entry.name}" if rel_dir else entry.name
+                if not matcher.is_dir_ignored(child):
+                    stack.append(child)
+
+    def _init_inotify(self):
+        import ctypes
+        import ctypes.util
+        self.libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        fd = self.libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if fd < 0:
+            raise OSError(ctypes.get_errno(), 'inotify_init1 failed')
+        self.fd = fd
+        for rel_dir in self._iter_dirs():
+            self._add_watch(rel_dir)
+        # .git/info/exclude lives in an ignored directory
+        info_dir = os.path.join(self.root_dir, '.git', 'info')
+        if os.path.isdir(info_dir):
+            self._add_watch('.git/info')
+
+    def _add_watch(self, rel_dir):
+        path = os.path.join(self.root_dir, rel_dir) if rel_dir else self.root_dir
+        wd = self.libc.inotify_add_watch(self.fd, os.fsencode(path), INOTIFY_MASK)
+        if wd >= 0:
+            self.watches[wd] = rel_dir
+
+    def _run_inotify(self):
+        pending = b''
+        while not self.stopped.is_set():
+            try:
+                pending += os.read(self.fd, 65536)
+            except BlockingIOError:
+                self.stopped.wait(0.05)
+                continue
+            except OSError:
+                break
+            while len(pending) >= 16:
+                wd, mask, _, length = struct.unpack_from('iIII', pending)
+                if len(pending) < 16 + length:
+                    break
+                name = os.fsdecode(pending[16:16 + length].rstrip(b'\0'))
+                pending = pending[16 + length:]
+                self._inotify_event(wd, mask, name)
+
+    def _inotify_event(self, wd, mask, name):
+        if mask & IN_Q_OVERFLOW:
+            self.on_change(None)
+            return
+        rel_dir = self.watches.get(wd)
+        if rel_dir is None:
+            return
+        rel_path = f"{rel_dir}/{name}" if rel_dir and name else (name or rel_dir)
+        if mask & (0x002 | 0x004 | 0x008):  # IN_MODIFY, IN_ATTRIB, IN_CLOSE_WRITE
+            if name in ('.gitignore', 'exclude'):
+                self.on_change(rel_path)
+            return
+        if mask & IN_ISDIR:
+            if name in IGNORED_DIRS:
+                return
+            if mask & (0x100 | 0x080):  # IN_CREATE, IN_MOVED_TO: watch the new tree too
+                for child in self._iter_dirs(rel_path):
+                    self._add_watch(child)
+            self.on_change(rel_path)
+        elif not name or affects_file_list(name) or name == '.gitignore':
+            self.on_change(rel_path)
+
+    def _snapshot_dir(self, rel_dir):
+        path = os.path.join(self.root_dir, rel_dir) if rel_dir else self.root_dir
+        try:
+            mtime_ns = os.stat(path).st_mtime_ns
+            gitignore = os.stat(os.path.join(path, '.gitignore')).st_mtime_ns
+        except FileNotFoundError:
+            gitignore = None
+        except OSError:
+            return None
+        return mtime_ns, gitignore
+
+    def _list_dir(self, rel_dir):
+        try:
+            return frozenset(name for name in os.listdir(os.path.join(self.root_dir, rel_dir) if rel_dir else self.root_dir)
+                             if name not in IGNORED_DIRS and affects_file_list(name))
+        except OSError:
+            return None
+
+    def _run_polling(self):
+        dirs = {rel_dir: (self._snapshot_dir(rel_dir), self._list_dir(rel_dir)) for rel_dir in self._iter_dirs()}
+        exclude_path = os.path.join(self.root_dir, '.git', 'info', 'exclude')
+        exclude = os.stat(exclude_path).st_mtime_ns if os.path.exists(exclude_path) else None
+        while not self.stopped.wait(self.poll_interval):
+            changed = None
+            current = os.stat(exclude_path).st_mtime_ns if os.path.exists(exclude_path) else None
+            if current != exclude:
+                exclude = current
+                changed = '.git/info/exclude'
+            for rel_dir, (snapshot, names) in list(dirs.items()):
+                new_snapshot = self._snapshot_dir(rel_dir)
+                if new_snapshot == snapshot:
+                    continue
+                new_names = self._list_dir(rel_dir)
+                dirs[rel_dir] = (new_snapshot, new_names)
+                if new_snapshot is None or snapshot is None or new_snapshot[1] != snapshot[1]:
+                    changed = f"{rel_dir}/.gitignore" if rel_dir else '.gitignore'
+                elif new_names != names and changed is None:
+                    changed = rel_dir
+            if changed is not None:
+                # Pick up new directories and forget removed ones
+                known = dirs
+                dirs = {rel_dir: known.get(rel_dir) or (self._snapshot_dir(rel_dir), self._list_dir(rel_dir))
+                        for rel_dir in self._iter_dirs()}
+                self.on_change(changed)
+
+def handle_daemon_request(conn, root_dir, block_cache):
+    """
+    Serves one request on an accepted connection: runs main() with the
+    client's arguments, capturing what it prints, and sends back the output
+    and exit status.
+    """
+    data = b''
+    while not data.endswith(b'\n'):
+        chunk = conn.recv(65536)
+        if not chunk:
+            return
+        data += chunk
+    try:
+        request = json.loads(data)
+        argv = [str(arg) for arg in request['argv']]
+        same_root = os.path.realpath(request.get('cwd', '')) == os.path.realpath(root_dir)
+    except (ValueError, KeyError, TypeError):
+        return
+    if not same_root:
+        conn.sendall(json.dumps({'fallback': True}).encode('utf-8') + b'\n')
+        return
+    
+    import contextlib
+    output = io.StringIO()
+    status = 0
+    with contextlib.redirect_stdout(output), contextlib.redirect_stderr(output):
+        try:
+            main(argv, block_cache=block_cache)
+        except SystemExit as e:
+            status = e.code if isinstance(e.code, int) else (0 if e.code is None else 1)
+        except Exception as e:
+            print(f"Error: {e}")
+            status = 1
+    conn.sendall(json.dumps({'output': output.getvalue(), 'status': status}).encode('utf-8') + b'\n')
+
+def serve(root_dir, poll_interval=DAEMON_POLL_SECONDS, use_inotify=True, stop_event=None, ready_event=None):
+    """
+    Runs the --serve daemon: keeps the file list, ignore matcher, path index
+    and block cache of root_dir in memory, drops them when the FileWatcher
+    reports a change, and answers requests (see penetrate_client.forward) one at a
+    time on a Unix socket until interrupted, terminated or stop_event is set.
+    """
+    import signal
+    import socket
+    socket_path = get_daemon_socket_path(root_dir)
+    os.makedirs(os.path.dirname(socket_path), exist_ok=True)
+    if os.path.exists(socket_path):
+        probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            probe.connect(socket_path)
+            print(f"A daemon is already serving {root_dir}.")
+            return
+        except OSError:
+            os.remove(socket_path)  # Left behind by a daemon that died
+        finally:
+            probe.close()
+    
+    if stop_event is None:
+        stop_event = threading.Event()
+    if threading.current_thread() is threading.main_thread():
+        signal.signal(signal.SIGTERM, lambda signum, frame: stop_event.set())
+    
+    hot = _HOT_STATE[root_dir] = {'generation': 0}
+    
+    def on_change(rel_path):
+        hot['generation'] += 1
+        hot.pop('files', None)
+        _PATH_INDEXES.pop(root_dir, None)
+        if rel_path is None or os.path.basename(rel_path) in ('.gitignore', 'exclude'):
+            hot.pop('matcher', None)
+    
+    watcher = FileWatcher(root_dir, on_change, poll_interval, use_inotify)
+    watcher.start()
+    block_cache = BlockCache(root_dir)
+    server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        server.bind(socket_path)
+        server.listen(8)
+        server.settimeout(0.2)
+        print(f"Serving {root_dir} on {socket_path} (watching with {watcher.mode}). Press Ctrl+C to stop.")
+        if ready_event is not None:
+            ready_event.set()
+        while not stop_event.is_set():
+            try:
+                conn, _ = server.accept()
+            except socket.timeout:
+                continue
+            with conn:
+                conn.settimeout(None)
+                try:
+                    handle_daemon_request(conn, root_dir, block_cache)
+                except OSError as e:
+                    print(f"Warning: Request failed: {e}")
+    except KeyboardInterrupt:
+        print("\nStopping daemon.")
+    finally:
+        server.close()
+        if os.path.exists(socket_path):
+            os.remove(socket_path)
+        watcher.stop()
+        block_cache.close()
+        _HOT_STATE.pop(root_dir, None)
+        _PATH_INDEXES.pop(root_dir, None)
+
+def read_from_file(filename):
+    """
+    Reads file list from a file.
+    """
+    try:
+        with open(filename, 'r', encoding='utf-8') as f:
+            return f.read()
+    except FileNotFoundError:
+        print(f"Error: File '{filename}' not found.")
+        sys.exit(1)
+    except Exception as e:
+        print(f"Error reading file '{filename}': {e}")
+        sys.exit(1)
+
+def get_user_input():
+    """
+    Gets user input for file selection mode.
+    """
+    print("\n" + "="*60)
+    print("PROJECT CODEBASE GENERATOR")
+    print("="*60)
+    print("\nChoose mode:")
+    print("1. Scan all files (default behavior)")
+    print("2. Provide custom list of files/directories")
+    
+    while True:
+        choice = input("\nEnter choice (1 or 2): ").strip()
+        if choice in ['1', '2', '']:
+            break
+        print("Invalid choice. Please enter 1 or 2.")
+    
+    if choice == '1' or choice == '':
+        return None
     
     # Mode 2: Get custom file list
     print("\n" + "-"*60)
@@ -521,33 +4172,17 @@ def get_user_input():
     user_text = '\n'.join(lines)
     return user_text
 
-def main():
-    parser = argparse.ArgumentParser(
-        description='Generate a markdown file containing project structure and file contents.',
-        formatter_class=argparse.RawDescriptionHelpFormatter,
-        epilog="""
-Examples:
-  %(prog)s                     # Interactive mode
-  %(prog)s --scan              # Scan all files
-  %(prog)s --input list.txt    # Read file list from list.txt
-  %(prog)s -o output.md        # Specify output file
-        """
-    )
-    
-    parser.add_argument('--scan', action='store_true', 
-                       help='Scan all files (skip interactive mode)')
-    parser.add_argument('--input', '-i', type=str,
-                       help='Read file/directory list from a file')
-    parser.add_argument('--output', '-o', type=str, default=OUTPUT_FILE,
-                       help=f'Output file name (default: {OUTPUT_FILE})')
-    
-    args = parser.parse_args()
-    
-    root_dir = os.getcwd()
+def run(args, root_dir, block_cache=None):
+    """
+    Generates the output for parsed command line arguments (see main).
+    """
     output_file = args.output  # Use local variable instead of modifying global
     
     # Determine input mode
-    if args.input:
+    if args.query:
+        # The query picks the files
+        user_input = None
+    elif args.input:
         # Read from file
         print(f"Reading file list from: {args.input}")
         user_input = read_from_file(args.input)
@@ -558,27 +4193,57 @@ Examples:
         # Interactive mode
         user_input = get_user_input()
     
-    if user_input is None:
-        # Mode 1: Scan all files
-        valid_files = scan_all_files(root_dir)
-    else:
+    known_hashes = {}
+    origins = {}
+    user_paths = []
+    if args.query:
+        # Mode 3: Rank project files against the query
+        print(f"\nSearching for: {args.query}")
+        with profile_stage('search') as stage:
+            user_paths = search_project(args.query, root_dir, args.query_limit, args.source,
+                                        use_cache=not args.no_cache)
+            stage.files = len(user_paths)
+        if not user_paths:
+            print("No files match the query.")
+            return
+    elif user_input is not None:
         # Mode 2: Parse user input and expand paths
         print("\nParsing file paths from your input...")
-        user_paths = parse_file_paths_from_text(user_input)
+        with profile_stage('parse') as stage:
+            user_paths = parse_file_paths_from_text(user_input)
+            stage.files = len(user_paths)
+            stage.nbytes = len(user_input.encode('utf-8'))
         
         if not user_paths:
             print("No valid file paths found in your input.")
             print("Falling back to scanning all files...")
-            valid_files = scan_all_files(root_dir)
         else:
             print(f"\nFound {len(user_paths)} unique paths:")
             for path in sorted(user_paths)[:10]:  # Show first 10
                 print(f"  - {path}")
             if len(user_paths) > 10:
                 print(f"  ... and {len(user_paths) - 10} more")
-            
-            print("\nExpanding directories and finding files...")
-            valid_files = expand_user_paths(user_paths, root_dir)
+    
+    if not user_paths:
+        # Mode 1: Scan all files
+        with profile_stage('enumerate') as stage:
+            valid_files = scan_project_files(root_dir, args.source, known_hashes)
+            stage.files = len(valid_files)
+    else:
+        print("\nExpanding directories and finding files...")
+        with profile_stage('expand') as stage:
+            valid_files = expand_user_paths(user_paths, root_dir, use_cache=not args.no_cache,
+                                            origins=origins)
+            stage.files = len(valid_files)
+        
+        if args.follow_imports:
+            print(f"\nFollowing imports ({args.follow_imports} levels deep)...")
+            with profile_stage('imports') as stage:
+                count = len(valid_files)
+                valid_files = follow_imports(valid_files, root_dir, args.follow_imports,
+                                             use_cache=not args.no_cache, origins=origins)
+                stage.files = len(valid_files) - count
+            print(f"Added {len(valid_files) - count} imported files")
     
     print(f"\nTotal files to process: {len(valid_files)}")
     
@@ -586,22 +4251,208 @@ Examples:
         print("No files found to process.")
         return
     
-    # Write the Markdown file
-    with open(output_file, 'w', encoding='utf-8') as md_file:
-        md_file.write(f"# Project Codebase: {os.path.basename(root_dir)}\n\n")
-        
-        # Section 1: Table of Contents / Structure
-        md_file.write(generate_tree(valid_files))
-        
-        # Section 2: File Contents
-        md_file.write("## 2. File Contents\n\n")
+    if args.token_budget is not None:
+        with profile_stage('pack') as stage:
+            valid_files = pack_token_budget(valid_files, root_dir, args.token_budget, args.tokenizer,
+                                            origins, args.max_file_bytes, args.tree_stats,
+                                            use_cache=not args.no_cache)
+            stage.files = len(valid_files)
+        if not valid_files:
+            print("No files fit in the token budget.")
+            return
+    
+    chunk_counter = None
+    if args.chunk_dedup is not None:
+        print("\nCounting repeated chunks...")
+        with profile_stage('chunks') as stage:
+            chunk_counter = count_chunks(root_dir, sorted(valid_files), args.chunk_dedup, args.jobs,
+                                         args.max_inflight_mb * 1024 * 1024, args.max_file_bytes,
+                                         use_cache=not args.no_cache)
+            stage.files = len(valid_files)
+    
+    outline = None
+    if args.outline == 'all':
+        outline = set(valid_files)
+    elif args.outline == 'unlisted':
+        outline = {rel_path for rel_path in valid_files if origins.get(rel_path) != 'listed'}
+    
+    own_block_cache = block_cache is None and not args.no_cache and chunk_counter is None
+    if own_block_cache:
+        block_cache = BlockCache(root_dir, args.cache_max_mb * 1024 * 1024)
+    elif args.no_cache or chunk_counter is not None:
+        block_cache = None
+    try:
+        if args.shard_size:
+            shard_size, shard_unit = args.shard_size
+            index = write_sharded_codebase(
+                output_file, valid_files, root_dir, shard_size, shard_unit, args.tokenizer,
+                incremental=args.incremental, use_cache=not args.no_cache,
+                jobs=args.jobs, max_inflight_bytes=args.max_inflight_mb * 1024 * 1024,
+                max_file_bytes=args.max_file_bytes, oversize=args.oversize,
+                tree_stats=args.tree_stats, known_hashes=known_hashes, dedup=args.dedup,
+                chunk_counter=chunk_counter, block_cache=block_cache, outline=outline)
+            print(f"\nSuccessfully generated {len(index['shards'])} shards, "
+                  f"indexed in: {get_shard_index_path(output_file)}")
+            return
         
-        for rel_path in sorted(valid_files):
-            abs_path = os.path.join(root_dir, rel_path)
-            content_block = get_file_content(abs_path, rel_path)
-            md_file.write(content_block)
-            
+        # Write the Markdown file
+        write_codebase(output_file, valid_files, root_dir,
+                       incremental=args.incremental, use_cache=not args.no_cache,
+                       jobs=args.jobs, max_inflight_bytes=args.max_inflight_mb * 1024 * 1024,
+                       max_file_bytes=args.max_file_bytes, oversize=args.oversize,
+                       tree_stats=args.tree_stats, known_hashes=known_hashes, dedup=args.dedup,
+                       chunk_counter=chunk_counter, block_cache=block_cache, outline=outline)
+    finally:
+        if own_block_cache:
+            block_cache.close()
+        elif block_cache is not None:
+            block_cache.flush()
+    
     print(f"\nSuccessfully generated: {output_file}")
 
+def main(argv=None, block_cache=None):
+    """
+    Runs the command line. argv defaults to sys.argv[1:]; the --serve daemon
+    passes each client's arguments and its long-lived block_cache.
+    """
+    import argparse
+    parser = argparse.ArgumentParser(
+        description='Generate a markdown file containing project structure and file contents.',
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+        epilog="""
+Examples:
+  %(prog)s                     # Interactive mode
+  %(prog)s --scan              # Scan all files
+  %(prog)s --input list.txt    # Read file list from list.txt
+  %(prog)s -o output.md        # Specify output file
+  %(prog)s --scan --incremental   # Only re-read files changed since the last run
+  %(prog)s --scan --source git-index   # List tracked files from .git/index
+  %(prog)s --query "wordpress publishing retries"   # The 20 files that best match the query
+  %(prog)s -i list.txt --token-budget 100000   # Listed files first, up to ~100k tokens
+  %(prog)s -i list.txt --follow-imports 2   # Listed files plus what they import, two levels deep
+  %(prog)s -i list.txt --outline   # Listed files in full, files from directories as outlines
+  %(prog)s --scan --shard-size 20MB   # PROJECT_CODEBASE.001.md, .002.md, ... and an index
+  %(prog)s --serve             # Keep the project hot; run penetrate_client.py for instant dumps
+        """
+    )
+    
+    parser.add_argument('--scan', action='store_true', 
+                       help='Scan all files (skip interactive mode)')
+    parser.add_argument('--input', '-i', type=str,
+                       help='Read file/directory list from a file')
+    parser.add_argument('--query', '-q', type=str, metavar='TEXT',
+                       help='Pick the files most relevant to TEXT (ranked with BM25 over identifiers, '
+                            f'path parts and comments, indexed in {CACHE_DIR}/cache) instead of listing them')
+    parser.add_argument('--query-limit', type=int, default=DEFAULT_QUERY_LIMIT, metavar='N',
+                       help=f'How many files --query picks (default: {DEFAULT_QUERY_LIMIT})')
+    parser.add_argument('--source', choices=FILE_SOURCES, default='walk',
+                       help='Where --scan gets the file list: walk the tree (default) '
+                            'or read the tracked files from .git/index')
+    parser.add_argument('--output', '-o', type=str, default=OUTPUT_FILE,
+                       help=f'Output file name (default: {OUTPUT_FILE})')
+    parser.add_argument('--incremental', action='store_true',
+                       help='Reuse blocks of unchanged files from the previous output')
+    parser.add_argument('--jobs', '-j', type=int, default=DEFAULT_JOBS,
+                       help=f'Number of threads reading files ahead of the writer (default: {DEFAULT_JOBS})')
+    parser.add_argument('--max-inflight-mb', type=int, default=DEFAULT_MAX_INFLIGHT_MB,
+                       help=f'Cap on file data read ahead of the writer, in MB (default: {DEFAULT_MAX_INFLIGHT_MB})')
+    parser.add_argument('--max-file-bytes', type=parse_size,
+                       help='Size cap per file, e.g. 500K or 10MB (default: no cap)')
+    parser.add_argument('--oversize', choices=OVERSIZE_POLICIES, default='truncate',
+                       help='What to do with files over --max-file-bytes (default: truncate)')
+    parser.add_argument('--tree-stats', action='store_true',
+                       help='Show file counts and sizes per directory in the project tree')
+    parser.add_argument('--follow-imports', type=int, default=0, metavar='DEPTH',
+                       help='Also include the files that listed files import (JS/TS with tsconfig path '
+                            'aliases, Python, PHP), following imports up to DEPTH levels (default: 0)')
+    parser.add_argument('--token-budget', type=int,
+                       help='Only include as many files as fit in this many tokens, '
+                            'files named in the input first (default: no budget)')
+    parser.add_argument('--tokenizer', choices=sorted(TOKEN_ESTIMATORS), default=DEFAULT_TOKEN_ESTIMATOR,
+                       help=f'How --token-budget and --shard-size count tokens: bytes/{BYTES_PER_TOKEN}, a '
+                            f'word/punctuation count, or tiktoken if installed (default: {DEFAULT_TOKEN_ESTIMATOR})')
+    parser.add_argument('--shard-size', type=parse_shard_size,
+                       help='Split the output into numbered shards of at most this size, in bytes '
+                            '(e.g. 20MB) or tokens with a t suffix (e.g. 200kt), plus a JSON index')
+    parser.add_argument('--dedup', action='store_true',
+                       help='Write files with identical content once and refer back to them')
+    parser.add_argument('--chunk-dedup', type=int, metavar='K',
+                       help='Move chunks of lines repeated more than K times (license headers, '
+                            'import preambles) into an appendix and reference them inline')
+    parser.add_argument('--outline', nargs='?', const='unlisted', choices=OUTLINE_MODES,
+                       help='Write Python, JS/TS and PHP files as outlines (signatures, exports and '
+                            'docstrings): files not named in the input (default), or all files')
+    parser.add_argument('--cache-max-mb', type=int, default=DEFAULT_BLOCK_CACHE_MB,
+                       help=f'Size cap of the rendered-block cache in {CACHE_DIR}/cache, in MB '
+                            f'(default: {DEFAULT_BLOCK_CACHE_MB})')
+    parser.add_argument('--no-cache', action='store_true',
+                       help=f'Do not read or write the {CACHE_DIR}/ cache directory')
+    parser.add_argument('--serve', action='store_true',
+                       help=f'Run a daemon that keeps the file list and caches in memory and serves '
+                            f'penetrate_client.py over {CACHE_DIR}/{DAEMON_SOCKET}')
+    parser.add_argument('--poll', action='store_true',
+                       help='With --serve, poll for changes instead of using inotify')
+    parser.add_argument('--profile', nargs='?', const='', metavar='FILE',
+                       help='Print time, files, bytes and syscalls per stage; with FILE, also write '
+                            'cProfile stats (view with pstats) or, for a .json FILE, a Chrome trace')
+    
+    args = parser.parse_args(argv)
+    if args.jobs < 1:
+        parser.error('--jobs must be at least 1')
+    if args.query is not None and args.input:
+        parser.error('--query and --input both pick the files; use one')
+    if args.query is not None and not args.query.strip():
+        parser.error('--query needs some text')
+    if args.query_limit < 1:
+        parser.error('--query-limit must be at least 1')
+    if args.follow_imports < 0:
+        parser.error('--follow-imports must be at least 0')
+    if args.max_file_bytes is not None and args.max_file_bytes < 1:
+        parser.error('--max-file-bytes must be at least 1')
+    if args.token_budget is not None and args.token_budget < 1:
+        parser.error('--token-budget must be at least 1')
+    if args.chunk_dedup is not None and args.chunk_dedup < 1:
+        parser.error('--chunk-dedup must be at least 1')
+    if args.chunk_dedup is not None and args.incremental:
+        print("Note: --chunk-dedup rewrites every block, so --incremental has no effect.")
+    if args.shard_size is not None and args.shard_size[0] < 1:
+        parser.error('--shard-size must be at least 1')
+    counts_tokens = args.token_budget is not None or (args.shard_size and args.shard_size[1] == 'tokens')
+    if counts_tokens and args.tokenizer == 'tiktoken':
+        import importlib.util
+        if importlib.util.find_spec('tiktoken') is None:
+            parser.error('--tokenizer tiktoken needs the tiktoken package (pip install tiktoken)')
+    
+    root_dir = os.getcwd()
+    
+    if block_cache is not None and (args.serve or not (args.scan or args.input)):
+        parser.error('the daemon only serves --scan and --input runs')
+    if args.serve:
+        serve(root_dir, use_inotify=not args.poll)
+        return
+    if args.profile is None:
+        run(args, root_dir, block_cache)
+        return
+    
+    global _PROFILER
+    _PROFILER = StageProfiler(trace=args.profile.endswith('.json'))
+    profile = None
+    if args.profile and not args.profile.endswith('.json'):
+        import cProfile
+        profile = cProfile.Profile()
+        profile.enable()
+    try:
+        run(args, root_dir, block_cache)
+    finally:
+        if profile is not None:
+            profile.disable()
+            profile.dump_stats(args.profile)
+        _PROFILER.report()
+        if _PROFILER.events is not None:
+            _PROFILER.write_trace(args.profile)
+        if args.profile:
+            print(f"Profile written to: {args.profile}")
+        _PROFILER = None
+
 if __name__ == "__main__":
     main()
@@ -4,11 +4,26 @@ Test script to demonstrate the improved penetrate.py functionality
 """
 
 import os
+import re
 import sys
+import json
+import shutil
+import subprocess
+
+import pytest
 
 # Add current directory to path to import penetrate_improved
 sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
 from penetrate_improved import parse_file_paths_from_text
+import penetrate_final
+
+# Upper bound for the modules penetrate_final imports at startup, in
+# microseconds of -X importtime cumulative time (about 15 ms when measured)
+STARTUP_IMPORT_BUDGET_US = 50000
+
+# Upper bound for the mean fuzzy lookup on a generated 100k-path index, in
+# milliseconds (about 1.5 ms when measured)
+FUZZY_LOOKUP_BUDGET_MS = 5
 
 def test_path_parsing():
     """Test the path parsing functionality with different input formats"""
@@ -146,5 +161,852 @@ def test_path_parsing():
         if path not in existing_files and path not in existing_dirs:
             print(f"  ✗ {path}")
 
+def make_tree(root, files):
+    """Creates the given {rel_path: content} files under root"""
+    for rel_path, content in files.items():
+        full_path = os.path.join(root, rel_path.replace('/', os.sep))
+        os.makedirs(os.path.dirname(full_path), exist_ok=True)
+        with open(full_path, 'w', encoding='utf-8') as f:
+            f.write(content)
+
+def test_path_index_lookups(tmp_path):
+    """find_file_similar resolves misses from the path index, not a tree walk"""
+    root = str(tmp_path)
+    make_tree(root, {
+        'src/app/api/content/analyze/route.ts': 'export {}',
+        'src/components/content/HistoryPanel.tsx': 'export {}',
+        'src/lib/utils.ts': 'export {}',
+        'node_modules/pkg/utils.ts': 'export {}',
+    })
+    index = penetrate_final.get_path_index(root, use_cache=True)
+    
+    assert 'node_modules/pkg/utils.ts' not in index['file_set']
+    assert penetrate_final.find_file_similar('api/content/analyze/', root, index) == [
+        'src/app/api/content/analyze/route.ts']
+    assert penetrate_final.find_file_similar('components/HistoryPanel.tsx', root, index) == [
+        'src/components/content/HistoryPanel.tsx']
+    assert penetrate_final.find_file_similar('lib/utils', root, index) == ['src/lib/utils.ts']
+    
+    # The saved index is reused until a directory changes
+    saved = penetrate_final.load_path_index(root)
+    assert penetrate_final.is_path_index_fresh(saved, root)
+    make_tree(root, {'src/lib/new.ts': ''})
+    os.utime(os.path.join(root, 'src', 'lib'), ns=(0, 0))
+    assert not penetrate_final.is_path_index_fresh(saved, root)
+
+def test_fuzzy_path_lookups(tmp_path, capsys):
+    """Misspelled or renamed paths resolve through the trigram index, with a confidence"""
+    root = str(tmp_path)
+    make_tree(root, {
+        'src/components/content/content-strategy-dashboard.tsx': 'export {}',
+        'src/components/content/history_panel.tsx': 'export {}',
+        'src/lib/history.ts': 'export {}',
+        'src/lib/formatters.ts': 'export {}',
+    })
+    index = penetrate_final.get_path_index(root, use_cache=False)
+    
+    matches = penetrate_final.find_file_matches('components/ContentStrategyDashboard.tsx', root, index)
+    assert matches == [('src/components/content/content-strategy-dashboard.tsx', 1.0)]
+    matches = penetrate_final.find_file_matches('content/HistoryPanell.js', root, index)
+    assert matches[0][0] == 'src/components/content/history_panel.tsx'
+    assert 0.5 < matches[0][1] < 1.0
+    assert penetrate_final.find_file_matches('lib/formater.ts', root, index)[0][0] == 'src/lib/formatters.ts'
+    assert penetrate_final.find_file_matches('lib/unrelated.ts', root, index) == []
+    # Bare names need FUZZY_MIN_CONFIDENCE, not more (6 of 10 trigrams shared)
+    assert penetrate_final.find_file_matches('formatting', root, index) == [('src/lib/formatters.ts', 0.6)]
+    
+    # Exact name matches keep their own, path-based confidence
+    assert penetrate_final.find_file_matches('utils/history.ts', root, index) == [('src/lib/history.ts', 0.75)]
+    
+    files = penetrate_final.expand_user_paths(['ContentStrategyDashboard.tsx'], root, use_cache=False)
+    assert files == ['src/components/content/content-strategy-dashboard.tsx']
+    assert "(confidence 1.00)" in capsys.readouterr().out
+
+def test_fuzzy_lookup_speed():
+    """Misspelled names resolve within FUZZY_LOOKUP_BUDGET_MS on 100k generated paths"""
+    import time
+    import random
+    rng = random.Random(0)
+    syllables = [a + b for a in 'bcdfghklmnprstvwz' for b in 'aeiou'] + ['ion', 'er', 'ent', 'al', 'or']
+    joins = ('-'.join, '_'.join, lambda words: ''.join(word.title() for word in words))
+    files = []
+    for n in range(100000):
+        words = [''.join(rng.choice(syllables) for _ in range(rng.randint(2, 4)))
+                 for _ in range(rng.randint(1, 3))]
+        files.append(f"src/d{n % 97}/d{n % 13}/{rng.choice(joins)(words)}{rng.choice(('.ts', '.tsx', '.py'))}")
+    index = penetrate_final.add_fuzzy_lookups({'files': files})
+    
+    # One character dropped from each name
+    queries = []
+    for rel_path in rng.sample(files, 200):
+        name = rel_path.rsplit('/', 1)[-1]
+        cut = rng.randrange(1, len(name) - 3)
+        queries.append(name[:cut] + name[cut + 1:])
+    # Posting sets are converted on first use; time the warm lookups
+    for query in queries:
+        penetrate_final.find_fuzzy_matches(query, index)
+    start = time.perf_counter()
+    for query in queries:
+        penetrate_final.find_fuzzy_matches(query, index)
+    elapsed_ms = (time.perf_counter() - start) * 1000 / len(queries)
+    assert elapsed_ms < FUZZY_LOOKUP_BUDGET_MS, f"{elapsed_ms:.2f} ms per lookup"
+
+def test_route_table_resolves_urls(tmp_path):
+    """URLs resolve through the app route trie, including dynamic and group segments"""
+    root = str(tmp_path)
+    make_tree(root, {
+        'src/app/api/content/analyze/route.ts': 'export {}',
+        'src/app/api/users/[id]/route.ts': 'export {}',
+        'src/app/api/files/[...path]/route.ts': 'export {}',
+        'src/app/[domain]/content-strategy/page.tsx': 'export {}',
+        'src/app/(marketing)/pricing/page.tsx': 'export {}',
+        'src/app/(marketing)/_components/Hero.tsx': 'export {}',
+        'src/app/docs/[[...slug]]/page.tsx': 'export {}',
+        'src/lib/utils.ts': 'export {}',
+        'src/app/[domain]/settings/page.tsx': 'export {}',
+        'src/lib/settings.ts': 'export {}',
+        'src/utils/settings.ts': 'export {}',
+    })
+    index = penetrate_final.get_path_index(root, use_cache=False)
+    
+    def resolve(path):
+        return penetrate_final.find_route_matches(path, index)
+    
+    assert resolve('/api/content/analyze/') == [('src/app/api/content/analyze/route.ts', 1.0)]
+    assert resolve('api/content/analyze/route.ts') == [('src/app/api/content/analyze/route.ts', 1.0)]
+    assert resolve('api/users/42') == [('src/app/api/users/[id]/route.ts', 0.5 + 0.5 * 2 / 3)]
+    assert resolve('api/files/a/b/c.txt') == []
+    assert resolve('api/files/a/b') == [('src/app/api/files/[...path]/route.ts', 0.5 + 0.5 * 2 / 4)]
+    assert resolve('acme.com/content-strategy') == [('src/app/[domain]/content-strategy/page.tsx', 0.75)]
+    assert resolve('[domain]/content-strategy/page.tsx') == [('src/app/[domain]/content-strategy/page.tsx', 1.0)]
+    assert resolve('/pricing') == [('src/app/(marketing)/pricing/page.tsx', 1.0)]
+    assert resolve('app/(marketing)/pricing') == [('src/app/(marketing)/pricing/page.tsx', 1.0)]
+    assert resolve('docs') == [('src/app/docs/[[...slug]]/page.tsx', 1.0)]
+    assert resolve('docs/intro/setup')[0][0] == 'src/app/docs/[[...slug]]/page.tsx'
+    assert resolve('_components') == []
+    
+    # Paths that only match dynamic segments are left to the file lookups
+    assert resolve('lib/utils') == []
+    assert penetrate_final.find_file_similar('lib/utils', root, index) == ['src/lib/utils.ts']
+    assert penetrate_final.find_file_similar('api/users/7/', root, index) == [
+        'src/app/api/users/[id]/route.ts']
+    
+    # A dynamic segment doesn't take a path over from a file that matches it better
+    assert resolve('lib/settings') == [('src/app/[domain]/settings/page.tsx', 0.75)]
+    assert penetrate_final.find_file_matches('lib/settings', root, index) == [('src/lib/settings.ts', 1.0)]
+    assert penetrate_final.find_file_matches('utils/settings', root, index) == [('src/utils/settings.ts', 1.0)]
+    assert penetrate_final.find_file_matches('acme.com/settings', root, index) == [
+        ('src/app/[domain]/settings/page.tsx', 0.75)]
+    
+    # Full URLs resolve by their path; a bare root names nothing
+    assert penetrate_final.find_file_matches('https://app.example.com/pricing?ref=nav#plans', root, index) == [
+        ('src/app/(marketing)/pricing/page.tsx', 1.0)]
+    assert penetrate_final.find_file_matches('https://app.example.com/acme.com/settings/', root, index) == [
+        ('src/app/[domain]/settings/page.tsx', 0.75)]
+    assert penetrate_final.find_file_matches('http://localhost:3000/api/users/7', root, index) == [
+        ('src/app/api/users/[id]/route.ts', 0.5 + 0.5 * 2 / 3)]
+    for path in ('/', '', 'https://example.com', 'https://example.com/?tab=1'):
+        assert penetrate_final.find_file_matches(path, root, index) == []
+
+def test_follow_imports_transitively(tmp_path, monkeypatch):
+    """--follow-imports pulls in what listed files import, through tsconfig aliases, up to DEPTH"""
+    root = str(tmp_path)
+    make_tree(root, {
+        'tsconfig.json': '{\n  // comments and trailing commas are fine\n  "compilerOptions": {\n'
+                         '    "baseUrl": ".",\n    "paths": {"@/*": ["./src/*"],},\n  },\n}\n',
+        'src/app/page.tsx': "import Panel from '@/components/Panel'\nimport './page.css'\n"
+                            "import { useState } from 'react'\n",
+        'src/app/page.css': 'body {}',
+        'src/components/Panel.tsx': "import {\n  format,\n} from '../lib'\nexport default 1\n",
+        'src/lib/index.ts': "export * from './format.js'\n",
+        'src/lib/format.ts': 'export const format = 1\n',
+        'tools/run.py': 'from .helpers import (\n    load,\n)\nimport tools.cli as cli\n',
+        'tools/__init__.py': '',
+        'tools/helpers.py': '',
+        'tools/cli.py': '',
+        'plugin/main.php': "<?php require_once __DIR__ . '/includes/api.php';\n",
+        'plugin/includes/api.php': '<?php\n',
+    })
+    
+    origins = {}
+    files = penetrate_final.follow_imports(['src/app/page.tsx'], root, 2, origins=origins)
+    assert files == ['src/app/page.tsx', 'src/components/Panel.tsx', 'src/app/page.css', 'src/lib/index.ts']
+    assert origins['src/lib/index.ts'] == 'imported'
+    files = penetrate_final.follow_imports(['src/app/page.tsx'], root, 5)
+    assert files[-1] == 'src/lib/format.ts'
+    assert penetrate_final.follow_imports(['tools/run.py', 'plugin/main.php'], root, 1) == [
+        'tools/run.py', 'plugin/main.php', 'plugin/includes/api.php', 'tools/helpers.py', 'tools/cli.py']
+    
+    # Unchanged files are answered from the cache without being scanned again
+    cache = penetrate_final.load_imports_cache(root)
+    assert cache['files']['src/components/Panel.tsx'][2] in cache['imports']
+    monkeypatch.setattr(penetrate_final, 'scan_imports', lambda *args: 1 / 0)
+    assert penetrate_final.follow_imports(['src/app/page.tsx'], root, 5)[-1] == 'src/lib/format.ts'
+    
+    # baseUrl is normalized as a path, not stripped of leading dots
+    for base_url, base_dir in (('.', ''), ('./src', 'src'), ('../shared', '../shared'), ('.config', '.config')):
+        make_tree(root, {'tsconfig.json': '{"compilerOptions": {"baseUrl": "%s"}}' % base_url})
+        assert penetrate_final.load_path_aliases(root) == (base_dir, [])
+
+def test_query_ranks_files(tmp_path, monkeypatch):
+    """--query ranks files by BM25 over split identifiers and paths, re-indexing only changed files"""
+    root = str(tmp_path)
+    make_tree(root, {
+        'src/lib/wordpress/publisher.ts': '// Publishes posts, retrying failures\n'
+                                          'export async function publishPost(post, maxRetries) {}\n',
+        'src/lib/email/sender.ts': 'export function sendEmail(to) { return retry(send) }\n',
+        'src/app/page.tsx': 'export default function Page() {}\n',
+        'assets/logo.dat': '\0\1\2 wordpress',
+    })
+    
+    assert penetrate_final.split_search_terms('WordPressRetries') == [
+        'word', 'press', 'retry', 'wordpress', 'pressretry']
+    index = penetrate_final.SearchIndex(root)
+    assert index.update(root, penetrate_final.scan_all_files(root)) == 4
+    matches = index.search('wordpress publishing retries')
+    assert [path for path, _ in matches] == ['src/lib/wordpress/publisher.ts', 'src/lib/email/sender.ts']
+    assert matches[0][1] > matches[1][1]
+    assert 'assets/logo.dat' in dict(index.search('logo')) and 'assets/logo.dat' not in dict(index.search('wordpress'))
+    index.close()
+    
+    # Unchanged files are not read again; a touched file with the same content is not re-indexed
+    os.utime(os.path.join(root, 'src/app/page.tsx'), (1, 1))
+    os.remove(os.path.join(root, 'src/lib/email/sender.ts'))
+    monkeypatch.setattr(penetrate_final, 'count_search_terms', lambda *args: 1 / 0)
+    index = penetrate_final.SearchIndex(root)
+    assert index.update(root, penetrate_final.scan_all_files(root)) == 0
+    monkeypatch.undo()
+    assert [path for path, _ in index.search('retries')] == ['src/lib/wordpress/publisher.ts']
+    make_tree(root, {'src/lib/wordpress/publisher.ts': 'export const queue = []\n'})
+    assert index.update(root, penetrate_final.scan_all_files(root)) == 1
+    assert index.search('retries') == [] and index.search('queue')[0][0] == 'src/lib/wordpress/publisher.ts'
+    index.close()
+    
+    monkeypatch.chdir(tmp_path)
+    penetrate_final.main(['--query', 'wordpress queue', '-o', 'out.md'])
+    with open(os.path.join(root, 'out.md'), encoding='utf-8') as f:
+        output = f.read()
+    assert 'export const queue' in output and 'Page()' not in output and 'logo.dat' not in output
+    
+    # Later queries reuse the indexed file list while no directory gained or
+    # lost an entry that matters (rewriting out.md doesn't count)
+    penetrate_final.main(['--query', 'wordpress queue', '-o', 'out.md'])
+    monkeypatch.setattr(penetrate_final, 'iter_scan_files', lambda *args: 1 / 0)
+    penetrate_final.main(['--query', 'wordpress queue', '-o', 'out.md'])
+    assert penetrate_final.search_project('queue', root) == ['src/lib/wordpress/publisher.ts']
+    monkeypatch.undo()
+    make_tree(root, {'src/lib/queue.ts': 'export const queue = 1\n', '.gitignore': 'dist/\n'})
+    assert 'src/lib/queue.ts' in penetrate_final.search_project('queue', root)
+    make_tree(root, {'.gitignore': 'queue.ts\n'})
+    os.utime(os.path.join(root, '.gitignore'), (1, 1))
+    assert 'src/lib/queue.ts' not in penetrate_final.search_project('queue', root)
+    # Under --serve the daemon's file list is used as is
+    monkeypatch.setitem(penetrate_final._HOT_STATE, root, {'generation': 0, 'files': ['src/app/page.tsx']})
+    assert penetrate_final.search_project('queue', root) == []
+
+def test_outline_mode(tmp_path, monkeypatch):
+    """--outline writes signatures for unlisted files, full text for listed ones, cached by hash"""
+    py_source = ('"""Models."""\nimport os\n\nLIMIT = 3\n\n@cached\ndef load(path,\n         mode="r"):\n'
+                 '    """Loads a file."""\n    return open(path, mode).read()\n\n'
+                 'class Store(Base):\n    size = 0\n\n    def add(self, item):\n        self.size += 1\n')
+    ts_source = ("import { db } from './db'\n\nexport interface Item {\n  id: string\n}\n\n"
+                 "export function list({ limit }: Options): Item[] {\n  if (limit) { return [] }\n"
+                 "  return db.all('}')\n}\n")
+    php_source = ("<?php\nclass Api extends Base {\n    public $name = 'x';\n"
+                  "    public function get($id) {\n        return $this->find($id);\n    }\n}\n")
+    make_tree(str(tmp_path), {
+        'src/app/models.py': py_source,
+        'src/app/list.ts': ts_source,
+        'src/app/api.php': php_source,
+        'src/app/style.css': 'body { color: red; }\n',
+        'list.txt': 'src/app/\nsrc/app/models.py\n',
+    })
+    
+    assert penetrate_final.outline_python(py_source) == (
+        '"""Models."""\nimport os\nLIMIT = 3\n\n@cached\ndef load(path,\n         mode="r"):\n'
+        '    """Loads a file."""\n    ...\n\nclass Store(Base):\n    size = 0\n    def add(self, item):\n        ...')
+    assert penetrate_final.extract_outline('src/app/list.ts', ts_source) == (
+        "import { db } from './db'\n\nexport interface Item {\n  id: string\n}\n\n"
+        "export function list({ limit }: Options): Item[] { ... }")
+    assert penetrate_final.extract_outline('src/app/api.php', php_source) == (
+        "<?php\nclass Api extends Base {\n    public $name = 'x';\n    public function get($id) { ... }\n}")
+    assert penetrate_final.extract_outline('src/app/broken.py', 'def (') is None
+    
+    monkeypatch.chdir(tmp_path)
+    penetrate_final.main(['-i', 'list.txt', '-o', 'out.md', '--outline'])
+    with open('out.md', encoding='utf-8') as f:
+        output = f.read()
+    blocks = {block.split('\n', 1)[0]: block for block in output.split('### ')[1:]}
+    assert 'Outline' not in blocks['src/app/models.py'] and 'return open(path' in blocks['src/app/models.py']
+    assert 'Outline' in blocks['src/app/list.ts'] and 'db.all' not in blocks['src/app/list.ts']
+    assert 'Outline' in blocks['src/app/api.php']
+    assert 'color: red' in blocks['src/app/style.css']
+    
+    # Outlines come from the cache by content hash; --outline all changes the manifest options
+    monkeypatch.setattr(penetrate_final, 'extract_outline', lambda *args: 1 / 0)
+    penetrate_final.main(['-i', 'list.txt', '-o', 'out.md', '--outline'])
+    with open('out.md', encoding='utf-8') as f:
+        assert f.read() == output
+    monkeypatch.undo()
+    monkeypatch.chdir(tmp_path)
+    penetrate_final.main(['-i', 'list.txt', '-o', 'out.md', '--outline', 'all', '--incremental'])
+    with open('out.md', encoding='utf-8') as f:
+        assert 'return open(path' not in f.read()
+
+def test_outline_python_headers():
+    """Outline headers stop before the first body statement's decorators; one-line bodies stay whole"""
+    source = ('class Point:\n    @property\n    def x(self):\n        return 1\n\n'
+              'def outer(f):\n    @wraps(f)\n    def inner():\n        pass\n    return inner\n\n'
+              'def one(): return 1\n\ndef two(a,\n        b): return a\n')
+    
+    assert penetrate_final.outline_python(source) == (
+        'class Point:\n    @property\n    def x(self):\n        ...\n\n'
+        'def outer(f):\n    ...\n\n'
+        'def one(): return 1\n\ndef two(a,\n        b): return a')
+
+def test_incremental_output_matches_full(tmp_path):
+    """Incremental runs reuse unchanged blocks and produce the same output"""
+    root = str(tmp_path)
+    make_tree(root, {'a.py': 'print(1)\n', 'lib/b.ts': 'export const b = 1\r\n'})
+    files = [os.path.join('lib', 'b.ts'), 'a.py']
+    output = os.path.join(root, 'out.md')
+    
+    penetrate_final.write_codebase(output, files, root)
+    make_tree(root, {'a.py': 'print(2)\n'})
+    entries = penetrate_final.write_codebase(output, files, root, incremental=True)
+    with open(output, 'rb') as f:
+        incremental = f.read()
+    
+    penetrate_final.write_codebase(output, files, root, use_cache=False)
+    with open(output, 'rb') as f:
+        assert f.read() == incremental
+    
+    offset, length = entries['a.py'][3:]
+    assert incremental[offset:offset + length].startswith(b'### a.py\n\n```python\nprint(2)\n')
+    assert b'export const b = 1\n\n```' in incremental
+
+def test_token_budget_packing(tmp_path):
+    """Listed files are packed first and the output stays within the budget"""
+    root = str(tmp_path)
+    make_tree(root, {'big.py': 'x = 1\n' * 400, 'docs/a.py': 'a\n', 'lib/b.ts': 'b\n' * 100,
+                     'lib/c.ts': 'c\n' * 1000})
+    origins = {}
+    files = penetrate_final.expand_user_paths(['big.py', 'lib'], root, use_cache=False, origins=origins)
+    assert origins == {'big.py': 'listed', os.path.join('lib', 'b.ts'): 'directory',
+                       os.path.join('lib', 'c.ts'): 'directory'}
+    
+    budget = 1000
+    kept = penetrate_final.pack_token_budget(files + [os.path.join('docs', 'a.py')], root, budget,
+                                             origins=origins, use_cache=False)
+    assert kept == ['big.py', os.path.join('lib', 'b.ts'), os.path.join('docs', 'a.py')]
+    output = os.path.join(root, 'out.md')
+    penetrate_final.write_codebase(output, kept, root, use_cache=False)
+    assert os.path.getsize(output) / penetrate_final.BYTES_PER_TOKEN <= budget
+    
+    assert penetrate_final.estimate_tokens_words(b'def get_user_profile(self):\n    return 42') == 11
+
+def test_sharded_output_and_index(tmp_path):
+    """Shards hold the same blocks as one output and the index points at them"""
+    root = str(tmp_path / 'repo')
+    files = {f'src/m{i}.py': f'value = {i}\n' * 50 for i in range(8)}
+    make_tree(root, files)
+    valid_files = [os.path.join('src', f'm{i}.py') for i in range(8)]
+    output = str(tmp_path / 'out.md')
+    assert penetrate_final.parse_shard_size('200kt') == (200000, 'tokens')
+    
+    penetrate_final.write_sharded_codebase(output, valid_files, root, 10, 'tokens', use_cache=False)
+    index = penetrate_final.write_sharded_codebase(output, valid_files, root, 1500, use_cache=False)
+    assert [shard['file'] for shard in index['shards']] == ['out.001.md', 'out.002.md', 'out.003.md', 'out.004.md']
+    assert not os.path.exists(str(tmp_path / 'out.005.md'))  # Left over from the first run
+    
+    blocks = []
+    for shard in index['shards']:
+        with open(str(tmp_path / shard['file']), 'rb') as f:
+            data = f.read()
+        assert len(data) <= 1500
+        assert data.startswith(f"# Project Codebase: repo (part {len(blocks) + 1} of 4)".encode())
+        blocks.append(data.split(b'## 2. File Contents\n\n', 1)[1])
+    for rel_path, entry in index['files'].items():
+        with open(str(tmp_path / entry['shard']), 'rb') as f:
+            f.seek(entry['offset'])
+            assert f.read(entry['length']).startswith(f"### {rel_path.replace('/', os.sep)}\n".encode())
+    
+    penetrate_final.write_codebase(output, valid_files, root, use_cache=False)
+    with open(output, 'rb') as f:
+        assert b''.join(blocks) == f.read().split(b'## 2. File Contents\n\n', 1)[1]
+
+def test_repeated_sharded_scans(tmp_path, monkeypatch):
+    """A second --scan --shard-size leaves out the shard index and only removes real shards"""
+    root = str(tmp_path / 'repo')
+    make_tree(root, {f'src/m{i}.py': f'value = {i}\n' * 50 for i in range(4)})
+    make_tree(root, {'a.py': 'keep = 1\n', 'PROJECT_CODEBASE.017.md.bak': 'keep'})
+    make_tree(str(tmp_path), {'x': 'keep'})
+    monkeypatch.chdir(root)
+    
+    penetrate_final.main(['--scan', '--shard-size', '1500', '--no-cache'])
+    with open('PROJECT_CODEBASE.index.json', 'r', encoding='utf-8') as f:
+        index = json.load(f)
+    index['shards'] += [{'file': 'a.py'}, {'file': '../x'}, {'file': 'PROJECT_CODEBASE.017.md.bak'}]
+    with open('PROJECT_CODEBASE.index.json', 'w', encoding='utf-8') as f:
+        json.dump(index, f)
+    
+    penetrate_final.main(['--scan', '--shard-size', '1500', '--no-cache'])
+    with open('PROJECT_CODEBASE.index.json', 'r', encoding='utf-8') as f:
+        index = json.load(f)
+    assert 'PROJECT_CODEBASE.index.json' not in index['files']
+    assert os.path.exists('a.py') and os.path.exists('PROJECT_CODEBASE.017.md.bak') and os.path.exists('../x')
+    assert penetrate_final.is_shard_name('PROJECT_CODEBASE.002.md', 'PROJECT_CODEBASE.md')
+
+def test_dedup_references_identical_files(tmp_path):
+    """Identical files are written once, also across incremental runs"""
+    root = str(tmp_path)
+    shared = 'def helper():\n    return 1\n'
+    make_tree(root, {'a/util.py': shared, 'b/util.py': shared, 'c/util.py': shared})
+    files = [os.path.join(d, 'util.py') for d in 'abc']
+    output = os.path.join(root, 'out.md')
+    
+    penetrate_final.write_codebase(output, files, root, dedup=True)
+    with open(output, encoding='utf-8') as f:
+        text = f.read()
+    assert text.count(shared) == 1
+    assert f"### {files[2]}\n\n> Identical to `{files[0]}` above." in text
+    
+    # b/util.py was a reference; once a/util.py changes it must be written out
+    make_tree(root, {'a/util.py': 'changed = True\n'})
+    penetrate_final.write_codebase(output, files, root, incremental=True, dedup=True)
+    with open(output, 'rb') as f:
+        incremental = f.read()
+    penetrate_final.write_codebase(output, files, root, use_cache=False, dedup=True)
+    with open(output, 'rb') as f:
+        assert f.read() == incremental
+    assert f"> Identical to `{files[1]}` above.".encode() in incremental
+
+def test_chunk_dedup_moves_repeated_chunks(tmp_path):
+    """Repeated chunks go to the appendix once and the references expand back"""
+    root = str(tmp_path)
+    header = ''.join(f"// Copyright line {i} of the license boilerplate text\n" for i in range(12))
+    files = {f'src/f{i}.ts': header + f"export const value{i} = {i}\n" * (i + 1) for i in range(5)}
+    make_tree(root, files)
+    rel_paths = sorted(os.path.join('src', f'f{i}.ts') for i in range(5))
+    output = os.path.join(root, 'out.md')
+    
+    counter = penetrate_final.count_chunks(root, rel_paths, 3, use_cache=False)
+    penetrate_final.write_codebase(output, rel_paths, root, use_cache=False, chunk_counter=counter)
+    with open(output, encoding='utf-8') as f:
+        text = f.read()
+    body, appendix = text.split('## 3. Repeated Chunks\n\n')
+    # The tail of the header shares a chunk with each file's own lines
+    assert text.count('Copyright line 0 ') == 1 and text.count('license boilerplate text\n') < 5 * 12
+    
+    chunks = {}
+    for part in appendix.split('### Chunk #')[1:]:
+        number, rest = part.split('\n', 1)
+        chunks[number] = rest.split('```typescript\n', 1)[1].split('```\n\n---', 1)[0]
+    expanded = re.sub(r'\[\.\.\. \d+ repeated lines, see chunk #(\d+) under Repeated Chunks \.\.\.\]\n',
+                      lambda m: chunks[m.group(1)], body)
+    for rel_path, content in files.items():
+        assert f"```typescript\n{content}\n```" in expanded
+
+def test_block_cache_skips_reads_and_evicts(tmp_path):
+    """Cached blocks are used without reading the file; the cap evicts LRU blocks"""
+    root = str(tmp_path)
+    make_tree(root, {'a.py': 'print("a")\n', 'b.py': 'print("b")\n'})
+    output = os.path.join(root, 'out.md')
+    penetrate_final.write_codebase(output, ['a.py', 'b.py'], root)
+    
+    # Same size and mtime, different content: only a cache hit keeps the old text
+    st = os.stat(os.path.join(root, 'a.py'))
+    make_tree(root, {'a.py': 'print("A")\n'})
+    os.utime(os.path.join(root, 'a.py'), ns=(st.st_atime_ns, st.st_mtime_ns))
+    penetrate_final.write_codebase(os.path.join(root, 'other.md'), ['a.py'], root)
+    with open(os.path.join(root, 'other.md'), encoding='utf-8') as f:
+        assert 'print("a")' in f.read()
+    
+    # The running size total follows inserts, replacements and evictions
+    def stored_bytes(cache):
+        total = cache.db.execute("SELECT value FROM meta WHERE key = 'bytes'").fetchone()[0]
+        assert total == cache.db.execute("SELECT SUM(LENGTH(block)) FROM blocks").fetchone()[0]
+        return total
+    
+    cache = penetrate_final.BlockCache(root)
+    stored_bytes(cache)
+    cache.put('a.py', os.stat(os.path.join(root, 'a.py')), None, b'x' * 5000)
+    cache.put_outline('0' * 40, 'y' * 3000)
+    cache.flush()
+    b_bytes = cache.db.execute("SELECT LENGTH(block) FROM blocks WHERE path = 'b.py'").fetchone()[0]
+    assert stored_bytes(cache) == 5000 + 3000 + b_bytes
+    cache.close()
+    cache = penetrate_final.BlockCache(root, max_bytes=1)
+    assert set(cache.entries(['a.py', 'b.py'])) == {'a.py', 'b.py'}
+    cache.close()
+    cache = penetrate_final.BlockCache(root)
+    assert cache.entries(['a.py', 'b.py']) == {}
+    assert cache.db.execute("SELECT value FROM meta WHERE key = 'bytes'").fetchone()[0] == 0
+    cache.close()
+
+def test_daemon_serves_and_invalidates(tmp_path, monkeypatch):
+    """The --serve daemon answers client runs and rescans after a file is added"""
+    import threading
+    import time
+    import penetrate_client
+    make_tree(str(tmp_path), {'a.py': 'a = 1\n', 'src/b.ts': 'export const b = 2\n'})
+    monkeypatch.chdir(tmp_path)
+    root = os.getcwd()
+    
+    for use_inotify in (False, True):
+        stop, ready = threading.Event(), threading.Event()
+        thread = threading.Thread(target=penetrate_final.serve, args=(root, 0.02, use_inotify, stop, ready))
+        thread.start()
+        try:
+            assert ready.wait(10)
+            output, status = penetrate_client.forward(['--scan', '-o', 'out.md'], root, timeout=30)
+            assert status == 0 and 'Successfully generated' in output
+            output, status = penetrate_client.forward(['--scan', '-o', 'out.md'], root, timeout=30)
+            assert 'Using the file list kept by the daemon' in output
+            
+            new_file = f'src/c{int(use_inotify)}.ts'
+            make_tree(root, {new_file: 'export const c = 3\n'})
+            deadline = time.time() + 10
+            while 'files' in penetrate_final._HOT_STATE[root] and time.time() < deadline:
+                time.sleep(0.02)
+            output, status = penetrate_client.forward(['--scan', '-o', 'out.md'], root, timeout=30)
+            assert 'Scanning directory' in output
+            with open('out.md', encoding='utf-8') as f:
+                assert f"### {new_file}\n" in f.read()
+            
+            _, status = penetrate_client.forward(['--serve'], root, timeout=30)
+            assert status == 2
+        finally:
+            stop.set()
+            thread.join()
+        assert not os.path.exists(penetrate_final.get_daemon_socket_path(root))
+        assert penetrate_final.get_daemon_socket_path(root) == os.path.join(root, penetrate_client.DAEMON_SOCKET)
+        assert penetrate_client.forward(['--scan'], root) is None
+
+def test_startup_imports_stay_lazy():
+    """--help loads no mode-specific modules and imports stay within budget"""
+    script = os.path.dirname(os.path.abspath(__file__))
+    result = subprocess.run(
+        [sys.executable, '-X', 'importtime', '-c',
+         'import penetrate_final; penetrate_final.main(["--help"])'],
+        cwd=script, capture_output=True, text=True, check=True)
+    assert '--scan' in result.stdout
+    
+    timings = {}
+    for line in result.stderr.splitlines():
+        match = re.match(r'import time:\s+(\d+) \|\s+(\d+) \| (\s*)(\S+)', line)
+        if match:
+            timings[match.group(4)] = (int(match.group(1)), int(match.group(2)))
+    for module in ('pathspec', 'sqlite3', 'concurrent.futures', 'tempfile', 'socket', 'ctypes'):
+        assert module not in timings, f"{module} imported at startup"
+    
+    # Self time is mostly compiling the script when no .pyc can be written
+    own, cumulative = timings['penetrate_final']
+    assert cumulative - own < STARTUP_IMPORT_BUDGET_US
+
+def test_profile_reports_stages(tmp_path, monkeypatch, capsys):
+    """--profile prints per-stage totals and can write a Chrome trace"""
+    import json
+    make_tree(str(tmp_path), {'a.py': 'a = 1\n', 'src/b.ts': 'export const b = 2\n'})
+    monkeypatch.chdir(tmp_path)
+    penetrate_final.main(['--scan', '-o', 'out.md', '--profile', 'trace.json'])
+    
+    report = capsys.readouterr().out.split('Stage', 1)[1]
+    rows = {line.split()[0]: line.split()[1:] for line in report.splitlines()[1:] if line.strip()}
+    assert rows['enumerate'][2] == '2' and rows['read'][2] == '2' and rows['render'][1] == '2'
+    assert 'total' in rows
+    with open('trace.json', encoding='utf-8') as f:
+        events = json.load(f)['traceEvents']
+    assert {'enumerate', 'read', 'render'} <= {event['name'] for event in events}
+    assert all(event['ph'] == 'X' and event['dur'] >= 0 for event in events)
+    assert penetrate_final._PROFILER is None
+
+def test_bench_suite_cases_and_baseline(tmp_path):
+    """The synthetic repo honours its knobs; suite cases run and regressions are caught"""
+    import bench_penetrate
+    root = str(tmp_path / 'repo')
+    os.makedirs(root)
+    bench_penetrate.make_synthetic_repo(root, files=300, depth=3, fanout=3, mean_size=512,
+                                        binary_ratio=0.1, ignore_files=3)
+    files = penetrate_final.scan_all_files(root)
+    assert any(f.endswith('.wasm') for f in files)
+    nested = [f for f in files if os.sep in f and os.path.exists(os.path.join(root, os.path.dirname(f), '.gitignore'))]
+    assert nested and not any(os.path.basename(f).startswith('tmp_') or f.endswith('.gen.ts') for f in nested)
+    
+    results = {name: bench_penetrate.run_case(name, root, 1, min_seconds=0) for name in bench_penetrate.SUITE_CASES}
+    assert results['scan']['count'] == len(files) and results['tree']['count'] == len(files)
+    assert results['tree-100k']['count'] == bench_penetrate.TREE_CASE_PATHS
+    assert results['main']['unit'] == 'bytes' and results['main']['count'] > 300 * 100
+    assert all(result['throughput'] > 0 and result['peak_rss_kb'] > 0 for result in results.values())
+    assert all(result['relative'] > 0 for result in results.values())
+    
+    report = {'results': results}
+    slower = {'results': {name: dict(result, relative=result['relative'] * 2)
+                          for name, result in results.items()}}
+    assert bench_penetrate.compare_to_baseline(report, report) == []
+    assert len(bench_penetrate.compare_to_baseline(report, slower)) == len(results)
+    
+    # End to end: a saved baseline passes against itself and fails against
+    # one the tree can't match
+    bench = [sys.executable, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'bench_penetrate.py'),
+             'suite', '--files', '300', '--repeat', '1', '--min-seconds', '0', '--keep', root]
+    baseline = str(tmp_path / 'baseline.json')
+    subprocess.run(bench + ['--save-baseline', baseline], check=True, capture_output=True)
+    # Small cases are noisy; only the comparison itself is under test
+    result = subprocess.run(bench + ['--baseline', baseline, '--tolerance', '0.9'], capture_output=True, text=True)
+    assert result.returncode == 0 and 'No regressions' in result.stdout
+    with open(baseline, encoding='utf-8') as f:
+        saved = json.load(f)
+    for case in saved['results'].values():
+        case['relative'] *= 100
+    with open(baseline, 'w', encoding='utf-8') as f:
+        json.dump(saved, f)
+    result = subprocess.run(bench + ['--baseline', baseline], capture_output=True, text=True)
+    assert result.returncode == 1 and 'per os.walk file' in result.stdout
+
+def test_parallel_reader_keeps_order(tmp_path):
+    """Prefetched reads come back in input order even with a tiny byte budget"""
+    root = str(tmp_path)
+    files = {f'f{i:03d}.py': 'x' * (i * 37) for i in range(60)}
+    make_tree(root, files)
+    names = sorted(files, reverse=True)
+    
+    results = list(penetrate_final.iter_read_files(root, names, jobs=8, max_inflight_bytes=100))
+    assert [name for name, _ in results] == names
+    assert all(result['data'] == files[name].encode() for name, result in results)
+
+def test_streamed_blocks_and_size_cap(tmp_path, monkeypatch):
+    """Streamed blocks match in-memory ones; oversized files follow the policy"""
+    root = str(tmp_path)
+    body = ''.join(f'line {i} \u00e9\r\n' for i in range(5000))
+    make_tree(root, {'data.json': body})
+    output = os.path.join(root, 'out.md')
+    
+    penetrate_final.write_codebase(output, ['data.json'], root, use_cache=False)
+    with open(output, 'rb') as f:
+        in_memory = f.read()
+    monkeypatch.setattr(penetrate_final, 'CHUNK_SIZE', 7)
+    monkeypatch.setattr(penetrate_final, 'STREAM_THRESHOLD', 0)
+    penetrate_final.write_codebase(output, ['data.json'], root, use_cache=False)
+    with open(output, 'rb') as f:
+        assert f.read() == in_memory
+    
+    penetrate_final.write_codebase(output, ['data.json'], root, use_cache=False,
+                                   max_file_bytes=1000, oversize='head-tail')
+    with open(output, 'r', encoding='utf-8') as f:
+        text = f.read()
+    assert 'line 0 \u00e9\n' in text and 'line 4999 \u00e9\n' in text
+    assert 'line 2500 ' not in text
+    assert '> Truncated: showing the first' in text
+    
+    penetrate_final.write_codebase(output, ['data.json'], root, use_cache=False,
+                                   max_file_bytes=1000, oversize='skip')
+    with open(output, 'r', encoding='utf-8') as f:
+        text = f.read()
+    assert '> Skipped:' in text and 'line 0' not in text
+    
+    # A zero cap is a mistake on the command line, and explained when passed in
+    with pytest.raises(SystemExit):
+        penetrate_final.main(['--scan', '-o', output, '--max-file-bytes', '0'])
+    penetrate_final.write_codebase(output, ['data.json'], root, use_cache=False,
+                                   max_file_bytes=0, oversize='skip')
+    with open(output, 'r', encoding='utf-8') as f:
+        assert 'is over the 0 bytes limit (--max-file-bytes)' in f.read()
+
+def test_library_api_streams_same_document(tmp_path, monkeypatch):
+    """iter_files/iter_blocks/render produce write_codebase's output chunk by chunk"""
+    root = str(tmp_path)
+    make_tree(root, {'src/a.ts': 'export const a = 1\n', 'src/big.json': 'x\u00e9\n' * 2000,
+                     'lib/b.py': 'b = 2\n', 'dist/out.js': 'ignored\n', '.gitignore': 'dist/\n'})
+    with open(os.path.join(root, 'bad.ts'), 'wb') as f:
+        f.write(b'ok' * 20000 + b'\xff\xfe')
+    with open(os.path.join(root, 'img.dat'), 'wb') as f:
+        f.write(b'\x00\x01binary')
+    monkeypatch.setattr(penetrate_final, 'STREAM_THRESHOLD', 1000)
+    monkeypatch.setattr(penetrate_final, 'CHUNK_SIZE', 256)
+    
+    files = sorted(penetrate_final.iter_files(root))
+    assert files == sorted(['.gitignore', 'bad.ts', 'img.dat', os.path.join('lib', 'b.py'),
+                            os.path.join('src', 'a.ts'), os.path.join('src', 'big.json')])
+    chunks = []
+    streamed = []
+    stream = penetrate_final.iter_streamed_block
+    monkeypatch.setattr(penetrate_final, 'iter_streamed_block', lambda *args: streamed.append(args[1]) or stream(*args))
+    written = penetrate_final.render(penetrate_final.iter_blocks(iter(files), root), chunks.append,
+                                     root, files=files)
+    # Streamed files are read once
+    assert sorted(streamed) == ['bad.ts', os.path.join('src', 'big.json')]
+    output = os.path.join(str(tmp_path), 'out.md')
+    penetrate_final.write_codebase(output, files, root, use_cache=False)
+    with open(output, 'rb') as f:
+        expected = f.read()
+    assert written == len(b''.join(chunks))
+    assert max(len(chunk) for chunk in chunks) < 1000
+    # bad.ts only fails to decode at its end: write_codebase replaces its
+    # block with the error note, iter_blocks (which read it once, streaming)
+    # closes the block it already sent with the note
+    note = b'> Error reading file bad.ts: '
+    bad_block = re.compile(rb'### bad\.ts\n\n```typescript\nok(?:ok)*\n```\n\n' + re.escape(note) + rb'[^\n]*\n\n---\n\n')
+    assert re.search(bad_block, b''.join(chunks))
+    assert re.sub(bad_block, b'', b''.join(chunks)) == re.sub(re.escape(note) + rb'[^\n]*\n\n---\n\n', b'', expected)
+    
+    listed = list(penetrate_final.iter_files(root, ['src/a.ts', 'lib', 'nowhere/missing.py']))
+    assert sorted(listed) == [os.path.join('lib', 'b.py'), os.path.join('src', 'a.ts')]
+
+def test_binary_files_sniffed_and_cached(tmp_path):
+    """Binary files are classified from their first bytes and cached by stat"""
+    root = str(tmp_path)
+    make_tree(root, {'app.js': 'let x = 1\n'})
+    with open(os.path.join(root, 'font.js'), 'wb') as f:
+        f.write(b'wOF2' + bytes(range(256)) * 100)
+    output = os.path.join(root, 'out.md')
+    
+    assert penetrate_final.sniff_binary(b'\x00asm\x01') == 'wasm data'
+    assert penetrate_final.sniff_binary('caf\u00e9'.encode('utf-8')[:-1]) is None
+    assert penetrate_final.sniff_binary(b'caf\xe9 ok') == 'not valid UTF-8'
+    
+    penetrate_final.write_codebase(output, ['app.js', 'font.js'], root)
+    with open(output, 'r', encoding='utf-8') as f:
+        text = f.read()
+    assert '> Skipped: not a UTF-8 text file (woff2 data' in text
+    assert 'let x = 1' in text
+    assert list(penetrate_final.load_binary_cache(root)) == ['font.js']
+
+def test_text_starting_with_magic_words_is_not_binary(tmp_path):
+    """Text files that begin like a binary signature (PACKAGE, ID3, GIF8...) are kept"""
+    root = str(tmp_path)
+    sources = {
+        'settings.py': 'PACKAGE_NAME = "demo"\n',
+        'tags.py': 'ID3_TAGS = []\n',
+        'bz.js': 'BZh = 1\n',
+        'gif.js': 'GIF8 = "image"\n',
+        'ogg.js': 'OggStream = null\n',
+        'flac.js': 'fLaCDecoder = null\n',
+        'woff.js': 'wOFFset = 0\n',
+        'pdf.js': '%PDF-1.4 as text\n',
+    }
+    make_tree(root, sources)
+    for content in sources.values():
+        assert penetrate_final.sniff_binary(content.encode('utf-8')) is None
+    assert penetrate_final.sniff_binary(b'PACK\x00\x00\x00\x02\x00\x00\x00\x05') == 'git pack data'
+    assert penetrate_final.sniff_binary(b'ID3\x03\x00\x00\x00\x00\x10') == 'MP3 data'
+    assert penetrate_final.sniff_binary(b'%PDF-1.4\n%\xe2\xe3\xcf\xd3') == 'PDF data'
+    
+    output = os.path.join(root, 'out.md')
+    penetrate_final.write_codebase(output, sorted(sources), root)
+    with open(output, 'r', encoding='utf-8') as f:
+        text = f.read()
+    assert 'Skipped' not in text and 'PACKAGE_NAME = "demo"' in text
+    assert penetrate_final.load_binary_cache(root) == {}
+
+def test_path_candidates_with_spans():
+    """The single-pass extractor reports spans and parses like before"""
+    text = ("See `src/app/page.tsx` and\n"
+            "- src/lib/utils.ts\n"
+            "plain prose line\n"
+            "Call /api/content/analyze/route.ts then trigger/jobs/run.ts\n"
+            "```\n├── src/components/Nav.tsx\n```\n")
+    for candidate, start, end in penetrate_final.iter_path_candidates(text):
+        assert text[start:end].strip() == candidate
+    paths = set(penetrate_final.parse_file_paths_from_text(text))
+    assert {'/api/content/analyze/route.ts', 'src/app/page.tsx', 'src/components/Nav.tsx',
+            'src/lib/utils.ts', 'trigger/jobs/run.ts'} <= paths
+    assert not any('prose' in path for path in paths)
+
+def test_generate_tree_hierarchy():
+    """The tree shows directory nodes, connectors and collapsed chains"""
+    files = [os.path.join(*p.split('/')) for p in
+             ['b.py', 'src/app/api/x/route.ts', 'src/app/page.tsx', 'src/lib/u.ts']]
+    tree = penetrate_final.generate_tree(files, {files[0]: 10, files[2]: 2048})
+    assert tree.splitlines()[3:] == [
+        '.',
+        '├── src/ (3 files, 2.0 KB)',
+        '│   ├── app/ (2 files, 2.0 KB)',
+        '│   │   ├── api/x/ (1 file, 0 bytes)',
+        '│   │   │   └── route.ts',
+        '│   │   └── page.tsx',
+        '│   └── lib/ (1 file, 0 bytes)',
+        '│       └── u.ts',
+        '└── b.py',
+        '```',
+        '',
+    ]
+
+def test_nested_gitignore_rules(tmp_path):
+    """Nested .gitignore files and .git/info/exclude apply, deepest rule wins"""
+    root = str(tmp_path)
+    make_tree(root, {
+        '.gitignore': '*.gen.ts\n',
+        '.git/info/exclude': 'local/\n',
+        'app/.gitignore': 'dist/\n!keep.gen.ts\n',
+        'app/dist/bundle.js': '',
+        'app/src/index.ts': '',
+        'app/src/keep.gen.ts': '',
+        'app/src/other.gen.ts': '',
+        'local/notes.js': '',
+        'web/dist/app.js': '',
+    })
+    
+    files = sorted(p.replace(os.sep, '/') for p in penetrate_final.scan_all_files(root))
+    assert files == ['.gitignore', 'app/.gitignore', 'app/src/index.ts',
+                     'app/src/keep.gen.ts', 'web/dist/app.js']
+    
+    matcher = penetrate_final.load_gitignore(root)
+    assert matcher.is_dir_ignored('app/dist')
+    assert matcher.match_file(os.path.join('app', 'dist', 'deep', 'x.js'))
+    assert not matcher.match_file('web/dist/app.js')
+
+def test_scandir_walk_matches_legacy_walk(tmp_path):
+    """scan_all_files lists exactly what the os.walk walker it replaced did"""
+    import bench_penetrate
+    root = str(tmp_path)
+    make_tree(root, {
+        '.gitignore': '*.log\nbuild/\n/top-only.ts\n',
+        '.env.example': 'KEY=\n',
+        'top-only.ts': '',
+        'src/top-only.ts': '',
+        'src/app/page.tsx': '',
+        'src/app/debug.log': '',
+        'src/app/build/out.js': '',
+        'src/lib/.gitignore': '*.gen.ts\n!keep.gen.ts\n',
+        'src/lib/keep.gen.ts': '',
+        'src/lib/drop.gen.ts': '',
+        'src/lib/caf\u00e9.ts': '',
+        'src/assets/logo.png': '',
+        'node_modules/pkg/index.js': '',
+        '.next/server/page.js': '',
+        'dist/bundle.js': '',
+        'penetrate_final.py': '',
+        penetrate_final.OUTPUT_FILE: '',
+    })
+    os.symlink(os.path.join(root, 'src', 'lib'), os.path.join(root, 'linked-lib'))
+    os.symlink(os.path.join(root, 'src', 'app', 'page.tsx'), os.path.join(root, 'linked-page.tsx'))
+    
+    files = penetrate_final.scan_all_files(root)
+    assert sorted(files) == sorted(bench_penetrate.scan_all_files_oswalk(root))
+    assert len(files) == len(set(files))
+    assert os.path.join('src', 'lib', 'keep.gen.ts') in files and 'linked-page.tsx' in files
+    assert not any(f.startswith('linked-lib') or f.endswith('.log') for f in files)
+
+def test_git_index_enumeration(tmp_path):
+    """Tracked files and their blob hashes come straight from .git/index"""
+    if shutil.which('git') is None:
+        pytest.skip('git not installed')
+    root = str(tmp_path)
+    make_tree(root, {'src/a.ts': 'export const a = 1\n', 'notes.md': '# notes\n', 'b.py': 'b = 2\n'})
+    make_tree(root, {'untracked.js': ''})
+    for version in ('2', '4'):
+        subprocess.run(['git', 'init', '-q'], cwd=root, check=True)
+        subprocess.run(['git', 'add', 'src', 'notes.md', 'b.py'], cwd=root, check=True)
+        subprocess.run(['git', 'update-index', '--index-version', version], cwd=root, check=True)
+        
+        known_hashes = {}
+        files = penetrate_final.scan_git_index(root, known_hashes)
+        assert sorted(f.replace(os.sep, '/') for f in files) == ['b.py', 'src/a.ts']
+        for rel_path, (size, _, blob_hash) in known_hashes.items():
+            with open(os.path.join(root, rel_path), 'rb') as f:
+                data = f.read()
+            assert (size, blob_hash) == (len(data), penetrate_final.hash_content(data))
+
 if __name__ == "__main__":
     test_path_parsing()